@@ -1,15 +1,22 @@
 import os
+import sys
 import asyncio
+from urllib.parse import quote, urlencode
 from fastapi import FastAPI, BackgroundTasks, Request, Query
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from sse_starlette.sse import EventSourceResponse
-from merge_tesla_cam import TeslaCamMerger
+from progress_events import EventBus, coalesce, parse_level
+from job_queue import JobManager, DONE
 
 app = FastAPI()
 VERSION = "v0.1.7"
 
+# SSE 每个连接按固定节奏取事件：一轮内的多条进度只发最后一条
+SSE_INTERVAL_S = 0.25
+SSE_HEARTBEAT_S = 15.0
+
 # 允许跨域
 app.add_middleware(
     CORSMiddleware,
@@ -21,15 +28,21 @@ app.add_middleware(
 # 任务状态
 class TaskStatus:
     def __init__(self):
-        self.is_running = False
-        self.progress = 0
-        self.logs = []
-        self.merger = None
-        self.queues = []
+        self.events = EventBus(capacity=2000, echo=lambda e: print(f"[CALLBACK] {e.message}", flush=True))
+        self.jobs = None
         self.loop = None
         self.history_mgr = None
         self.config_mgr = None
 
+    @property
+    def is_running(self):
+        return bool(self.jobs and self.jobs.is_running)
+
+    @property
+    def progress(self):
+        event = self.events.progress
+        return event.percent if event and event.percent is not None else 0
+
 status = TaskStatus()
 
 # --- History Manager ---
@@ -114,21 +127,29 @@ async def startup_event():
     status.loop = asyncio.get_running_loop()
     status.history_mgr = HistoryManager()
     status.config_mgr = ConfigManager()
+    status.jobs = JobManager(status.events, max_concurrent=lambda: status.config_mgr.config.get("max_concurrent_jobs", 1),
+                             on_finished=record_job,
+                             worker_token=lambda: status.config_mgr.config.get("render_worker_token"),
+                             fragment_cache_dir=lambda: status.config_mgr.config.get("fragment_cache_dir") or None)
+    status.jobs.start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    if status.jobs:
+        status.jobs.shutdown()
+
+def record_job(job):
+    """Record Success to History"""
+    final_output_file = job.get("output")
+    if job["status"] == DONE and final_output_file and os.path.exists(final_output_file):
+        f_size = os.path.getsize(final_output_file)
+        size_str = f"{f_size / (1024*1024):.1f} MB"
+        if status.history_mgr:
+            status.history_mgr.add_record(job["request"]["source_path"], final_output_file,
+                                          job["request"].get("target_date"), size_str)
 
 def progress_callback(message):
-    print(f"[CALLBACK] {message}", flush=True) # 增加终端打印，方便调试
-    if status.loop:
-        for q in status.queues:
-            status.loop.call_soon_threadsafe(q.put_nowait, message)
-            
-    if message.startswith("PROGRESS:"):
-        try:
-            status.progress = float(message.split(":")[1].replace("%", ""))
-        except:
-            pass
-    status.logs.append(message)
-    if len(status.logs) > 500:
-        status.logs.pop(0)
+    status.events.emit(message)
 
 from pydantic import BaseModel
 from typing import Optional, List
@@ -140,57 +161,80 @@ class StartRequest(BaseModel):
     sample_limit: Optional[int] = None
     target_date: Optional[str] = None
     target_timestamps: Optional[List[str]] = None
+    single_pass: Optional[bool] = False
+    wheel_sprites: Optional[bool] = False
+    render_workers: Optional[List[str]] = None  # 渲染 worker 地址，不填则用配置里的 render_workers
+    highlights: Optional[bool] = False  # 只渲染行车数据触发点前后的窗口
+    highlight_triggers: Optional[Dict[str, Any]] = None  # 不填则用配置里的 highlight_triggers
+    idle_mode: Optional[str] = None  # "drop" 去掉停车/哨兵画面，"timelapse" 把它们压成延时摄影
+
+class JobRequest(StartRequest):
+    priority: Optional[int] = 0
+
+class PriorityRequest(BaseModel):
+    priority: int
+
+def with_config_defaults(request):
+    if status.config_mgr:
+        for key in ("render_workers", "highlight_triggers"):
+            if request.get(key) is None:
+                request[key] = status.config_mgr.config.get(key) or None
+    return request
 
 @app.post("/api/start")
 async def start_task(req: StartRequest, background_tasks: BackgroundTasks):
-    if status.is_running:
-        return {"status": "error", "message": "任务已在运行中"}
-    
-    status.is_running = True
-    status.progress = 0
-    status.logs = ["开始扫描文件..."]
-    
-    def run_merger(source, output, limit, target_date, target_timestamps):
-        try:
-            # 发送初始进度，确保 SSE 建立后立刻有反馈
-            progress_callback("PROGRESS:1%:正在初始化合并引擎...")
-            status.merger = TeslaCamMerger(source, output, progress_callback)
-            if target_timestamps:
-                status.merger.target_timestamps = target_timestamps
-                
-            final_output_file = status.merger.merge_all(sample_count=limit, target_date=target_date)
-            
-            # Record Success to History
-            if final_output_file and os.path.exists(final_output_file):
-                f_size = os.path.getsize(final_output_file)
-                size_str = f"{f_size / (1024*1024):.1f} MB"
-                if status.history_mgr:
-                    status.history_mgr.add_record(source, final_output_file, target_date, size_str)
-            
-            progress_callback(f"COMPLETED:Successfully processed clips. Saved to {output}")
-        except Exception as e:
-            progress_callback(f"Error: {str(e)}")
-        finally:
-            status.is_running = False
-
-    thread = threading.Thread(target=run_merger, args=(req.source_path, req.output_path, req.sample_limit, req.target_date, req.target_timestamps))
-    thread.start()
-    
-    return {"status": "success", "message": "任务已启动"}
+    queued = status.is_running
+    if not queued:
+        status.events.clear()
+        progress_callback("开始扫描文件...")
+    job = status.jobs.submit(with_config_defaults(req.dict()))
+    return {"status": "success", "message": "已加入队列" if queued else "任务已启动", "job_id": job["id"]}
 
 @app.post("/api/stop")
 async def stop_task():
-    if status.merger:
-        status.merger.stop()
+    if status.jobs and status.jobs.cancel_running():
         return {"status": "success", "message": "停止指令已发送"}
     return {"status": "error", "message": "没有正在运行的任务"}
 
+# --- Job queue APIs ---
+@app.get("/api/jobs")
+async def list_jobs():
+    return {"status": "success", "jobs": status.jobs.list()}
+
+@app.post("/api/jobs")
+async def submit_job(req: JobRequest):
+    data = req.dict()
+    priority = data.pop("priority") or 0
+    job = status.jobs.submit(with_config_defaults(data), priority=priority)
+    return {"status": "success", "job": job}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = status.jobs.get(job_id)
+    if not job:
+        return JSONResponse({"status": "error", "message": "任务不存在"}, status_code=404)
+    return {"status": "success", "job": job}
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    if status.jobs.cancel(job_id):
+        return {"status": "success", "message": "已取消"}
+    return {"status": "error", "message": "任务不存在或已结束"}
+
+@app.post("/api/jobs/{job_id}/priority")
+async def reprioritize_job(job_id: str, req: PriorityRequest):
+    if status.jobs.set_priority(job_id, req.priority):
+        return {"status": "success", "job": status.jobs.get(job_id)}
+    return {"status": "error", "message": "任务不存在或已结束"}
+
 @app.get("/api/status")
-async def get_status():
+async def get_status(level: str = "info"):
+    latest = status.events.progress
     return {
         "is_running": status.is_running,
         "progress": status.progress,
-        "logs": status.logs[-20:]
+        "logs": [e.message for e in status.events.recent(20, parse_level(level))],
+        "event": latest.to_dict() if latest else None
     }
 
 # --- History APIs ---
@@ -229,35 +273,135 @@ async def get_videos(date: str, path: str):
     if not os.path.exists(path):
         return {"status": "error", "message": "路径不存在"}
     
-    from merge_tesla_cam import TeslaCamMerger
-    # 临时实例化以复用分组逻辑, 但这里我们只关心特定日期
-    merger = TeslaCamMerger(path, "", None)
-    grouped, _ = merger.group_videos()
+    from source_index import shared_index
+    # 查询源目录索引（只重新列出有变化的目录），不再每次完整遍历
+    index = shared_index()
+    index.refresh(path)
+    clips = index.clips(path, date)
     
-    if date not in grouped:
+    if not clips:
         return {"status": "success", "date": date, "videos": []}
 
     videos = []
-    # grouped[date] 是 timestamp -> {camera: file_path}
-    for ts, cameras in grouped[date].items():
+    # clips 是 timestamp -> {camera: {path, size, mtime_ns}}
+    for ts, cameras in clips.items():
         # 取任意一个存在的摄像头文件作为预览源
-        preview_file = next(iter(cameras.values()), "")
+        preview_file = next(iter(cameras.values()), {}).get("path", "")
         videos.append({
             "timestamp": ts,
             "cameras": list(cameras.keys()),
-            "preview_path": preview_file
+            "preview_path": preview_file,
+            "thumbnail": thumbnail_url(preview_file),
+            "sprite": thumbnail_url(preview_file, "sprite"),
+            "thumbnails": {cam: thumbnail_url(info["path"]) for cam, info in cameras.items()},
         })
+        if proxy_enabled():
+            query = urlencode({"source": path, "timestamp": ts})
+            videos[-1]["proxy"] = {
+                "hls": f"/api/proxy/playlist.m3u8?{urlencode({'path': preview_file})}",
+                "mp4": f"/api/stream?proxy=true&{urlencode({'path': preview_file})}",
+                "grid_hls": f"/api/proxy/playlist.m3u8?{query}",
+                "grid_mp4": f"/api/proxy/clip.mp4?{query}",
+            }
     
     # 按时间戳排序
     videos.sort(key=lambda x: x["timestamp"])
+    # 列表里用到的预览图先在后台生成，点开时基本都已在缓存里
+    thumbnail_service().prefetch([v["preview_path"] for v in videos if v["preview_path"]])
     return {"status": "success", "date": date, "videos": videos}
 
-from fastapi.responses import FileResponse, StreamingResponse
+_thumbnails = None
+
+def thumbnail_service():
+    global _thumbnails
+    if _thumbnails is None:
+        from thumbnails import ThumbnailService
+        ffmpeg_bin = resource_path("ffmpeg.exe" if os.name == "nt" else "ffmpeg") if getattr(sys, "frozen", False) else "ffmpeg"
+        _thumbnails = ThumbnailService(ffmpeg_bin, log=progress_callback)
+    return _thumbnails
+
+def thumbnail_url(path, kind="frame"):
+    return f"/api/thumbnail?kind={kind}&path={quote(path)}" if path else None
+
+@app.get("/api/thumbnail")
+async def get_thumbnail(path: str, kind: str = "frame"):
+    from thumbnails import KINDS
+    if kind not in KINDS or not os.path.isfile(path):
+        return JSONResponse(status_code=404, content={"message": "File not found"})
+    # 生成时会阻塞等待 ffmpeg，放到线程池里
+    thumb = await asyncio.get_running_loop().run_in_executor(None, thumbnail_service().get, path, kind)
+    if not thumb:
+        return JSONResponse(status_code=404, content={"message": "Thumbnail unavailable"})
+    # 缓存键包含源文件的身份，同一个 URL 的内容只会在源文件变化时改变
+    return FileResponse(thumb, media_type="image/jpeg", headers={"Cache-Control": "private, max-age=3600"})
+
+from fastapi.responses import FileResponse, StreamingResponse, Response
+
+_proxy = None
+
+def proxy_streamer():
+    global _proxy
+    if _proxy is None:
+        from stream_proxy import ProxyStreamer
+        _proxy = ProxyStreamer(thumbnail_service().ffmpeg_bin, log=progress_callback)
+    return _proxy
+
+def proxy_enabled():
+    # 低码率预览要转码，默认关闭（直接用 FileResponse 推原文件）；config.json 里 "preview_proxy": true 打开
+    return bool(status.config_mgr and status.config_mgr.config.get("preview_proxy") is True)
+
+def proxy_sources(path, source, timestamp):
+    """{"": file} for one clip, {camera: file} for the grid of a timestamp, None if nothing matches."""
+    if path:
+        return {"": path} if os.path.isfile(path) else None
+    if not (source and timestamp):
+        return None
+    from source_index import shared_index
+    cameras = shared_index().clips(source, timestamp.split("_")[0]).get(timestamp)
+    return {cam: info["path"] for cam, info in cameras.items()} if cameras else None
+
+@app.get("/api/proxy/playlist.m3u8")
+async def proxy_playlist(path: str = None, source: str = None, timestamp: str = None):
+    sources = proxy_sources(path, source, timestamp)
+    if not sources:
+        return JSONResponse(status_code=404, content={"message": "File not found"})
+    query = urlencode({k: v for k, v in (("path", path), ("source", source), ("timestamp", timestamp)) if v})
+    text = await asyncio.get_running_loop().run_in_executor(
+        None, proxy_streamer().playlist, sources, lambda i: f"/api/proxy/segment/{i}.ts?{query}")
+    if not text:
+        return JSONResponse(status_code=404, content={"message": "Unreadable clip"})
+    return Response(text, media_type="application/vnd.apple.mpegurl", headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/proxy/segment/{index}.ts")
+async def proxy_segment(index: int, path: str = None, source: str = None, timestamp: str = None):
+    sources = proxy_sources(path, source, timestamp)
+    if not sources:
+        return JSONResponse(status_code=404, content={"message": "File not found"})
+    # 第一次请求时才编码这一段，放到线程池里等 ffmpeg
+    segment = await asyncio.get_running_loop().run_in_executor(None, proxy_streamer().segment, sources, index)
+    if not segment:
+        return JSONResponse(status_code=404, content={"message": "Segment unavailable"})
+    return FileResponse(segment, media_type="video/mp2t", headers={"Cache-Control": "private, max-age=3600"})
+
+@app.get("/api/proxy/clip.mp4")
+async def proxy_clip(path: str = None, source: str = None, timestamp: str = None):
+    sources = proxy_sources(path, source, timestamp)
+    if not sources:
+        return JSONResponse(status_code=404, content={"message": "File not found"})
+    proxy_file = await asyncio.get_running_loop().run_in_executor(None, proxy_streamer().proxy_mp4, sources)
+    if not proxy_file:
+        return JSONResponse(status_code=404, content={"message": "Proxy unavailable"})
+    return FileResponse(proxy_file, media_type="video/mp4")
 
 @app.get("/api/stream")
-async def stream_video(path: str, range: str =  None):
+async def stream_video(path: str, range: str =  None, proxy: bool = False):
     if not os.path.exists(path):
         return JSONResponse(status_code=404, content={"message": "File not found"})
+    if proxy and proxy_enabled():
+        # 不支持 HLS 的 webview：整段转成一个低码率 MP4，缓存后照样支持 Range
+        proxy_file = await asyncio.get_running_loop().run_in_executor(None, proxy_streamer().proxy_mp4, {"": path})
+        if proxy_file:
+            return FileResponse(proxy_file, media_type="video/mp4", filename=os.path.basename(path))
     
     file_size = os.path.getsize(path)
     
@@ -319,9 +463,9 @@ async def get_dates(path: str):
     if not os.path.exists(path):
         return {"dates": [], "merged_dates": []}
     
-    from merge_tesla_cam import TeslaCamMerger
-    merger = TeslaCamMerger(path, "", None)
-    grouped, _ = merger.group_videos()
+    from source_index import shared_index
+    index = shared_index()
+    index.refresh(path)
     
     # 获取历史记录中已经合并成功的日期
     merged_dates = []
@@ -329,10 +473,92 @@ async def get_dates(path: str):
         merged_dates = [record["target_date"] for record in status.history_mgr.history if record["status"] == "success"]
     
     return {
-        "dates": sorted(grouped.keys(), reverse=True),
+        "dates": index.dates(path),
         "merged_dates": list(set(merged_dates)) # 去重
     }
 
+# --- 行车数据检索 ---
+telemetry_jobs = {}  # 源目录 -> 后台建索引的进度
+
+def _index_telemetry(root, date):
+    from telemetry_index import shared_telemetry_index
+    job = telemetry_jobs[root]
+    def progress(done, total):
+        job.update(done=done, total=total)
+    try:
+        job["result"] = shared_telemetry_index().update(root, date or None, progress=progress)
+        progress_callback(f"Telemetry index for {root}: {job['result']['indexed']} clips indexed, "
+                          f"{job['result']['failed']} unreadable")
+    except Exception as e:
+        job["error"] = str(e)
+        progress_callback(f"Error: telemetry indexing failed: {e}")
+    finally:
+        job["running"] = False
+
+@app.post("/api/telemetry/index")
+async def build_telemetry_index(path: str, date: str = None):
+    """Indexes new/changed clips under path (optionally one date or YYYY-MM) in the background."""
+    if not os.path.exists(path):
+        return {"status": "error", "message": "路径不存在"}
+    root = os.path.abspath(path)
+    job = telemetry_jobs.get(root)
+    if job and job["running"]:
+        return {"status": "running", **job}
+    telemetry_jobs[root] = {"running": True, "done": 0, "total": 0, "result": None, "error": None, "date": date}
+    threading.Thread(target=_index_telemetry, args=(root, date), name="telemetry-index", daemon=True).start()
+    return {"status": "started"}
+
+@app.get("/api/telemetry/status")
+async def telemetry_status(path: str):
+    from telemetry_index import shared_telemetry_index
+    root = os.path.abspath(path)
+    return {"status": "success", "job": telemetry_jobs.get(root), "index": shared_telemetry_index().stats(root)}
+
+@app.get("/api/telemetry/search")
+async def telemetry_search(path: str, start: str = None, end: str = None, min_speed: float = None,
+                           max_speed: float = None, autopilot: bool = None, brake: bool = None, gear: str = None,
+                           limit: int = 500):
+    """Minutes with at least one second matching all conditions (speeds in km/h, dates YYYY-MM-DD or YYYY-MM)."""
+    from telemetry_index import shared_telemetry_index
+    rows = shared_telemetry_index().search(path, start, end, min_speed, max_speed, autopilot, brake, gear, limit)
+    return {"status": "success", "results": rows}
+
+@app.get("/api/telemetry/events")
+async def telemetry_events(path: str, kind: str = None, start: str = None, end: str = None, min_speed: float = None,
+                           max_speed: float = None, limit: int = 500):
+    """Autopilot engage/disengage and hard-braking moments, e.g. kind=autopilot_disengaged&min_speed=80."""
+    from telemetry_index import shared_telemetry_index, EVENT_KINDS
+    if kind and kind not in EVENT_KINDS:
+        return {"status": "error", "message": f"kind must be one of {', '.join(EVENT_KINDS)}"}
+    rows = shared_telemetry_index().events(path, kind, start, end, min_speed, max_speed, limit)
+    return {"status": "success", "events": rows}
+
+@app.get("/api/telemetry/clips")
+async def telemetry_clips(path: str, start: str = None, end: str = None, min_speed: float = None,
+                          autopilot: bool = None, hard_brake: bool = None, limit: int = 500):
+    """Per-minute telemetry summaries."""
+    from telemetry_index import shared_telemetry_index
+    rows = shared_telemetry_index().clips(path, start, end, min_speed, autopilot, hard_brake, limit)
+    return {"status": "success", "clips": rows}
+
+@app.get("/api/track")
+async def export_gps_track(path: str, date: str, format: str = "gpx", tolerance: float = None):
+    """The day's GPS track as GPX or GeoJSON, streamed clip by clip (tolerance: simplification in metres)."""
+    from gps_export import FORMATS, TOLERANCE_M, day_clips, export_track
+    if format not in FORMATS:
+        return JSONResponse({"status": "error", "message": f"format must be one of {', '.join(FORMATS)}"}, status_code=400)
+    if not os.path.exists(path):
+        return JSONResponse({"status": "error", "message": "路径不存在"}, status_code=404)
+    clips = day_clips(os.path.abspath(path), date)
+    if not clips:
+        return JSONResponse({"status": "error", "message": "该日期没有前视摄像头片段"}, status_code=404)
+    media_type = "application/gpx+xml" if format == "gpx" else "application/geo+json"
+    filename = f"TeslaCam_{date}.{format}"
+    # 同步生成器由 Starlette 放到线程池里逐块执行，不会阻塞事件循环
+    chunks = export_track(clips, format, TOLERANCE_M if tolerance is None else tolerance, name=f"TeslaCam {date}")
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
 @app.get("/api/sys_stats")
 async def get_sys_stats():
     import psutil
@@ -351,6 +577,16 @@ async def get_sys_stats():
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@app.get("/api/cache_stats")
+async def get_cache_stats():
+    from merge_tesla_cam import open_fragment_cache
+    try:
+        cache = open_fragment_cache(status.config_mgr.config.get("fragment_cache_dir") or None)
+        return {"status": "success", "fragments": cache.stats(), "thumbnails": thumbnail_service().stats(),
+                "proxy": proxy_streamer().stats()}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
 @app.get("/api/disks")
 async def get_disk_usage():
     import shutil
@@ -449,29 +685,41 @@ async def get_preview(path: str = Query(..., description="要预览的路径")):
         return {"status": "error", "message": str(e)}
 
 @app.get("/api/events")
-async def sse_events(request: Request):
+async def sse_events(request: Request, level: str = "info", format: str = "text"):
+    """Progress stream. format=text sends the legacy strings (what index.html parses),
+    format=json sends typed events (`event: progress|log|completed`, data = Event.to_dict()).
+    Debug lines are only sent with level=debug."""
+    min_level = parse_level(level)
+    typed = format == "json"
+
+    def encode(event):
+        if typed:
+            return {"event": event.kind, "id": str(event.seq), "data": json.dumps(event.to_dict(), ensure_ascii=False)}
+        return {"id": str(event.seq), "data": event.message}
+
     async def event_generator():
-        queue = asyncio.Queue()
-        status.queues.append(queue)
-        
         # 先把最近的 50 条日志补发给新连接，防止还没连上 SSE 之前的日志丢掉
-        # 过滤掉之前的 PROGRESS 消息，以免进度条跳动，只补发普通文本日志
-        for old_log in status.logs[-50:]:
-            if not old_log.startswith("PROGRESS:"):
-                yield {"data": old_log}
-        
-        try:
-            while True:
-                if await request.is_disconnected():
-                    break
-                try:
-                    msg = await asyncio.wait_for(queue.get(), timeout=1.0)
-                    yield {"data": msg}
-                except asyncio.TimeoutError:
-                    yield {"comment": "heartbeat"}
-        finally:
-            if queue in status.queues:
-                status.queues.remove(queue)
+        # 过滤掉之前的 PROGRESS 消息，以免进度条跳动，只补发普通文本日志（json 客户端额外拿到最新进度）
+        seq = status.events.seq
+        for event in status.events.recent(50, min_level, kinds=("log",)):
+            yield encode(event)
+        if typed and status.events.progress:
+            yield encode(status.events.progress)
+
+        idle = 0.0
+        while True:
+            if await request.is_disconnected():
+                break
+            await asyncio.sleep(SSE_INTERVAL_S)
+            events, seq, dropped = status.events.since(seq, min_level)
+            if dropped and typed:
+                yield {"event": "dropped", "data": json.dumps({"count": dropped})}
+            for event in coalesce(events):
+                yield encode(event)
+            idle = 0.0 if events else idle + SSE_INTERVAL_S
+            if idle >= SSE_HEARTBEAT_S:
+                idle = 0.0
+                yield {"comment": "heartbeat"}
 
     return EventSourceResponse(event_generator())
 
@@ -511,6 +759,10 @@ async def read_qr():
     return JSONResponse({"status": "error", "message": "QR code not found"}, status_code=404)
 
 if __name__ == "__main__":
+    import multiprocessing
+    # 打包后的程序启动 SEI 提取进程池时需要
+    multiprocessing.freeze_support()
+
     import uvicorn
     import webview
     import threading
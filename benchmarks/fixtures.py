@@ -0,0 +1,167 @@
+"""Synthetic TeslaCam data for benchmarks."""
+import os
+import math
+import struct
+import datetime
+import subprocess
+
+import dashcam_pb2
+
+
+def add_emulation_prevention(data: bytes) -> bytes:
+    """Inserts 0x03 after every 00 00 that is followed by a byte <= 0x03 (H.264 RBSP -> EBSP)."""
+    out = bytearray()
+    zeros = 0
+    for byte in data:
+        if zeros >= 2 and byte <= 0x03:
+            out.append(0x03)
+            zeros = 0
+        out.append(byte)
+        zeros = zeros + 1 if byte == 0 else 0
+    return bytes(out)
+
+
+def make_sei_metadata(frame_index: int, fps: float = 36.0, parked: bool = False) -> dashcam_pb2.SeiMetadata:
+    """A plausible, slowly changing telemetry sample for frame_index (parked: Sentry-style, nothing moves)."""
+    t = frame_index / fps
+    meta = dashcam_pb2.SeiMetadata()
+    if parked:
+        meta.version = 1
+        meta.gear_state = dashcam_pb2.SeiMetadata.GEAR_PARK
+        meta.frame_seq_no = frame_index
+        meta.steering_wheel_angle = 0.3 * math.sin(t * 7.0)  # 传感器噪声
+        meta.latitude_deg = 31.2304
+        meta.longitude_deg = 121.4737
+        meta.linear_acceleration_mps2_z = 9.8
+        return meta
+    meta.version = 1
+    meta.gear_state = dashcam_pb2.SeiMetadata.GEAR_DRIVE
+    meta.frame_seq_no = frame_index
+    meta.vehicle_speed_mps = 15.0 + 5.0 * math.sin(t / 10.0)
+    meta.accelerator_pedal_position = 20.0 + 10.0 * math.sin(t / 3.0)
+    meta.steering_wheel_angle = 30.0 * math.sin(t / 4.0)
+    meta.blinker_on_left = int(t) % 20 < 3
+    meta.blinker_on_right = False
+    meta.brake_applied = int(t) % 15 == 0
+    meta.autopilot_state = dashcam_pb2.SeiMetadata.AUTOSTEER if int(t) % 40 < 20 else dashcam_pb2.SeiMetadata.NONE
+    meta.latitude_deg = 31.2304 + t * 1e-5
+    meta.longitude_deg = 121.4737 + t * 1e-5
+    meta.heading_deg = (t * 2.0) % 360
+    meta.linear_acceleration_mps2_x = 0.5 * math.sin(t)
+    meta.linear_acceleration_mps2_y = 0.2 * math.cos(t)
+    meta.linear_acceleration_mps2_z = 9.8
+    return meta
+
+
+def make_sei_nal(meta: dashcam_pb2.SeiMetadata) -> bytes:
+    """Tesla-style user-data SEI NAL: 06 05 <size> 42 42 42 69 <protobuf> 80."""
+    payload = b"\x42\x42\x42\x69" + meta.SerializeToString()
+    return b"\x06\x05" + bytes([len(payload)]) + add_emulation_prevention(payload) + b"\x80"
+
+
+def write_synthetic_mdat_clip(path: str, frames: int = 2160, slice_bytes: int = 16 * 1024, fps: float = 36.0,
+                              parked: bool = False) -> int:
+    """Writes an ftyp + mdat file of length-prefixed NALs (one SEI and one slice per frame).
+
+    It is not playable, but has the exact layout DashcamParser scans, so parser
+    throughput can be measured without ffmpeg.  Returns the file size.
+    """
+    # 伪造的 IDR/非 IDR slice，内容无所谓，只要大小接近真实码率
+    slice_body = bytes((i * 131) & 0xFF or 1 for i in range(slice_bytes - 1))
+    with open(path, "wb") as f:
+        f.write(struct.pack(">I4s4sI4s", 20, b"ftyp", b"isom", 0x200, b"isom"))
+        mdat_start = f.tell()
+        f.write(struct.pack(">I4s", 0, b"mdat"))
+        for i in range(frames):
+            sei = make_sei_nal(make_sei_metadata(i, fps, parked))
+            f.write(struct.pack(">I", len(sei)) + sei)
+            nal = (b"\x65" if i % 36 == 0 else b"\x41") + slice_body
+            f.write(struct.pack(">I", len(nal)) + nal)
+        end = f.tell()
+        f.seek(mdat_start)
+        f.write(struct.pack(">I", end - mdat_start))
+    return os.path.getsize(path)
+
+
+# 各摄像头用不同的测试图案，避免编码器因四路画面相同而"作弊"
+CAMERA_SOURCES = {
+    "front": "testsrc2",
+    "back": "smptehdbars",
+    "left_repeater": "rgbtestsrc",
+    "right_repeater": "testsrc",
+}
+
+
+def split_annexb(data: bytes):
+    """NAL units of an Annex B byte stream (start codes and trailing zero bytes removed)."""
+    starts = []
+    i = data.find(b"\x00\x00\x01")
+    while i != -1:
+        starts.append(i + 3)
+        i = data.find(b"\x00\x00\x01", i + 3)
+    nals = []
+    for n, start in enumerate(starts):
+        end = starts[n + 1] - 3 if n + 1 < len(starts) else len(data)
+        nal = data[start:end].rstrip(b"\x00")
+        if nal:
+            nals.append(nal)
+    return nals
+
+
+def inject_sei(annexb: bytes, fps: float = 36.0, parked: bool = False) -> bytes:
+    """Inserts one Tesla SeiMetadata SEI in front of the first slice of every frame."""
+    out = bytearray()
+    frame = 0
+    for nal in split_annexb(annexb):
+        nal_type = nal[0] & 0x1F
+        # first_mb_in_slice == 0（ue(v) 编码为单个 1 比特）表示一帧的第一个 slice
+        if nal_type in (1, 5) and len(nal) > 1 and nal[1] & 0x80:
+            out += b"\x00\x00\x00\x01" + make_sei_nal(make_sei_metadata(frame, fps, parked))
+            frame += 1
+        out += b"\x00\x00\x00\x01" + nal
+    return bytes(out)
+
+
+def write_camera_clip(path: str, camera: str, seconds: float = 60.0, size: str = "640x480", fps: float = 36.0,
+                      with_sei: bool = False, parked: bool = False, ffmpeg: str = "ffmpeg") -> int:
+    """Encodes a playable H.264 MP4 from an ffmpeg test source, optionally with SEI telemetry. Returns its size."""
+    source = CAMERA_SOURCES.get(camera, "testsrc2")
+    encode = [ffmpeg, "-v", "error", "-f", "lavfi", "-i", f"{source}=size={size}:rate={fps:g}:duration={seconds:g}",
+              "-c:v", "libx264", "-preset", "ultrafast", "-g", str(int(fps)), "-pix_fmt", "yuv420p"]
+    if not with_sei:
+        subprocess.run(encode + ["-movflags", "+faststart", "-y", path], check=True)
+        return os.path.getsize(path)
+
+    raw = subprocess.run(encode + ["-f", "h264", "-"], check=True, capture_output=True).stdout
+    h264_path = path + ".h264"
+    try:
+        with open(h264_path, "wb") as f:
+            f.write(inject_sei(raw, fps, parked))
+        subprocess.run([ffmpeg, "-v", "error", "-framerate", f"{fps:g}", "-f", "h264", "-i", h264_path,
+                        "-c", "copy", "-movflags", "+faststart", "-y", path], check=True)
+    finally:
+        if os.path.exists(h264_path):
+            os.remove(h264_path)
+    return os.path.getsize(path)
+
+
+def write_teslacam_tree(root: str, days: int = 1, clips_per_day: int = 3, seconds: float = 60.0, size: str = "640x480",
+                        fps: float = 36.0, start: str = "2024-01-01_08-00-00", ffmpeg: str = "ffmpeg") -> dict:
+    """Creates root/RecentClips/YYYY-MM-DD_HH-MM-SS-{camera}.mp4 for consecutive minutes on consecutive days.
+    Front clips carry SeiMetadata SEI. Returns {"files", "bytes", "front_bytes", "clips"}."""
+    folder = os.path.join(root, "RecentClips")
+    os.makedirs(folder, exist_ok=True)
+    first = datetime.datetime.strptime(start, "%Y-%m-%d_%H-%M-%S")
+    stats = {"files": 0, "bytes": 0, "front_bytes": 0, "clips": 0}
+    for day in range(days):
+        for minute in range(clips_per_day):
+            ts = (first + datetime.timedelta(days=day, minutes=minute)).strftime("%Y-%m-%d_%H-%M-%S")
+            for camera in CAMERA_SOURCES:
+                size_bytes = write_camera_clip(os.path.join(folder, f"{ts}-{camera}.mp4"), camera, seconds, size, fps,
+                                               with_sei=camera == "front", ffmpeg=ffmpeg)
+                stats["files"] += 1
+                stats["bytes"] += size_bytes
+                if camera == "front":
+                    stats["front_bytes"] += size_bytes
+            stats["clips"] += 1
+    return stats
@@ -0,0 +1,182 @@
+"""End-to-end merger benchmark on a synthetic (or real) TeslaCam tree.
+
+Times each stage of the fragment pipeline separately: group_videos,
+DashcamParser.extract_sei_to_ass over all front clips, process_clip for
+every minute (sequential, fragment cache off) and the validate + concat
+step per day.  Reports clips/minute, parser MB/s and peak RSS of the
+benchmark process and of its ffmpeg children.
+
+    python -m benchmarks.merge_pipeline                          # 1 day x 3 one-minute clips, 640x480
+    python -m benchmarks.merge_pipeline --clips 10 --size 1280x960
+    python -m benchmarks.merge_pipeline --source /Volumes/TESLADRIVE/TeslaCam --limit 5
+    python -m benchmarks.merge_pipeline --json results/v0.1.7.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from merge_tesla_cam import TeslaCamMerger
+from dashcam_parser import DashcamParser
+from benchmarks.fixtures import write_teslacam_tree
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peak_rss_mb():
+    """(this process, largest child process) peak RSS in MB; None where the platform cannot tell."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+            info = psutil.Process().memory_info()
+            return round(getattr(info, "peak_wset", info.rss) / 1024 ** 2, 1), None
+        except ImportError:
+            return None, None
+    # ru_maxrss 在 Linux 上是 KB，在 macOS 上是字节
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return round(own / 1024 ** 2, 1), round(children / 1024 ** 2, 1)
+
+
+def environment(ffmpeg_bin):
+    """Versions the numbers depend on, so results from different releases can be compared."""
+    env = {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()}
+    try:
+        with open(os.path.join(REPO_DIR, "backend.py"), encoding="utf-8") as f:
+            match = re.search(r'^VERSION = "([^"]+)"', f.read(), re.M)
+        env["version"] = match.group(1) if match else None
+    except OSError:
+        env["version"] = None
+    try:
+        env["git"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                                    text=True).stdout.strip() or None
+    except OSError:
+        env["git"] = None
+    try:
+        env["ffmpeg"] = subprocess.run([ffmpeg_bin, "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        env["ffmpeg"] = None
+    return env
+
+
+def run(source, work_dir, limit=None, log=None):
+    log = log or (lambda message: None)
+    output_dir = os.path.join(work_dir, "out")
+    os.makedirs(output_dir, exist_ok=True)
+    merger = TeslaCamMerger(source, output_dir, progress_callback=log, use_fragment_cache=False)
+    results = {}
+
+    start = time.perf_counter()
+    grouped, total_files = merger.group_videos()
+    results["group_videos"] = {"seconds": round(time.perf_counter() - start, 3), "files": total_files,
+                               "days": len(grouped)}
+
+    days = {}
+    for date_str, timestamps in sorted(grouped.items()):
+        selected = sorted(timestamps.items())[:limit] if limit else sorted(timestamps.items())
+        days[date_str] = selected
+    clips = [(ts, cams) for selected in days.values() for ts, cams in selected]
+
+    # SEI -> ASS：只统计解析与写文件，不含编码
+    parser = DashcamParser()
+    fronts = [(ts, cams["front"]) for ts, cams in clips if cams.get("front")]
+    front_bytes = sum(os.path.getsize(path) for _, path in fronts)
+    ass_path = os.path.join(work_dir, "bench.ass")
+    start = time.perf_counter()
+    with_sei = sum(1 for ts, path in fronts if parser.extract_sei_to_ass(path, ass_path, base_timestamp_str=ts))
+    parse_s = time.perf_counter() - start
+    results["extract_sei_to_ass"] = {
+        "seconds": round(parse_s, 3), "clips": len(fronts), "clips_with_sei": with_sei,
+        "mb": round(front_bytes / 1024 ** 2, 2),
+        "mb_per_s": round(front_bytes / 1024 ** 2 / parse_s, 1) if parse_s else None,
+        "ass_events": parser.ass_stats["text_events"] + parser.ass_stats["wheel_events"],
+    }
+
+    merger.probe_encoders()
+    fragments = {date_str: [] for date_str in days}
+    start = time.perf_counter()
+    for date_str, selected in days.items():
+        for ts, cams in selected:
+            fragment = merger.process_clip(ts, cams)
+            if fragment:
+                fragments[date_str].append((ts, fragment))
+    encode_s = time.perf_counter() - start
+    rendered = sum(len(f) for f in fragments.values())
+    results["process_clip"] = {
+        "seconds": round(encode_s, 3), "clips": len(clips), "rendered": rendered,
+        "clips_per_minute": round(rendered * 60 / encode_s, 2) if encode_s else None,
+        "encoders": merger._usable_encoders(),
+    }
+
+    start = time.perf_counter()
+    outputs = [merger._finalize_day(date_str, day_fragments) for date_str, day_fragments in fragments.items()]
+    results["concat"] = {"seconds": round(time.perf_counter() - start, 3), "days": len(outputs),
+                         "outputs": sum(1 for o in outputs if o)}
+
+    total_s = sum(results[k]["seconds"] for k in ("group_videos", "extract_sei_to_ass", "process_clip", "concat"))
+    own, children = peak_rss_mb()
+    results["total"] = {"seconds": round(total_s, 3),
+                        "clips_per_minute": round(rendered * 60 / total_s, 2) if total_s else None,
+                        "peak_rss_mb": own, "peak_child_rss_mb": children}
+    return results
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--source", help="existing TeslaCam folder (default: generate a synthetic tree)")
+    ap.add_argument("--limit", type=int, help="clips per day to process from --source")
+    ap.add_argument("--days", type=int, default=1)
+    ap.add_argument("--clips", type=int, default=3, help="one-minute clips per synthetic day")
+    ap.add_argument("--seconds", type=float, default=60.0, help="length of each synthetic clip")
+    ap.add_argument("--size", default="640x480", help="synthetic camera resolution (Tesla: 1280x960)")
+    ap.add_argument("--work-dir", help="keep the tree and outputs here instead of a temp dir")
+    ap.add_argument("--json", dest="json_path", help="write results as JSON")
+    ap.add_argument("-v", "--verbose", action="store_true", help="print merger log lines")
+    args = ap.parse_args(argv)
+
+    ffmpeg_bin = shutil.which("ffmpeg") or "ffmpeg"
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="teslacam_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    log = print if args.verbose else None
+    try:
+        config = {"source": args.source, "limit": args.limit}
+        source = args.source
+        if not source:
+            source = os.path.join(work_dir, "TeslaCam")
+            config.update(days=args.days, clips=args.clips, seconds=args.seconds, size=args.size)
+            start = time.perf_counter()
+            tree = write_teslacam_tree(source, args.days, args.clips, args.seconds, args.size, ffmpeg=ffmpeg_bin)
+            print(f"Generated {tree['files']} files ({tree['bytes'] / 1024 ** 2:.1f} MB) "
+                  f"in {time.perf_counter() - start:.1f} s")
+        results = run(source, work_dir, args.limit, log)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for stage in ("group_videos", "extract_sei_to_ass", "process_clip", "concat", "total"):
+        r = results[stage]
+        extra = ", ".join(f"{k} {v}" for k, v in r.items() if k != "seconds")
+        print(f"{stage:>20}: {r['seconds']:8.2f} s  {extra}")
+    if args.json_path:
+        report = {"benchmark": "merge_pipeline", "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "environment": environment(ffmpeg_bin), "config": config, "results": results}
+        os.makedirs(os.path.dirname(os.path.abspath(args.json_path)), exist_ok=True)
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0 if results["process_clip"]["rendered"] == results["process_clip"]["clips"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""ASS overlay size: delta-coalesced events vs. the previous one-event-per-sample writer.
+
+    python -m benchmarks.overlay_events                 # synthetic driving + parked minute
+    python -m benchmarks.overlay_events clip-front.mp4  # real clips
+    python -m benchmarks.overlay_events --render        # also time libass burn-in with ffmpeg
+    python -m benchmarks.overlay_events --json out.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dashcam_parser import DashcamParser, WHEEL_VECTOR, format_time_ass
+from benchmarks.fixtures import write_synthetic_mdat_clip
+
+BASE_TIMESTAMP = "2024-01-01_00-00-00"
+
+
+class LegacyOverlayParser(DashcamParser):
+    """Writes a text and a wheel event for every ~6 Hz sample, as before coalescing."""
+
+    def _ass_events(self, messages, base_dt=None, time_offset=0.0, wheel_spans=None):
+        # 旧写法没有方向盘精灵，wheel_spans 忽略
+        frame_duration = 1.0 / self.fps
+        step = max(1, int(self.fps / 6))
+        for i in range(0, len(messages), step):
+            meta = messages[i]
+            start = format_time_ass(i * frame_duration + time_offset)
+            end = format_time_ass(min(i + step, len(messages)) * frame_duration + time_offset)
+            self.ass_stats["samples"] += 1
+            self.ass_stats["text_events"] += 1
+            self.ass_stats["wheel_events"] += 1
+            text = self._overlay_text(meta, base_dt, i * frame_duration, meta.steering_wheel_angle)
+            yield f"Dialogue: 0,{start},{end},DashData,,0,0,0,,{{\\pos(40,40)}}{text}\n"
+            yield (f"Dialogue: 0,{start},{end},DashWheel,,0,0,0,,"
+                   f"{{\\an7\\pos(380,430)\\org(380,430)\\frz{meta.steering_wheel_angle}}}{{\\p1}}{WHEEL_VECTOR}{{\\p0}}\n")
+
+
+def render_seconds(ass_path, duration, ffmpeg="ffmpeg"):
+    """Wall time for ffmpeg to burn ass_path onto a blank 1080p video of `duration` seconds."""
+    escaped = ass_path.replace("\\", "/").replace(":", "\\:")
+    cmd = [ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+           "-i", f"color=c=black:s=1920x1080:r=36:d={duration:.3f}",
+           "-vf", f"ass='{escaped}'", "-f", "null", "-"]
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True)
+    return time.perf_counter() - start
+
+
+def benchmark_file(path, render=False):
+    messages = DashcamParser().extract_sei_messages(path)
+    duration = len(messages) / 36.0
+    result = {"file": path, "sei_messages": len(messages)}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, parser in (("legacy", LegacyOverlayParser()), ("coalesced", DashcamParser())):
+            ass_path = os.path.join(tmp, f"{label}.ass")
+            parser.write_ass(messages, ass_path, BASE_TIMESTAMP)
+            stats = parser.ass_stats
+            result[f"{label}_events"] = stats["text_events"] + stats["wheel_events"]
+            result[f"{label}_kb"] = round(os.path.getsize(ass_path) / 1024, 1)
+            if render and messages:
+                result[f"{label}_render_s"] = round(render_seconds(ass_path, duration), 2)
+    result["event_reduction"] = round(result["legacy_events"] / max(1, result["coalesced_events"]), 1)
+    return result
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("clips", nargs="*", help="front camera clips (default: one synthetic driving and one parked minute)")
+    ap.add_argument("--render", action="store_true", help="time libass rendering with ffmpeg")
+    ap.add_argument("--json", dest="json_path", help="write results as JSON")
+    args = ap.parse_args(argv)
+
+    if args.render and not shutil.which("ffmpeg"):
+        print("ffmpeg not found, skipping --render")
+        args.render = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        clips = args.clips
+        if not clips:
+            clips = []
+            for name, parked in (("driving", False), ("parked", True)):
+                synthetic = os.path.join(tmp, f"{BASE_TIMESTAMP}-{name}-front.mp4")
+                write_synthetic_mdat_clip(synthetic, slice_bytes=256, parked=parked)
+                clips.append(synthetic)
+        results = [benchmark_file(path, args.render) for path in clips]
+
+    for r in results:
+        line = (f"{os.path.basename(r['file'])}: {r['sei_messages']} SEI | events {r['legacy_events']} -> "
+                f"{r['coalesced_events']} (x{r['event_reduction']}), {r['legacy_kb']} KB -> {r['coalesced_kb']} KB")
+        if "legacy_render_s" in r:
+            line += f" | libass {r['legacy_render_s']} s -> {r['coalesced_render_s']} s"
+        print(line)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "overlay_events", "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
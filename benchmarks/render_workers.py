@@ -0,0 +1,186 @@
+"""End-to-end check of distributed rendering against real render_worker apps.
+
+Starts two workers in this process on ephemeral ports, both requiring a
+token: "shared" may read the synthetic tree in place (--source-root), "upload"
+has no source root, so every camera file is uploaded.  A third URL points at
+a port nothing listens on.  Then runs:
+
+    shared    one clip on the shared worker; no camera is uploaded
+    upload    one clip on the upload worker; every camera is uploaded
+    retry     the dead URL is marked healthy (a worker that died after its
+              health check); the clip fails there and is retried on another
+    token     a pool with the wrong token: health checks get 401, nothing is
+              sent, merge_all encodes every clip locally
+    merge     merge_all over the whole tree with all three URLs
+
+and reports each scenario's time and outcome.  Needs fastapi + uvicorn.
+
+    python -m benchmarks.render_workers
+    python -m benchmarks.render_workers --clips 4 --seconds 10 --json results/workers.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from merge_tesla_cam import TeslaCamMerger, RENDER_VERSION
+from mp4_check import check_fragment
+from render_worker import RenderWorkerPool, create_app
+from benchmarks.fixtures import write_teslacam_tree
+
+TOKEN = "benchmark-token"
+
+
+def free_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+def dead_url():
+    """A local URL nothing listens on (connection refused)."""
+    sock = free_socket()
+    port = sock.getsockname()[1]
+    sock.close()
+    return f"http://127.0.0.1:{port}"
+
+
+def start_worker(work_dir, source_root=None, log=None):
+    """Runs a render worker app in a daemon thread. Returns (url, uvicorn server)."""
+    import uvicorn
+
+    app = create_app(work_dir, TOKEN, source_root, log=log or (lambda message: None))
+    sock = free_socket()
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("render worker did not start")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}", server
+
+
+def render_one(pool, merger, timestamp, cameras, dest):
+    """Renders one clip through pool into dest."""
+    start = time.perf_counter()
+    ok = pool.render(timestamp, cameras, merger.render_params(), dest)
+    return {"seconds": round(time.perf_counter() - start, 3), "rendered": ok, "valid": ok and check_fragment(dest),
+            "workers": pool.snapshot()}
+
+
+def missing_cameras(pool, url, timestamp, cameras, params):
+    """The cameras url would want uploaded for this clip (the clip is deleted again)."""
+    manifest = json.dumps(pool.manifest(timestamp, cameras, params)).encode("utf-8")
+    with pool._request(f"{url}/clips", manifest, "POST", {"Content-Type": "application/json"}) as resp:
+        clip = json.load(resp)
+    pool._request(f"{url}/clips/{clip['id']}", method="DELETE").close()
+    return sorted(clip["missing"])
+
+
+def run(source, work_dir, log=None):
+    log = log or (lambda message: None)
+    shared_url, shared_server = start_worker(os.path.join(work_dir, "worker-shared"), source_root=source, log=log)
+    upload_url, upload_server = start_worker(os.path.join(work_dir, "worker-upload"), log=log)
+    dead = dead_url()
+    results = {}
+    try:
+        merger = TeslaCamMerger(source, os.path.join(work_dir, "out"), progress_callback=log, use_fragment_cache=False,
+                                use_source_index=False, use_journal=False)
+        grouped, _ = merger.group_videos()
+        clips = [(ts, cams) for day in sorted(grouped) for ts, cams in sorted(grouped[day].items())]
+        timestamp, cameras = clips[0]
+        params = merger.render_params()
+        fragments = os.path.join(work_dir, "fragments")
+        os.makedirs(fragments, exist_ok=True)
+
+        def pool_for(urls, token=TOKEN):
+            pool = RenderWorkerPool(urls, token=token, log=log)
+            pool.render_version = RENDER_VERSION
+            return pool
+
+        pool = pool_for([shared_url])
+        r = render_one(pool, merger, timestamp, cameras, os.path.join(fragments, "shared.mp4"))
+        r["uploaded"] = missing_cameras(pool, shared_url, timestamp, cameras, params)
+        r["ok"] = r["valid"] and r["uploaded"] == []
+        results["shared"] = r
+
+        pool = pool_for([upload_url])
+        r = render_one(pool, merger, timestamp, cameras, os.path.join(fragments, "upload.mp4"))
+        r["uploaded"] = missing_cameras(pool, upload_url, timestamp, cameras, params)
+        r["ok"] = r["valid"] and r["uploaded"] == sorted(cameras)
+        results["upload"] = r
+
+        pool = pool_for([dead, shared_url])
+        pool.check_health(force=True)
+        # 模拟健康检查之后才挂掉的 worker：第一次派活一定落在它上面
+        pool.workers[0].update(healthy=True, capacity=1)
+        r = render_one(pool, merger, timestamp, cameras, os.path.join(fragments, "retry.mp4"))
+        dead_state, shared_state = r["workers"]
+        r["ok"] = r["valid"] and not dead_state["healthy"] and shared_state["rendered"] == 1
+        results["retry"] = r
+
+        for name, urls, token in (("token", [shared_url, upload_url], "wrong-token"),
+                                  ("merge", [shared_url, upload_url, dead], TOKEN)):
+            pool = pool_for(urls, token)
+            output_dir = os.path.join(work_dir, f"out-{name}")
+            start = time.perf_counter()
+            output = TeslaCamMerger(source, output_dir, progress_callback=log, use_fragment_cache=False,
+                                    use_source_index=False, use_journal=False, render_pool=pool).merge_all()
+            workers = pool.snapshot()
+            remote = sum(w["rendered"] for w in workers)
+            r = {"seconds": round(time.perf_counter() - start, 3), "output": bool(output and os.path.exists(output)),
+                 "clips": len(clips), "remote": remote, "workers": workers}
+            # 令牌不对时所有片段都在本地编码；令牌正确时两台活着的 worker 分掉全部片段
+            r["ok"] = r["output"] and (remote == 0 if name == "token" else remote == len(clips))
+            if name == "token":
+                r["ok"] = r["ok"] and all("401" in (w["error"] or "") for w in workers)
+            results[name] = r
+    finally:
+        shared_server.should_exit = upload_server.should_exit = True
+    return results
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--clips", type=int, default=2, help="clips in the synthetic day")
+    ap.add_argument("--seconds", type=float, default=5.0, help="length of each synthetic clip")
+    ap.add_argument("--size", default="320x240", help="synthetic camera resolution")
+    ap.add_argument("--work-dir", help="keep the tree, worker folders and outputs here instead of a temp dir")
+    ap.add_argument("--json", dest="json_path", help="write results as JSON")
+    ap.add_argument("-v", "--verbose", action="store_true", help="print merger and worker log lines")
+    args = ap.parse_args(argv)
+
+    ffmpeg_bin = shutil.which("ffmpeg") or "ffmpeg"
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="teslacam_workers_")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        source = os.path.join(work_dir, "TeslaCam")
+        write_teslacam_tree(source, 1, args.clips, args.seconds, args.size, ffmpeg=ffmpeg_bin)
+        results = run(source, work_dir, print if args.verbose else None)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for name, r in results.items():
+        extra = ", ".join(f"{k} {v}" for k, v in r.items() if k not in ("seconds", "ok", "workers"))
+        print(f"{name:>8}: {'ok  ' if r['ok'] else 'FAIL'} {r['seconds']:7.2f} s  {extra}")
+    if args.json_path:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json_path)), exist_ok=True)
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "render_workers", "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "config": vars(args), "results": results}, f, indent=2)
+    return 0 if all(r["ok"] for r in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""SEI extraction throughput: mmap scanner vs. the previous buffered-read implementation.
+
+    python -m benchmarks.sei_throughput                 # synthetic 1-minute clip
+    python -m benchmarks.sei_throughput clip-front.mp4  # real clips
+    python -m benchmarks.sei_throughput --json out.json
+"""
+import os
+import sys
+import json
+import time
+import filecmp
+import argparse
+import tempfile
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dashcam_parser import DashcamParser
+from benchmarks.fixtures import write_synthetic_mdat_clip
+
+
+class LegacyDashcamParser(DashcamParser):
+    """The parser as it was before the mmap scanner: small fp.read calls and a byte-by-byte strip loop."""
+
+    def _iter_nals(self, fp, offset, size):
+        return self._iter_nals_stream(fp, offset, size)
+
+    def _extract_proto_payload(self, nal):
+        if not isinstance(nal, bytes) or len(nal) < 2:
+            return None
+        for i in range(3, len(nal) - 1):
+            byte = nal[i]
+            if byte == 0x42:
+                continue
+            if byte == 0x69:
+                if i > 2:
+                    return self._strip_emulation_prevention_bytes(nal[i + 1:-1])
+                break
+            break
+        return None
+
+    def _strip_emulation_prevention_bytes(self, data):
+        stripped = bytearray()
+        zero_count = 0
+        for byte in data:
+            if zero_count >= 2 and byte == 0x03:
+                zero_count = 0
+                continue
+            stripped.append(byte)
+            zero_count = 0 if byte != 0 else zero_count + 1
+        return bytes(stripped)
+
+
+def time_extraction(parser, path, repeat):
+    """Best-of-`repeat` wall time for parsing path (file cache is warm after the first run)."""
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open(path, "rb") as fp:
+            offset, size = parser._find_mdat(fp)
+            count = sum(1 for _ in parser._iter_sei_messages(fp, offset, size))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, count
+
+
+def benchmark_file(path, repeat=3):
+    size_mb = os.path.getsize(path) / (1024 * 1024)
+    legacy_s, legacy_count = time_extraction(LegacyDashcamParser(), path, repeat)
+    mmap_s, mmap_count = time_extraction(DashcamParser(), path, repeat)
+
+    # 两种实现生成的 ASS 必须逐字节一致
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_ass = os.path.join(tmp, "legacy.ass")
+        mmap_ass = os.path.join(tmp, "mmap.ass")
+        LegacyDashcamParser().extract_sei_to_ass(path, legacy_ass, "2024-01-01_00-00-00")
+        DashcamParser().extract_sei_to_ass(path, mmap_ass, "2024-01-01_00-00-00")
+        identical = (os.path.exists(legacy_ass) and os.path.exists(mmap_ass)
+                     and filecmp.cmp(legacy_ass, mmap_ass, shallow=False))
+
+    return {
+        "file": path,
+        "size_mb": round(size_mb, 2),
+        "sei_messages": mmap_count,
+        "legacy_mb_per_s": round(size_mb / legacy_s, 1),
+        "mmap_mb_per_s": round(size_mb / mmap_s, 1),
+        "speedup": round(legacy_s / mmap_s, 2),
+        "ass_identical": identical and legacy_count == mmap_count,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("clips", nargs="*", help="front camera clips to parse (default: one synthetic minute)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--json", dest="json_path", help="write results as JSON")
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        clips = args.clips
+        if not clips:
+            synthetic = os.path.join(tmp, "2024-01-01_00-00-00-front.mp4")
+            write_synthetic_mdat_clip(synthetic)
+            clips = [synthetic]
+        results = [benchmark_file(path, args.repeat) for path in clips]
+
+    for r in results:
+        print(f"{os.path.basename(r['file'])}: {r['size_mb']} MB, {r['sei_messages']} SEI | "
+              f"legacy {r['legacy_mb_per_s']} MB/s, mmap {r['mmap_mb_per_s']} MB/s "
+              f"(x{r['speedup']}), identical ASS: {r['ass_identical']}")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "sei_throughput", "results": results}, f, indent=2)
+    return 0 if all(r["ass_identical"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,5 @@
+import io
+import mmap
 import struct
 import tempfile
 import codecs
@@ -8,6 +10,9 @@ from google.protobuf.message import DecodeError
 # This requires dashcam_pb2 to be generated in the same directory.
 import dashcam_pb2
 
+NAL_ID_SEI = 6
+NAL_SEI_ID_USER_DATA_UNREGISTERED = 5
+
 def format_speed(mps: float) -> str:
     kmh = mps * 3.6
     return f"{kmh:.0f} km/h"
@@ -45,27 +50,55 @@ def format_time_ass(seconds: float) -> str:
         cs = 99
     return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
 
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 1920
+PlayResY: 1080
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: DashData,Arial,48,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,-1,0,0,0,100,100,0,0,1,2,2,7,40,40,40,1
+Style: DashWheel,Arial,48,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,-1,0,0,0,100,100,0,0,1,2,2,5,0,0,0,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+# Vector: A perfectly centered Tesla-style steering wheel (R=50). Origin (0,0) is exactly the pivot center.
+WHEEL_VECTOR = r"m 0 -50 b 28 -50 50 -28 50 0 b 50 28 28 50 0 50 b -28 50 -50 28 -50 0 b -50 -28 -28 -50 0 -50 m 0 -42 b -23 -42 -42 -23 -42 0 b -42 23 -23 42 0 42 b 23 42 42 23 42 0 b 42 -23 23 -42 0 -42 m -42 -8 l 42 -8 l 42 8 l -42 8 m -18 8 l 18 8 l 12 42 l -12 42"
+
+# 方向盘角度按此粒度取整：小于 2° 的抖动看不出来，却会让每个采样都变成一个新事件
+STEERING_QUANTUM_DEG = 2.0
+
+def quantize_angle(angle: float, quantum: float = STEERING_QUANTUM_DEG) -> float:
+    if not quantum:
+        return angle
+    return round(angle / quantum) * quantum + 0.0  # + 0.0 turns -0.0 into 0.0
+
+def parse_base_timestamp(timestamp_str: Optional[str]) -> Optional[datetime.datetime]:
+    """Parses a TeslaCam clip timestamp (YYYY-MM-DD_HH-MM-SS), None if missing or malformed."""
+    if not timestamp_str:
+        return None
+    try:
+        return datetime.datetime.strptime(timestamp_str, "%Y-%m-%d_%H-%M-%S")
+    except ValueError:
+        return None
+
 class DashcamParser:
-    def __init__(self, fps=36.0):
+    def __init__(self, fps=36.0, steering_quantum=STEERING_QUANTUM_DEG):
         self.fps = fps # Typically 36 FPS for Tesla cameras
+        self.steering_quantum = steering_quantum
+        # samples = telemetry samples considered; the legacy writer emitted 2 events per sample
+        self.ass_stats = {"samples": 0, "text_events": 0, "wheel_events": 0}
 
     def extract_sei_to_ass(self, video_path: str, output_ass_path: str, base_timestamp_str: str = None):
         """Extract SEI from video_path and write an .ass file to output_ass_path.
         Returns True if successful and SEI was found, False otherwise."""
         
-        sei_messages = []
-        base_dt = None
-        if base_timestamp_str:
-            try:
-                base_dt = datetime.datetime.strptime(base_timestamp_str, "%Y-%m-%d_%H-%M-%S")
-            except ValueError:
-                pass
+        base_dt = parse_base_timestamp(base_timestamp_str)
 
         try:
-            with open(video_path, "rb") as fp:
-                offset, size = self._find_mdat(fp)
-                for meta in self._iter_sei_messages(fp, offset, size):
-                    sei_messages.append(meta)
+            sei_messages = self.extract_sei_messages(video_path)
         except Exception as e:
             return False
 
@@ -75,85 +108,148 @@ class DashcamParser:
         self._write_ass_file(sei_messages, output_ass_path, base_dt)
         return True
 
-    def _write_ass_file(self, messages: List[dashcam_pb2.SeiMetadata], out_path: str, base_dt: Optional[datetime.datetime] = None):
-        # We group nearby messages if needed, or just write them frame by frame.
-        # But writing 2160 lines for a 1 minute file is totally fine for ASS.
-        
-        # We will update the subtitle roughly every 3 frames (12fps) to reduce file size and jitter.
-        # 1 frame at 36fps = 0.0277s
-        
-        header = """[Script Info]
-ScriptType: v4.00+
-PlayResX: 1920
-PlayResY: 1080
+    def extract_sei_messages(self, video_path: str) -> List[dashcam_pb2.SeiMetadata]:
+        """Returns every SeiMetadata message of video_path in frame order."""
+        with open(video_path, "rb") as fp:
+            offset, size = self._find_mdat(fp)
+            return list(self._iter_sei_messages(fp, offset, size))
 
-[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: DashData,Arial,48,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,-1,0,0,0,100,100,0,0,1,2,2,7,40,40,40,1
-Style: DashWheel,Arial,48,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,-1,0,0,0,100,100,0,0,1,2,2,5,0,0,0,1
+    def write_ass(self, messages, output_ass_path: str, base_timestamp_str: str = None, wheel_spans=None) -> bool:
+        """Writes an .ass overlay from already extracted messages (SeiMetadata or rows with the same fields).
+        If wheel_spans is a list, the steering wheel is collected there as (start, end, angle) instead of drawn."""
+        if not messages:
+            return False
+        self._write_ass_file(messages, output_ass_path, parse_base_timestamp(base_timestamp_str), wheel_spans)
+        return True
 
-[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-"""
-        
-        lines = []
+    def write_concatenated_ass(self, segments, output_ass_path: str, loader=None, wheel_spans=None) -> int:
+        """Writes one .ass file for several consecutive clips.
+        segments yields (video_path, base_timestamp_str, time_offset); loader(video_path) returns the
+        messages of a clip (default: extract_sei_messages); wheel_spans as in write_ass.
+        Returns how many clips had SEI."""
+        loader = loader or self.extract_sei_messages
+        clips_with_sei = 0
+        with codecs.open(output_ass_path, "w", "utf-8") as f:
+            f.write(ASS_HEADER)
+            for video_path, base_timestamp_str, time_offset in segments:
+                try:
+                    messages = loader(video_path)
+                except Exception:
+                    continue
+                if messages:
+                    clips_with_sei += 1
+                    f.writelines(self._ass_events(messages, parse_base_timestamp(base_timestamp_str), time_offset, wheel_spans))
+        return clips_with_sei
+
+    def read_duration(self, video_path: str) -> Optional[float]:
+        """Reads the movie duration (seconds) from the moov/mvhd atom without spawning ffprobe."""
+        try:
+            with open(video_path, "rb") as fp:
+                moov = self._find_atom(fp, b"moov")
+                if not moov:
+                    return None
+                mvhd = self._find_atom(fp, b"mvhd", *moov)
+                if not mvhd:
+                    return None
+                fp.seek(mvhd[0])
+                version = fp.read(4)[0]
+                if version == 1:
+                    fp.seek(16, 1)
+                    timescale, duration = struct.unpack(">IQ", fp.read(12))
+                else:
+                    fp.seek(8, 1)
+                    timescale, duration = struct.unpack(">II", fp.read(8))
+                return duration / timescale if timescale else None
+        except (OSError, IndexError, struct.error, RuntimeError):
+            return None
+
+    def _write_ass_file(self, messages: List[dashcam_pb2.SeiMetadata], out_path: str, base_dt: Optional[datetime.datetime] = None, wheel_spans=None):
+        # ASS needs UTF-8 with BOM usually if it has CJK, but standard utf-8 works fine with ffmpeg.
+        with codecs.open(out_path, "w", "utf-8") as f:
+            f.write(ASS_HEADER)
+            f.writelines(self._ass_events(messages, base_dt, wheel_spans=wheel_spans))
+
+    def _ass_events(self, messages: List[dashcam_pb2.SeiMetadata], base_dt: Optional[datetime.datetime] = None, time_offset: float = 0.0,
+                    wheel_spans=None):
+        """Yields Dialogue lines for messages; time_offset shifts them when several clips share one ASS file.
+
+        Telemetry is sampled every int(fps/6) frames (~6 Hz), but an event is only emitted when what it
+        displays changes: consecutive samples with the same text (or the same quantized wheel angle) are
+        merged into one longer event.  A parked minute thus costs a handful of events instead of ~720,
+        each of which libass would otherwise rasterize again.  Counts are added to self.ass_stats.
+        With a wheel_spans list the wheel is appended there (offset applied) instead of yielded.
+        """
         frame_duration = 1.0 / self.fps
-        
-        # Downsample to ~5 times a second for readability? 
-        # Actually every 6 frames = ~166ms = 6 fps.
-        step = max(1, int(self.fps / 6)) 
-        
+        step = max(1, int(self.fps / 6))
+        stats = self.ass_stats
+        text_span = wheel_span = None  # [start, end, payload]
+
         for i in range(0, len(messages), step):
             meta = messages[i]
-            
             start_time = i * frame_duration
-            next_i = min(i + step, len(messages))
-            end_time = next_i * frame_duration
-            
-            speed = format_speed(meta.vehicle_speed_mps)
-            gear = format_gear(meta.gear_state)
-            ap = format_autopilot(meta.autopilot_state)
-            accel = f"{meta.accelerator_pedal_position:.0f}%"
-            brake = "已踩下" if meta.brake_applied else "未踩下"
-            l_icon, r_icon = format_blinker(meta.blinker_on_left, meta.blinker_on_right)
-            steer = f"{meta.steering_wheel_angle:.0f}°"
-            
-            text_lines = []
-            if base_dt:
-                current_dt = base_dt + datetime.timedelta(seconds=start_time)
-                text_lines.append(f"日　期:  {current_dt.strftime('%Y-%m-%d %H:%M:%S')}")
-
-            text_lines.extend([
-                f"车　速:  {speed}",
-                f"挡　位:  {gear}",
-                f"自动驾驶:  {ap}",
-                f"加速踏板:  {accel}",
-                f"刹　车:  {brake}",
-                f"转向灯:  {l_icon}   {r_icon}",
-                f"方向盘:  {steer}"
-            ])
-            text = r"\N".join(text_lines)
-            
-            start_str = format_time_ass(start_time)
-            end_str = format_time_ass(end_time)
-            
-            # Text block at Top-Left
-            ass_line = f"Dialogue: 0,{start_str},{end_str},DashData,,0,0,0,,{{\\pos(40,40)}}{text}\n"
-            lines.append(ass_line)
-            
-            # Steering Wheel Animation
-            # Vector: A perfectly centered Tesla-style steering wheel (R=50). Origin (0,0) is exactly the pivot center.
-            angle = -meta.steering_wheel_angle 
-            wheel_vector = r"m 0 -50 b 28 -50 50 -28 50 0 b 50 28 28 50 0 50 b -28 50 -50 28 -50 0 b -50 -28 -28 -50 0 -50 m 0 -42 b -23 -42 -42 -23 -42 0 b -42 23 -23 42 0 42 b 23 42 42 23 42 0 b 42 -23 23 -42 0 -42 m -42 -8 l 42 -8 l 42 8 l -42 8 m -18 8 l 18 8 l 12 42 l -12 42"
-            wheel_line = f"Dialogue: 0,{start_str},{end_str},DashWheel,,0,0,0,,{{\\an7\\pos(380,430)\\org(380,430)\\frz{-angle}}}{{\\p1}}{wheel_vector}{{\\p0}}\n"
-            lines.append(wheel_line)
-            
-        # ASS needs UTF-8 with BOM usually if it has CJK, but standard utf-8 works fine with ffmpeg.
-        with codecs.open(out_path, "w", "utf-8") as f:
-            f.write(header)
-            f.writelines(lines)
+            end_time = min(i + step, len(messages)) * frame_duration
+            stats["samples"] += 1
+
+            angle = quantize_angle(meta.steering_wheel_angle, self.steering_quantum)
+            text = self._overlay_text(meta, base_dt, start_time, angle)
+            if text_span and text_span[2] == text:
+                text_span[1] = end_time
+            else:
+                if text_span:
+                    yield self._text_event(text_span, time_offset)
+                text_span = [start_time, end_time, text]
+
+            if wheel_span and wheel_span[2] == angle:
+                wheel_span[1] = end_time
+            else:
+                if wheel_span:
+                    yield from self._emit_wheel(wheel_span, time_offset, wheel_spans)
+                wheel_span = [start_time, end_time, angle]
+
+        if text_span:
+            yield self._text_event(text_span, time_offset)
+        if wheel_span:
+            yield from self._emit_wheel(wheel_span, time_offset, wheel_spans)
 
-    # Everything below is verbatim logic from sei_extractor.py
+    def _overlay_text(self, meta, base_dt: Optional[datetime.datetime], start_time: float, steering_angle: float) -> str:
+        l_icon, r_icon = format_blinker(meta.blinker_on_left, meta.blinker_on_right)
+        text_lines = []
+        if base_dt:
+            current_dt = base_dt + datetime.timedelta(seconds=start_time)
+            text_lines.append(f"日　期:  {current_dt.strftime('%Y-%m-%d %H:%M:%S')}")
+
+        text_lines.extend([
+            f"车　速:  {format_speed(meta.vehicle_speed_mps)}",
+            f"挡　位:  {format_gear(meta.gear_state)}",
+            f"自动驾驶:  {format_autopilot(meta.autopilot_state)}",
+            f"加速踏板:  {meta.accelerator_pedal_position:.0f}%",
+            f"刹　车:  {'已踩下' if meta.brake_applied else '未踩下'}",
+            f"转向灯:  {l_icon}   {r_icon}",
+            f"方向盘:  {steering_angle:.0f}°"
+        ])
+        return r"\N".join(text_lines)
+
+    def _text_event(self, span, time_offset: float) -> str:
+        # Text block at Top-Left
+        start, end, text = span
+        self.ass_stats["text_events"] += 1
+        return f"Dialogue: 0,{format_time_ass(start + time_offset)},{format_time_ass(end + time_offset)},DashData,,0,0,0,,{{\\pos(40,40)}}{text}\n"
+
+    def _emit_wheel(self, span, time_offset: float, wheel_spans):
+        if wheel_spans is None:
+            yield self._wheel_event(span, time_offset)
+        else:
+            self.ass_stats["wheel_events"] += 1
+            wheel_spans.append((span[0] + time_offset, span[1] + time_offset, span[2]))
+
+    def _wheel_event(self, span, time_offset: float) -> str:
+        # Steering Wheel Animation, rotated around its own center
+        start, end, angle = span
+        self.ass_stats["wheel_events"] += 1
+        return (f"Dialogue: 0,{format_time_ass(start + time_offset)},{format_time_ass(end + time_offset)},DashWheel,,0,0,0,,"
+                f"{{\\an7\\pos(380,430)\\org(380,430)\\frz{angle:g}}}{{\\p1}}{WHEEL_VECTOR}{{\\p0}}\n")
+
+    # Everything below is adapted from sei_extractor.py
     def _iter_sei_messages(self, fp, offset: int, size: int):
         for nal in self._iter_nals(fp, offset, size):
             payload = self._extract_proto_payload(nal)
@@ -169,32 +265,47 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
     def _extract_proto_payload(self, nal: bytes) -> Optional[bytes]:
         if not isinstance(nal, bytes) or len(nal) < 2:
             return None
-        for i in range(3, len(nal) - 1):
-            byte = nal[i]
-            if byte == 0x42:
-                continue
-            if byte == 0x69:
-                if i > 2:
-                    return self._strip_emulation_prevention_bytes(nal[i + 1:-1])
-                break
-            break
-        return None
+        # 跳过 0x42 填充字节后必须紧跟 0x69，其后（去掉末尾的 rbsp 结束位）就是 protobuf
+        body = nal[3:len(nal) - 1]
+        rest = body.lstrip(b"\x42")
+        if not rest or rest[0] != 0x69:
+            return None
+        return self._strip_emulation_prevention_bytes(rest[1:])
 
     def _strip_emulation_prevention_bytes(self, data: bytes) -> bytes:
-        stripped = bytearray()
-        zero_count = 0
-        for byte in data:
-            if zero_count >= 2 and byte == 0x03:
-                zero_count = 0
-                continue
-            stripped.append(byte)
-            zero_count = 0 if byte != 0 else zero_count + 1
-        return bytes(stripped)
+        # 00 00 03 -> 00 00；bytes.replace 从左到右不重叠匹配，与逐字节计数零的写法结果一致
+        return data.replace(b"\x00\x00\x03", b"\x00\x00")
 
     def _iter_nals(self, fp, offset: int, size: int) -> Generator[bytes, None, None]:
-        NAL_ID_SEI = 6
-        NAL_SEI_ID_USER_DATA_UNREGISTERED = 5
+        """Yields SEI user-data NALs from the mdat payload.
+        Scans a read-only mmap of the file, so only the few SEI NALs are ever copied; falls back to
+        buffered reads for file objects that cannot be mapped."""
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            yield from self._iter_nals_stream(fp, offset, size)
+            return
+
+        with mm:
+            file_end = len(mm)
+            end = file_end if size == 0 else min(offset + size, file_end)
+            unpack_size = struct.Struct(">I").unpack_from
+            pos = offset
+            while pos + 4 <= end:
+                nal_size = unpack_size(mm, pos)[0]
+                body = pos + 4
+                pos = body + nal_size
+                if nal_size < 2:
+                    continue
+                if body + 2 > file_end:
+                    break
+                if (mm[body] & 0x1F) != NAL_ID_SEI or mm[body + 1] != NAL_SEI_ID_USER_DATA_UNREGISTERED:
+                    continue
+                if pos > file_end:
+                    break
+                yield mm[body:pos]
 
+    def _iter_nals_stream(self, fp, offset: int, size: int) -> Generator[bytes, None, None]:
         fp.seek(offset)
         consumed = 0
         while size == 0 or consumed < size:
@@ -223,6 +334,28 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
             consumed += 4 + nal_size
             yield payload
 
+    def _find_atom(self, fp, name: bytes, start: int = 0, end: Optional[int] = None) -> Optional[Tuple[int, int]]:
+        """Finds a child atom between start and end. Returns (payload_offset, payload_end) or None."""
+        if end is None:
+            fp.seek(0, 2)
+            end = fp.tell()
+        pos = start
+        while pos + 8 <= end:
+            fp.seek(pos)
+            size32, atom_type = struct.unpack(">I4s", fp.read(8))
+            header_size = 8
+            if size32 == 1:
+                atom_size = struct.unpack(">Q", fp.read(8))[0]
+                header_size = 16
+            else:
+                atom_size = size32 if size32 else end - pos
+            if atom_size < header_size:
+                return None
+            if atom_type == name:
+                return pos + header_size, min(pos + atom_size, end)
+            pos += atom_size
+        return None
+
     def _find_mdat(self, fp) -> Tuple[int, int]:
         fp.seek(0)
         while True:
@@ -0,0 +1,265 @@
+"""Content-addressed, size-bounded file caches stored under ~/.teslacam_merger.
+
+Entries are keyed by a hash of the source file identities plus whatever
+parameters influenced the output, so a changed input or setting simply
+misses instead of returning stale data.  When the byte budget is exceeded
+the least recently used, unpinned entries are evicted.
+
+Several processes (the backend, CLI runs, render workers) may share one
+cache directory.  The index only records sizes and recency, so a lookup
+adopts a file another process put there, and save() merges the index on
+disk before replacing it.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+DATA_DIR = os.path.expanduser("~/.teslacam_merger")
+
+# 只对文件头尾采样做哈希，避免每次都读完整个视频
+IDENTITY_SAMPLE_BYTES = 64 * 1024
+
+
+def file_identity(path):
+    """Cheap identity of a source file: size, mtime and a hash of its first/last 64 KB."""
+    st = os.stat(path)
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        h.update(f.read(IDENTITY_SAMPLE_BYTES))
+        if st.st_size > 2 * IDENTITY_SAMPLE_BYTES:
+            f.seek(-IDENTITY_SAMPLE_BYTES, os.SEEK_END)
+            h.update(f.read(IDENTITY_SAMPLE_BYTES))
+    return f"{st.st_size}:{st.st_mtime_ns}:{h.hexdigest()}"
+
+
+def cache_key(*parts):
+    """Stable hex key for any JSON-serialisable parts."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """LRU byte-budgeted directory of files, one file per key."""
+
+    def __init__(self, name, max_bytes, suffix="", root=None):
+        self.root = os.path.join(root or DATA_DIR, name)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.index_file = os.path.join(self.root, "index.json")
+        self.lock = threading.RLock()
+        self.pins = {}  # key -> refcount, pinned entries are never evicted
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.root, exist_ok=True)
+        self.entries = self._load_index()
+
+    def _load_index(self):
+        """Loads index.json and reconciles it with the files actually on disk."""
+        saved = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+            except Exception:
+                saved = {}
+
+        entries = {}
+        for filename in os.listdir(self.root):
+            if filename == "index.json" or filename.endswith(".tmp") or not filename.endswith(self.suffix):
+                continue
+            key = filename[:len(filename) - len(self.suffix)] if self.suffix else filename
+            path = os.path.join(self.root, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            last_used = saved.get(key, {}).get("last_used", st.st_mtime)
+            entries[key] = {"size": st.st_size, "last_used": last_used}
+        return entries
+
+    def save(self):
+        with self.lock:
+            self._merge_saved_index()
+            tmp = None
+            try:
+                # 每次写入用独立的临时文件名，多个进程同时保存也不会互相覆盖一半的内容
+                fd, tmp = tempfile.mkstemp(prefix="index.", suffix=".tmp", dir=self.root)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp, self.index_file)
+            except Exception as e:
+                print(f"Failed to save cache index {self.index_file}: {e}")
+                if tmp and os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def _merge_saved_index(self):
+        """Takes in entries another process added to index.json since we loaded it (and newer last_used times),
+        and forgets ones it evicted."""
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except Exception:
+            return
+        for key in [key for key in self.entries if key not in saved]:
+            if not os.path.exists(self.path_for(key)):
+                del self.entries[key]
+        for key, entry in saved.items():
+            current = self.entries.get(key)
+            if current is not None:
+                current["last_used"] = max(current["last_used"], entry.get("last_used", 0))
+            elif os.path.exists(self.path_for(key)):
+                # 文件已被别的进程淘汰就不再记回来
+                self.entries[key] = {"size": os.path.getsize(self.path_for(key)),
+                                     "last_used": entry.get("last_used", time.time())}
+
+    def path_for(self, key):
+        return os.path.join(self.root, key + self.suffix)
+
+    def key_for_path(self, path):
+        """Returns the key if path is a file inside this cache, else None."""
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.root):
+            return None
+        filename = os.path.basename(path)
+        return filename[:len(filename) - len(self.suffix)] if self.suffix else filename
+
+    def contains(self, key):
+        """Membership test that does not count as a hit or miss."""
+        with self.lock:
+            return self._adopt(key)
+
+    def _adopt(self, key):
+        """True if key's file exists; a file put there by another process is added to the index."""
+        path = self.path_for(key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if key not in self.entries:
+            self.entries[key] = {"size": st.st_size, "last_used": st.st_mtime}
+        return True
+
+    def get(self, key, pin=False):
+        """Returns the cached file path (and marks it recently used) or None."""
+        with self.lock:
+            path = self.path_for(key)
+            if self._adopt(key):
+                self.entries[key]["last_used"] = time.time()
+                self.hits += 1
+                if pin:
+                    self.pin(key)
+                return path
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key, src_path, pin=False, persist=True):
+        """Moves src_path into the cache and returns the new path.
+        persist=False skips rewriting index.json (callers adding many small entries save() themselves)."""
+        dest = self.path_for(key)
+        tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.replace(src_path, tmp)
+        except OSError:
+            # 输出目录和缓存不在同一个磁盘时只能复制
+            shutil.copyfile(src_path, tmp)
+            os.remove(src_path)
+        os.replace(tmp, dest)
+        with self.lock:
+            self.entries[key] = {"size": os.path.getsize(dest), "last_used": time.time()}
+            if pin:
+                self.pin(key)
+            self._evict()
+            if persist:
+                self.save()
+        return dest
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.pins.pop(key, None)
+            path = self.path_for(key)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def pin(self, key):
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, key):
+        with self.lock:
+            count = self.pins.get(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+            else:
+                self.pins.pop(key, None)
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(e["size"] for e in self.entries.values())
+
+    def pinned_bytes(self):
+        """Bytes held by pinned entries, which eviction cannot free."""
+        with self.lock:
+            return sum(self.entries[key]["size"] for key in self.pins if key in self.entries)
+
+    def _evict(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        for key, entry in sorted(self.entries.items(), key=lambda kv: kv[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key in self.pins:
+                continue
+            path = self.path_for(key)
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                continue
+            total -= entry["size"]
+            del self.entries[key]
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes(),
+                "max_bytes": self.max_bytes,
+            }
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_cache(name, max_bytes, suffix="", root=None):
+    """Process-wide cache instance (one per name and root), so concurrent mergers share pins and stats."""
+    shared_key = (name, os.path.abspath(root) if root else None)
+    with _shared_lock:
+        cache = _shared.get(shared_key)
+        if cache is None:
+            cache = _shared[shared_key] = DiskCache(name, max_bytes, suffix, root)
+        else:
+            cache.max_bytes = max_bytes
+        return cache
+
+
+def free_space_budget(root, cap, share, held=0):
+    """cap, or share of the free space on root's volume plus the held bytes already stored there, if smaller."""
+    try:
+        free = shutil.disk_usage(root).free
+    except OSError:
+        return cap
+    return min(cap, int(share * (free + held)))
@@ -0,0 +1,302 @@
+"""Encoder-aware concurrency control for TeslaCamMerger.
+
+Hardware encoders are limited by the number of concurrent sessions the
+driver allows, the libx264 fallback is limited by CPU cores.  `EncoderSlots`
+keeps one counter per backend, `AdaptiveConcurrency` decides how many clips
+are in flight at once based on measured throughput and host load.
+
+`probe_encoders` finds out once per machine which backends work at all, and
+`EncoderHealth` stops using a backend that keeps failing during a run.
+"""
+import os
+import json
+import time
+import shutil
+import platform
+import threading
+import subprocess
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from disk_cache import DATA_DIR
+
+try:
+    import psutil
+except ImportError:  # psutil 是可选的，缺失时只按吞吐量调节
+    psutil = None
+
+# 硬件编码器的并发会话上限（保守值，超过后驱动会直接报错或排队超时）
+HW_SESSION_LIMITS = {
+    "h264_videotoolbox": 2,
+    "h264_nvenc": 3,
+    "h264_qsv": 2,
+}
+
+# 编码器探测结果缓存：同一台机器、同一个 ffmpeg 在有效期内不重复探测
+PROBE_CACHE_PATH = os.path.join(DATA_DIR, "encoder_probe.json")
+PROBE_CACHE_TTL = 7 * 24 * 3600
+
+# 一路四分屏软件编码（4 路解码 + 缩放叠加 + x264）大约能吃满的线程数
+SW_THREADS_PER_ENCODE = 4
+
+
+def encoder_family(codec):
+    """Return the encoder name without extra options, e.g. 'libx264 -preset veryfast' -> 'libx264'."""
+    return codec.split()[0] if codec else ""
+
+
+def default_slot_count(codec, cpu_count=None):
+    """Number of concurrent encodes a backend supports on this machine."""
+    name = encoder_family(codec)
+    if name in HW_SESSION_LIMITS:
+        return HW_SESSION_LIMITS[name]
+    cpus = cpu_count or os.cpu_count() or 2
+    return max(1, cpus // SW_THREADS_PER_ENCODE)
+
+
+class EncoderSlots:
+    """Per-backend counting semaphore shared by all clips (and all mergers using the same instance)."""
+
+    def __init__(self, limits=None):
+        self._cond = threading.Condition()
+        self._limits = dict(limits or {})
+        self._in_use = defaultdict(int)
+
+    def limit(self, codec):
+        name = encoder_family(codec)
+        with self._cond:
+            if name not in self._limits:
+                self._limits[name] = default_slot_count(name)
+            return self._limits[name]
+
+    def set_limit(self, codec, count):
+        with self._cond:
+            self._limits[encoder_family(codec)] = max(1, int(count))
+            self._cond.notify_all()
+
+    def acquire(self, codec, should_stop=None):
+        """Block until a session for `codec` is free. Returns False if `should_stop()` became true."""
+        name = encoder_family(codec)
+        limit = self.limit(name)
+        with self._cond:
+            while self._in_use[name] >= self._limits.get(name, limit):
+                if should_stop and should_stop():
+                    return False
+                self._cond.wait(timeout=0.5)
+            self._in_use[name] += 1
+            return True
+
+    def release(self, codec):
+        name = encoder_family(codec)
+        with self._cond:
+            self._in_use[name] = max(0, self._in_use[name] - 1)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, codec, should_stop=None):
+        acquired = self.acquire(codec, should_stop)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release(codec)
+
+    def snapshot(self):
+        with self._cond:
+            return {name: {"in_use": self._in_use[name], "limit": limit} for name, limit in self._limits.items()}
+
+
+class AdaptiveConcurrency:
+    """Hill-climbing controller for the number of clips processed at once.
+
+    Every `interval` seconds the clips/minute of the last window is compared
+    with the previous one: if throughput went up and the host has headroom
+    the target grows by one, if it dropped after a step up (or the host is
+    overloaded) it shrinks again.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None, interval=30.0,
+                 cpu_high=90.0, cpu_low=75.0, mem_high=90.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum or initial)
+        self.target = min(max(initial, self.minimum), self.maximum)
+        self.interval = interval
+        self.cpu_high = cpu_high
+        self.cpu_low = cpu_low
+        self.mem_high = mem_high
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_done = 0
+        self._last_rate = None
+        self._last_direction = 0
+        self._recent = deque(maxlen=50)  # 最近完成时间，用于展示 clips/min
+
+        if psutil:
+            psutil.cpu_percent(interval=None)  # 首次调用只是建立基线
+
+    def record(self):
+        """Call once per finished clip."""
+        now = time.monotonic()
+        with self._lock:
+            self._window_done += 1
+            self._recent.append(now)
+
+    @property
+    def clips_per_minute(self):
+        with self._lock:
+            if len(self._recent) < 2:
+                return 0.0
+            span = self._recent[-1] - self._recent[0]
+            return (len(self._recent) - 1) * 60.0 / span if span > 0 else 0.0
+
+    def _host_load(self):
+        """Returns (cpu_percent, mem_percent) or (None, None) without psutil."""
+        if not psutil:
+            return None, None
+        try:
+            return psutil.cpu_percent(interval=None), psutil.virtual_memory().percent
+        except Exception:
+            return None, None
+
+    def update(self):
+        """Re-evaluate the target if the current window is over. Returns the (possibly new) target."""
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self._window_start
+            if elapsed < self.interval or self._window_done == 0:
+                return self.target
+
+            rate = self._window_done * 60.0 / elapsed
+            cpu, mem = self._host_load()
+            overloaded = (cpu is not None and cpu >= self.cpu_high) or (mem is not None and mem >= self.mem_high)
+            headroom = cpu is None or cpu < self.cpu_low
+
+            direction = 0
+            if overloaded:
+                direction = -1
+            elif self._last_rate is None:
+                direction = 1 if headroom else 0
+            elif rate > self._last_rate * 1.05:
+                # 吞吐量在涨：如果上一步不是降并发，且 CPU 还有余量，继续加
+                direction = 1 if self._last_direction >= 0 and headroom else 0
+            elif rate < self._last_rate * 0.95 and self._last_direction:
+                # 上一步反而变慢了，退回去
+                direction = -self._last_direction
+
+            self.target = min(max(self.target + direction, self.minimum), self.maximum)
+            self._last_direction = direction
+            self._last_rate = rate
+            self._window_start = now
+            self._window_done = 0
+            return self.target
+
+
+def ffmpeg_identity(ffmpeg_bin):
+    """Identifies the machine and ffmpeg build a probe result belongs to."""
+    resolved = shutil.which(ffmpeg_bin) or ffmpeg_bin
+    try:
+        st = os.stat(resolved)
+        build = f"{st.st_size}:{st.st_mtime_ns}"
+    except OSError:
+        build = "?"
+    return f"{platform.node()}|{platform.system()}|{platform.machine()}|{resolved}|{build}"
+
+
+def _probe_encoder(ffmpeg_bin, codec, timeout):
+    """One second of synthetic 640x480 video through `codec`. True if ffmpeg succeeds in time."""
+    cmd = [ffmpeg_bin, "-v", "error", "-f", "lavfi", "-i", "color=black:s=640x480:r=25:d=1",
+           "-c:v", *codec.split(), "-b:v", "3000k", "-pix_fmt", "yuv420p", "-f", "null", "-"]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=timeout).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def probe_encoders(ffmpeg_bin, codecs, cache_path=PROBE_CACHE_PATH, timeout=30, refresh=False):
+    """Which of `codecs` work on this machine, as {encoder name: bool}.
+
+    Results are cached in cache_path per host and ffmpeg build (for PROBE_CACHE_TTL);
+    codecs missing from the cache are probed and added.  Returns (results, probed_now).
+    """
+    identity = ffmpeg_identity(ffmpeg_bin)
+    cached = {}
+    if not refresh:
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("identity") == identity and time.time() - data.get("checked", 0) < PROBE_CACHE_TTL:
+                cached = data.get("results", {})
+        except (OSError, ValueError):
+            pass
+
+    results = {}
+    probed = []
+    for codec in codecs:
+        name = encoder_family(codec)
+        if name in results:
+            continue
+        if name in cached:
+            results[name] = bool(cached[name])
+        else:
+            results[name] = _probe_encoder(ffmpeg_bin, codec, timeout)
+            probed.append(name)
+
+    if probed:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp = cache_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"identity": identity, "checked": time.time(), "results": {**cached, **results}}, f, indent=2)
+            os.replace(tmp, cache_path)
+        except OSError:
+            pass
+    return results, probed
+
+
+class EncoderHealth:
+    """Circuit breaker per encoder backend.
+
+    After `threshold` consecutive failures (or one fatal failure such as a
+    timeout) a backend is skipped.  Once `cooldown` seconds have passed a
+    single caller is let through again to test it; success closes the
+    breaker, another failure keeps it open for a further cooldown.
+    """
+
+    def __init__(self, threshold=3, cooldown=600.0, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = defaultdict(int)
+        self._opened_at = {}
+
+    def available(self, codec):
+        name = encoder_family(codec)
+        with self._lock:
+            opened = self._opened_at.get(name)
+            if opened is None:
+                return True
+            if self.clock() - opened >= self.cooldown:
+                self._opened_at[name] = self.clock()  # 半开：只放行这一次试探
+                return True
+            return False
+
+    def record_success(self, codec):
+        name = encoder_family(codec)
+        with self._lock:
+            self._failures[name] = 0
+            self._opened_at.pop(name, None)
+
+    def record_failure(self, codec, fatal=False):
+        """Returns True if this failure opened (or re-opened) the breaker."""
+        name = encoder_family(codec)
+        with self._lock:
+            self._failures[name] += 1
+            if fatal or self._failures[name] >= self.threshold:
+                self._opened_at[name] = self.clock()
+                return True
+            return False
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {"failures": count, "open": name in self._opened_at} for name, count in self._failures.items()}
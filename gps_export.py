@@ -0,0 +1,293 @@
+"""Per-day GPS track export (GPX / GeoJSON) from the SEI telemetry.
+
+Every frame's SeiMetadata carries latitude/longitude/heading at 36 Hz, but
+until now it was only used for the overlay text.  `export_track` walks a
+day's front-camera clips in time order, one clip's columns at a time (read
+through the columnar telemetry cache, so memory stays at one clip no
+matter how long the drive), and:
+
+  * drops invalid fixes, frames where the car is not moving (GPS drift
+    while parked) and repeated fixes (GPS updates slower than 36 Hz);
+  * simplifies each clip's part of the line with Douglas-Peucker
+    (tolerance in metres) on a local planar projection, keeping the
+    endpoints so the pieces join up;
+  * splits the day into trips where footage has a gap of TRIP_GAP_S or more;
+  * sums distance (haversine over the kept points) and driving
+    time along the way.
+
+Output is produced as text chunks, so the backend can stream it and the
+CLI can write it to a file.
+
+numpy is optional and not part of requirements.txt (the packaged app does
+not ship it).  When it happens to be installed, the distance and
+simplification maths are vectorised.  Otherwise the same algorithm runs in
+plain Python, which is the path most installs take.
+"""
+import sys
+import math
+import json
+import argparse
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+from dashcam_parser import parse_base_timestamp
+from source_index import shared_index
+from telemetry_store import load_or_extract
+
+try:
+    import numpy as np
+except ImportError:  # numpy 是可选的，缺失时用纯 Python 跑同样的算法
+    np = None
+
+FRAME_RATE = 36.0
+EARTH_RADIUS_M = 6371008.8
+TOLERANCE_M = 5.0
+TRIP_GAP_S = 300.0  # 片段之间空档超过 5 分钟算新的一段行程
+MOVING_MPS = 0.5
+FORMATS = ("gpx", "geojson")
+
+
+def _valid(lat, lon):
+    return (lat or lon) and -90 <= lat <= 90 and -180 <= lon <= 180
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+def _project(points):
+    """Local equirectangular metres (x, y) for [(t, lat, lon, ...)]; good enough over one clip."""
+    lat0 = math.radians(points[0][1])
+    k = math.pi / 180 * EARTH_RADIUS_M
+    if np is not None:
+        arr = np.asarray([(p[1], p[2]) for p in points])
+        return np.column_stack((arr[:, 1] * k * math.cos(lat0), arr[:, 0] * k))
+    return [(p[2] * k * math.cos(lat0), p[1] * k) for p in points]
+
+
+def simplify(points, tolerance_m=TOLERANCE_M):
+    """Douglas-Peucker over [(t, lat, lon, ...)]; endpoints are always kept."""
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+    xy = _project(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        if np is not None:
+            a, b = xy[first], xy[last]
+            seg = b - a
+            length = math.hypot(seg[0], seg[1])
+            inner = xy[first + 1:last] - a
+            if length:
+                dist = np.abs(seg[0] * inner[:, 1] - seg[1] * inner[:, 0]) / length
+            else:
+                dist = np.hypot(inner[:, 0], inner[:, 1])
+            i = int(np.argmax(dist))
+            farthest = float(dist[i])
+        else:
+            (ax, ay), (bx, by) = xy[first], xy[last]
+            sx, sy = bx - ax, by - ay
+            length = math.hypot(sx, sy)
+            farthest, i = -1.0, 0
+            for j in range(first + 1, last):
+                px, py = xy[j][0] - ax, xy[j][1] - ay
+                d = abs(sx * py - sy * px) / length if length else math.hypot(px, py)
+                if d > farthest:
+                    farthest, i = d, j - first - 1
+        if farthest > tolerance_m:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def _path_length(lats, lons):
+    """Haversine length in metres of the polyline through lats/lons (degrees)."""
+    if len(lats) < 2:
+        return 0.0
+    if np is not None:
+        la, lo = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+        a = np.sin(np.diff(la) / 2) ** 2 + np.cos(la[:-1]) * np.cos(la[1:]) * np.sin(np.diff(lo) / 2) ** 2
+        return float(np.sum(2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(1.0, a)))))
+    return sum(haversine_m(lats[i - 1], lons[i - 1], lats[i], lons[i]) for i in range(1, len(lats)))
+
+
+def _clip_points(telemetry, start_epoch, last):
+    """(t, lat, lon, heading, speed) of one clip with invalid fixes, stationary frames and repeated fixes
+    removed, plus the distance covered since `last` (the previous clip's final point) and the moving frames."""
+    cols = telemetry.columns
+    lat, lon = cols["latitude_deg"], cols["longitude_deg"]
+    heading, speed = cols["heading_deg"], cols["vehicle_speed_mps"]
+    n = len(telemetry)
+    if np is not None and n:
+        lat_a, lon_a = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        speed_a = np.asarray(speed, dtype=float)
+        moving = speed_a > MOVING_MPS
+        keep = moving & ((lat_a != 0) | (lon_a != 0)) & (np.abs(lat_a) <= 90) & (np.abs(lon_a) <= 180)
+        idx = np.flatnonzero(keep)
+        if len(idx):
+            # GPS 更新频率比 36 Hz 低，连续重复的坐标只留第一个
+            changed = np.concatenate(([True], (np.diff(lat_a[idx]) != 0) | (np.diff(lon_a[idx]) != 0)))
+            idx = idx[changed]
+        points = [(start_epoch + j / FRAME_RATE, lat[j], lon[j], heading[j], speed[j]) for j in idx.tolist()]
+        moving_frames = int(np.count_nonzero(moving))
+    else:
+        points, moving_frames, prev = [], 0, None
+        for j in range(n):
+            if speed[j] <= MOVING_MPS:
+                continue
+            moving_frames += 1
+            # 停车时的 GPS 漂移不算进轨迹和里程
+            if not _valid(lat[j], lon[j]) or (lat[j], lon[j]) == prev:
+                continue
+            prev = (lat[j], lon[j])
+            points.append((start_epoch + j / FRAME_RATE, lat[j], lon[j], heading[j], speed[j]))
+    chain = ([last] if last else []) + points
+    distance = _path_length([p[1] for p in chain], [p[2] for p in chain])
+    return points, distance, moving_frames
+
+
+def iter_trips(clips, tolerance_m=TOLERANCE_M):
+    """Yields ("point", point) for each simplified point and ("trip_end", stats) after each trip.
+    clips: [(timestamp, front clip path)] in time order; one clip's telemetry is in memory at a time."""
+    trip = None
+    last_end = None
+    for timestamp, path in clips:
+        base = parse_base_timestamp(timestamp)
+        telemetry = load_or_extract(path) if base is not None else None
+        if telemetry is None:
+            continue
+        try:
+            start = base.timestamp()
+            duration = len(telemetry) / FRAME_RATE
+            if trip and last_end is not None and start - last_end >= TRIP_GAP_S:
+                yield "trip_end", trip
+                trip = None
+            if trip is None:
+                trip = {"start": start, "end": start, "distance_m": 0.0, "moving_s": 0.0, "points": 0, "raw_points": 0,
+                        "last": None}
+            points, distance, moving = _clip_points(telemetry, start, trip["last"])
+        finally:
+            telemetry.close()
+        trip["end"] = start + duration
+        trip["distance_m"] += distance
+        trip["moving_s"] += moving / FRAME_RATE
+        trip["raw_points"] += len(points)
+        last_end = start + duration
+        if points:
+            trip["last"] = points[-1]
+            for point in simplify(points, tolerance_m):
+                trip["points"] += 1
+                yield "point", point
+    if trip:
+        yield "trip_end", trip
+
+
+def _iso(epoch):
+    # 片段时间戳是车机本地时间，没有时区信息，原样当作 UTC 写出
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4] + "Z"
+
+
+def _stats(trip):
+    return {"start": _iso(trip["start"]), "end": _iso(trip["end"]), "distance_km": round(trip["distance_m"] / 1000, 3),
+            "moving_time_s": round(trip["moving_s"], 1), "duration_s": round(trip["end"] - trip["start"], 1),
+            "points": trip["points"], "points_before_simplify": trip["raw_points"]}
+
+
+def _totals(trips):
+    return {"trips": len(trips), "distance_km": round(sum(t["distance_km"] for t in trips), 3),
+            "moving_time_s": round(sum(t["moving_time_s"] for t in trips), 1),
+            "points": sum(t["points"] for t in trips)}
+
+
+def export_track(clips, fmt="gpx", tolerance_m=TOLERANCE_M, name="TeslaCam", summary=None):
+    """Yields the GPX or GeoJSON document for clips in chunks. summary (a dict), if given, receives the totals."""
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    trips = []
+    if fmt == "gpx":
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<gpx version="1.1" creator="TeslaCam Merger" xmlns="http://www.topografix.com/GPX/1/1">\n'
+               f'<trk><name>{escape(name)}</name>\n')
+        open_segment = False
+        for kind, item in iter_trips(clips, tolerance_m):
+            if kind == "point":
+                if not open_segment:
+                    yield "<trkseg>\n"
+                    open_segment = True
+                yield f'<trkpt lat="{item[1]:.7f}" lon="{item[2]:.7f}"><time>{_iso(item[0])}</time></trkpt>\n'
+            else:
+                trips.append(_stats(item))
+                if open_segment:
+                    yield "</trkseg>\n"
+                    open_segment = False
+        totals = _totals(trips)
+        # GPX 1.1 的 trk 元数据要写在轨迹点之前，统计结果只能最后才知道，所以放在注释里
+        yield f"</trk>\n<!-- {json.dumps({**totals, 'trips': trips})} -->\n</gpx>\n"
+    else:
+        yield '{"type": "FeatureCollection", "features": ['
+        first_feature = True
+        coords = 0
+        for kind, item in iter_trips(clips, tolerance_m):
+            if kind == "point":
+                if coords == 0:
+                    yield ("" if first_feature else ",") + '\n{"type": "Feature", "geometry": {"type": "LineString", "coordinates": ['
+                    first_feature = False
+                yield ("," if coords else "") + f"[{item[2]:.7f}, {item[1]:.7f}]"
+                coords += 1
+            else:
+                stats = _stats(item)
+                trips.append(stats)
+                if coords:
+                    yield f']}}, "properties": {json.dumps(stats)}}}'
+                coords = 0
+        totals = _totals(trips)
+        yield f'\n], "properties": {json.dumps({"name": name, **totals})}}}\n'
+    if summary is not None:
+        summary.update(_totals(trips))
+
+
+def day_clips(root, date):
+    """[(timestamp, front clip path)] of one date, in time order (from the source index)."""
+    index = shared_index()
+    index.refresh(root)
+    return [(ts, cameras["front"]["path"]) for ts, cameras in sorted(index.clips(root, date).items())
+            if "front" in cameras]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a day's GPS track from TeslaCam telemetry.")
+    parser.add_argument("source", help="TeslaCam folder")
+    parser.add_argument("date", help="YYYY-MM-DD")
+    parser.add_argument("--format", choices=FORMATS, default="gpx")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE_M, help="simplification tolerance in metres")
+    args = parser.parse_args()
+
+    clips = day_clips(args.source, args.date)
+    if not clips:
+        print(f"No front camera clips for {args.date}", file=sys.stderr)
+        return 1
+    summary = {}
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for chunk in export_track(clips, args.format, args.tolerance, name=f"TeslaCam {args.date}", summary=summary):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+    print(f"{summary['trips']} trips, {summary['distance_km']:.2f} km, {summary['moving_time_s'] / 60:.0f} min moving, "
+          f"{summary['points']} points", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
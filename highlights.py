@@ -0,0 +1,132 @@
+"""Highlight mode: render only the interesting seconds of a day.
+
+Most dashcam minutes are uneventful, yet a full merge encodes every one of
+them with all four cameras.  `find_triggers` scans a clip's SEI telemetry
+for the moments worth reviewing:
+
+    hard_brake        the IMU's longitudinal deceleration while braking, or
+                      the speed drop over one second, above hard_brake_mps2
+    brake_at_speed    brake pressed above brake_min_kmh
+    autopilot_change  autopilot / FSD engaged or disengaged
+    sharp_steering    steering wheel turned faster than steering_deg_per_s
+                      while above steering_min_kmh (ignores parking)
+
+`plan_windows` pads each trigger, merges windows that overlap or nearly
+touch (also across minute boundaries) and cuts them back into per-clip
+(start, end) spans.  TeslaCamMerger renders only those spans and
+concatenates them into TeslaCam_{date}_highlights.mp4.
+"""
+from datetime import timedelta
+
+from dashcam_parser import parse_base_timestamp
+
+FRAME_RATE = 36.0  # SEI 每帧一条
+
+# 触发条件，可以在 config.json 的 "highlight_triggers" 或任务请求里按项覆盖；设为 None/false 关闭该项
+HIGHLIGHT_TRIGGERS = {
+    "hard_brake_mps2": 4.0,
+    "brake_min_kmh": 80.0,
+    "autopilot_change": True,
+    "steering_deg_per_s": 120.0,
+    "steering_min_kmh": 30.0,
+}
+PRE_SECONDS = 6.0
+POST_SECONDS = 8.0
+MERGE_GAP_S = 3.0  # 间隔小于这个值的两个窗口合成一个，避免成片的碎段
+MIN_SPAN_S = 0.5
+DEBOUNCE_S = 2.0  # 同一种触发在这段时间内只记一次
+
+
+def resolve_triggers(overrides=None):
+    triggers = dict(HIGHLIGHT_TRIGGERS)
+    triggers.update({k: v for k, v in (overrides or {}).items() if k in HIGHLIGHT_TRIGGERS})
+    return triggers
+
+
+def find_triggers(telemetry, triggers=None):
+    """[(offset seconds, kind)] of the trigger moments in one clip's Telemetry, in time order."""
+    triggers = triggers or HIGHLIGHT_TRIGGERS
+    cols = telemetry.columns
+    n = len(telemetry)
+    speed = cols["vehicle_speed_mps"]
+    brake = cols["brake_applied"]
+    autopilot = cols["autopilot_state"]
+    steering = cols["steering_wheel_angle"]
+    accel_x = cols["linear_acceleration_mps2_x"]
+    step = int(FRAME_RATE)
+
+    hard_brake = triggers.get("hard_brake_mps2")
+    brake_min = triggers["brake_min_kmh"] / 3.6 if triggers.get("brake_min_kmh") else None
+    steering_rate = triggers.get("steering_deg_per_s")
+    steering_min = (triggers.get("steering_min_kmh") or 0) / 3.6
+
+    found = []
+    last = {}
+
+    def hit(i, kind):
+        t = i / FRAME_RATE
+        if t - last.get(kind, -DEBOUNCE_S - 1) > DEBOUNCE_S:
+            found.append((t, kind))
+        last[kind] = t
+
+    for i in range(1, n):
+        if hard_brake:
+            # IMU 的轴向约定因车型而异，只在踩着刹车时看它；速度下降作为兜底
+            imu = brake[i] and -accel_x[i] >= hard_brake
+            drop = i >= step and speed[i - step] - speed[i] >= hard_brake
+            if imu or drop:
+                hit(i, "hard_brake")
+        if brake_min is not None and brake[i] and not brake[i - 1] and speed[i] >= brake_min:
+            hit(i, "brake_at_speed")
+        if triggers.get("autopilot_change") and bool(autopilot[i]) != bool(autopilot[i - 1]):
+            hit(i, "autopilot_change")
+        if steering_rate and i >= step and speed[i] >= steering_min \
+                and abs(steering[i] - steering[i - step]) >= steering_rate:
+            hit(i, "sharp_steering")
+    return found
+
+
+def plan_windows(clips, pre=PRE_SECONDS, post=POST_SECONDS):
+    """Padded, merged highlight windows cut back into per-clip spans.
+
+    clips: [(timestamp, duration seconds, [(offset, kind)])] of one day.
+    Returns [{"start", "end", "kinds", "spans": [(timestamp, start offset, end offset)]}] in time order."""
+    timeline = []  # (clip start, clip end, timestamp)
+    intervals = []
+    for timestamp, duration, triggers in clips:
+        base = parse_base_timestamp(timestamp)
+        if base is None:
+            continue
+        start = base.timestamp()
+        timeline.append((start, start + duration, timestamp))
+        for offset, kind in triggers:
+            intervals.append([start + offset - pre, start + offset + post, {kind}])
+    intervals.sort(key=lambda w: w[0])
+
+    merged = []
+    for window in intervals:
+        if merged and window[0] - merged[-1][1] <= MERGE_GAP_S:
+            merged[-1][1] = max(merged[-1][1], window[1])
+            merged[-1][2] |= window[2]
+        else:
+            merged.append(window)
+
+    timeline.sort()
+    windows = []
+    for start, end, kinds in merged:
+        spans = []
+        for clip_start, clip_end, timestamp in timeline:
+            lo, hi = max(start, clip_start), min(end, clip_end)
+            if hi - lo >= MIN_SPAN_S:
+                spans.append((timestamp, round(lo - clip_start, 3), round(hi - clip_start, 3)))
+        if spans:
+            windows.append({"start": start, "end": end, "kinds": sorted(kinds), "spans": spans})
+    return windows
+
+
+def describe_window(window):
+    """'08:12:03 hard_brake, autopilot_change (14s)' for logs."""
+    first = window["spans"][0]
+    clock = parse_base_timestamp(first[0]) + timedelta(seconds=first[1])
+    length = sum(end - start for _, start, end in window["spans"])
+    return f"{clock:%H:%M:%S} {', '.join(window['kinds'])} ({length:.0f}s)"
@@ -0,0 +1,143 @@
+"""Idle / parked footage detection for the condensed merge mode.
+
+Sentry and parked recordings (speed 0, gear P) are often most of a day, and
+a normal merge encodes every minute of them with all four cameras.
+`idle_intervals` finds the stretches of a clip where the car is not moving
+from its SEI telemetry; clips without SEI fall back to `frame_idle_intervals`,
+a cheap motion check on the front camera's keyframes scaled down to a few
+hundred grey pixels.  Gear is not used on its own: P always comes with speed
+0, and 0 is also the value of an unset gear field.
+
+`plan_day` joins idle stretches across minute boundaries, ignores stops
+shorter than MIN_IDLE_S (traffic lights, queues), keeps KEEP_EDGE_S of
+context where driving starts and ends, and cuts the day back into per-clip
+"drive" / "idle" segments.  TeslaCamMerger renders the drive segments as
+usual and either drops the idle ones or renders them as a TIMELAPSE_SPEED
+time-lapse, then writes the decisions next to TeslaCam_{date}_condensed.mp4.
+"""
+import subprocess
+
+from dashcam_parser import parse_base_timestamp
+from mp4_check import inspect_mp4
+
+FRAME_RATE = 36.0  # SEI 每帧一条
+IDLE_MODES = ("drop", "timelapse")
+IDLE_SPEED_MPS = 0.3
+MIN_IDLE_S = 30.0  # 比这短的停车（红灯、排队）照常保留
+KEEP_EDGE_S = 2.0
+JOIN_GAP_S = 1.0  # 相邻片段之间的接缝
+MIN_SPAN_S = 0.5
+TIMELAPSE_SPEED = 30
+# 画面差异检测：每秒一帧缩成 32x24 灰度图，平均亮度差低于阈值算静止
+MOTION_SIZE = (32, 24)
+MOTION_THRESHOLD = 3.0
+
+
+def idle_intervals(telemetry):
+    """[(start, end)] offsets (seconds) of one clip's Telemetry where the car is not moving."""
+    speed = telemetry.columns["vehicle_speed_mps"]
+    intervals = []
+    start = None
+    for i in range(len(telemetry)):
+        if speed[i] <= IDLE_SPEED_MPS:
+            if start is None:
+                start = i
+        elif start is not None:
+            intervals.append((start / FRAME_RATE, i / FRAME_RATE))
+            start = None
+    if start is not None:
+        intervals.append((start / FRAME_RATE, len(telemetry) / FRAME_RATE))
+    return intervals
+
+
+def frame_idle_intervals(ffmpeg_bin, path):
+    """(duration, [(start, end)]) from frame differences of a clip without telemetry; None if it cannot be decoded.
+    Only keyframes are decoded, resampled to one frame per second."""
+    width, height = MOTION_SIZE
+    cmd = [ffmpeg_bin, "-v", "error", "-skip_frame", "nokey", "-i", path,
+           "-vf", f"fps=1,scale={width}:{height},format=gray", "-f", "rawvideo", "-"]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    size = width * height
+    frames = [result.stdout[i:i + size] for i in range(0, len(result.stdout) - size + 1, size)]
+    if result.returncode != 0 or not frames:
+        return None
+    intervals = []
+    start = None
+    for second in range(1, len(frames)):
+        previous, current = frames[second - 1], frames[second]
+        if sum(abs(a - b) for a, b in zip(previous, current)) / size < MOTION_THRESHOLD:
+            if start is None:
+                start = second - 1
+        elif start is not None:
+            intervals.append((float(start), float(second - 1)))
+            start = None
+    # 每秒取样会少算最后不到一秒，时长以 moov 里的为准
+    duration = max(inspect_mp4(path)["duration"] or 0.0, float(len(frames)))
+    if start is not None:
+        intervals.append((float(start), duration))
+    return duration, intervals
+
+
+def plan_day(clips, min_idle=MIN_IDLE_S, edge=KEEP_EDGE_S):
+    """Splits a day's footage into drive and idle segments.
+
+    clips: [(timestamp, duration seconds, [(idle start, idle end)], source)] of one day.
+    Returns [{"timestamp", "start", "end", "idle", "source"}] in time order, covering every clip."""
+    timeline = []  # (clip start, duration, timestamp, source)
+    idle = []
+    for timestamp, duration, intervals, source in clips:
+        base = parse_base_timestamp(timestamp)
+        if base is None:
+            continue
+        start = base.timestamp()
+        timeline.append((start, duration, timestamp, source))
+        idle.extend([start + lo, start + hi] for lo, hi in intervals)
+    idle.sort()
+
+    merged = []
+    for interval in idle:
+        if merged and interval[0] - merged[-1][1] <= JOIN_GAP_S:
+            merged[-1][1] = max(merged[-1][1], interval[1])
+        else:
+            merged.append(interval)
+    # 停得够久的才算空闲，两头各留一点起步/停车的过程
+    merged = [(lo + edge, hi - edge) for lo, hi in merged if hi - lo >= min_idle and hi - lo - 2 * edge >= MIN_SPAN_S]
+
+    segments = []
+    for clip_start, duration, timestamp, source in sorted(timeline):
+        cuts = []
+        position = 0.0
+        for lo, hi in merged:
+            lo, hi = max(lo - clip_start, 0.0), min(hi - clip_start, duration)
+            if hi <= lo:
+                continue
+            if lo > position:
+                cuts.append([position, lo, False])
+            cuts.append([lo, hi, True])
+            position = hi
+        if position < duration:
+            cuts.append([position, duration, False])
+        # 太短的碎段并到前一段（或后一段）里，再把同类的相邻段合起来
+        for i, cut in enumerate(cuts):
+            if cut[1] - cut[0] < MIN_SPAN_S and len(cuts) > 1:
+                cut[2] = cuts[i - 1][2] if i else cuts[i + 1][2]
+        clip_segments = []
+        for lo, hi, is_idle in cuts:
+            if clip_segments and clip_segments[-1]["idle"] == is_idle:
+                clip_segments[-1]["end"] = round(hi, 3)
+            else:
+                clip_segments.append({"timestamp": timestamp, "start": round(lo, 3), "end": round(hi, 3),
+                                      "idle": is_idle, "source": source})
+        segments.extend(clip_segments)
+    return segments
+
+
+def summarize(segments):
+    """{"drive_s", "idle_s", "idle_spans"} of plan_day segments (adjacent idle segments count as one span)."""
+    drive = sum(s["end"] - s["start"] for s in segments if not s["idle"])
+    idle = sum(s["end"] - s["start"] for s in segments if s["idle"])
+    spans = sum(1 for i, s in enumerate(segments) if s["idle"] and (i == 0 or not segments[i - 1]["idle"]))
+    return {"drive_s": round(drive, 1), "idle_s": round(idle, 1), "idle_spans": spans}
@@ -0,0 +1,170 @@
+"""Append-only journal that lets an interrupted merge_all resume where it stopped.
+
+Before this, a restart only had the `temp_*.mp4` existence check: SEI was
+extracted again for every clip, every leftover fragment was re-validated
+and every day was concatenated from scratch.  The journal lives in the
+output folder (one per output folder, and the job queue never runs two jobs
+on the same folder).  It gets one JSON line per state change:
+
+    clip  extracted     overlay (.ass) written for the clip
+    clip  encoded       fragment rendered (temp file or cache entry)
+    clip  validated     fragment passed the structural check
+    day   concatenated  TeslaCam_{date}.mp4 written from the listed clips
+    day   verified      the day file passed the structural check
+
+Clips are identified by a signature of their source files' stat and the
+render parameters, and every file a record points to carries its size and
+mtime.  A record is only trusted while the file it describes is unchanged,
+so a stale journal costs a redo, never a wrong output.  Every line is
+fsynced.  A torn last line (power loss mid-write) is skipped on load, and
+the file is compacted to the latest record per clip/day once superseded
+lines dominate.
+"""
+import os
+import json
+import threading
+
+from disk_cache import cache_key
+
+JOURNAL_FILE = ".teslacam_journal.jsonl"
+COMPACT_MIN_LINES = 500
+
+EXTRACTED = "extracted"
+ENCODED = "encoded"
+VALIDATED = "validated"
+CONCATENATED = "concatenated"
+VERIFIED = "verified"
+
+
+def stamp(path):
+    """(size, mtime_ns) of path, None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def clip_signature(cameras, render_params):
+    """Identifies a clip's inputs by stat only (no file reads), so checking the journal stays cheap."""
+    sources = {camera: [path, stamp(path)] for camera, path in sorted(cameras.items())}
+    return cache_key(sources, render_params)
+
+
+def day_signature(clip_signatures):
+    return cache_key(sorted(clip_signatures))
+
+
+class JobJournal:
+    def __init__(self, output_dir, name=JOURNAL_FILE):
+        self.path = os.path.join(output_dir, name)
+        self._lock = threading.Lock()
+        self._clips = {}  # clip signature -> merged record
+        self._days = {}  # date -> merged record
+        self._paths = {}  # fragment path -> stamp it had when validated
+        self._lines = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                continue  # 断电时写了一半的最后一行
+        self._lines = len(lines)
+        if self._lines >= COMPACT_MIN_LINES and self._lines > 2 * (len(self._clips) + len(self._days)):
+            self._compact()
+
+    def _apply(self, record):
+        if record["kind"] == "clip":
+            merged = self._clips.setdefault(record["id"], {})
+            if record["state"] == ENCODED:
+                # 重新编码的片段：之前的校验结果作废
+                merged.pop("validated", None)
+            merged.update(record)
+            merged[record["state"]] = True
+            if record["state"] == VALIDATED:
+                self._paths[record["fragment"]] = record["fragment_stamp"]
+        else:
+            merged = self._days.setdefault(record["id"], {})
+            if record["state"] == CONCATENATED:
+                merged.pop(VERIFIED, None)
+            merged.update(record)
+            merged[record["state"]] = True
+
+    def _append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._apply(record)
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._lines += 1
+            except OSError as e:
+                print(f"Failed to write job journal: {e}")
+
+    def _compact(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                for kind, records in (("clip", self._clips), ("day", self._days)):
+                    for record in records.values():
+                        f.write(json.dumps({**record, "kind": kind}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._lines = len(self._clips) + len(self._days)
+        except OSError as e:
+            print(f"Failed to compact job journal: {e}")
+
+    # --- clips ---
+
+    def record_clip(self, signature, timestamp, state, **files):
+        """Appends a clip state; files (fragment=, ass=) are stored with their current stamp."""
+        record = {"kind": "clip", "id": signature, "timestamp": timestamp, "state": state}
+        for name, path in files.items():
+            record[name] = path
+            record[f"{name}_stamp"] = stamp(path)
+        self._append(record)
+
+    def _unchanged(self, record, name):
+        path = record.get(name)
+        return path if path and record.get(f"{name}_stamp") == stamp(path) else None
+
+    def fragment(self, signature):
+        """The fragment an earlier run rendered for this clip, if it is still on disk unchanged."""
+        record = self._clips.get(signature)
+        return self._unchanged(record, "fragment") if record and record.get(ENCODED) else None
+
+    def overlay(self, signature):
+        """The .ass overlay an earlier run extracted for this clip, if still on disk unchanged."""
+        record = self._clips.get(signature)
+        return self._unchanged(record, "ass") if record and record.get(EXTRACTED) else None
+
+    def validated(self, path):
+        """True if path passed validation in an earlier run and has not changed since."""
+        recorded = self._paths.get(path)
+        return recorded is not None and recorded == stamp(path)
+
+    def record_validated(self, signature, timestamp, path):
+        self.record_clip(signature, timestamp, VALIDATED, fragment=path)
+
+    # --- days ---
+
+    def record_day(self, date_str, state, signature, output):
+        self._append({"kind": "day", "id": date_str, "state": state, "signature": signature,
+                      "output": output, "output_stamp": stamp(output)})
+
+    def day_output(self, date_str, signature, state=VERIFIED):
+        """The day's output file if it reached `state` for exactly these clips and is unchanged."""
+        record = self._days.get(date_str)
+        if not record or not record.get(state) or record.get("signature") != signature:
+            return None
+        return self._unchanged(record, "output")
@@ -0,0 +1,305 @@
+"""Persistent queue of merge jobs for the web backend.
+
+`JobManager` accepts any number of start requests, stores them in
+~/.teslacam_merger/jobs.json and runs up to `max_concurrent()` of them at a
+time, highest priority first (ties in submission order).  All jobs share one
+`EncoderSlots` and one `EncoderHealth`, so two jobs running side by side
+split the hardware encoder sessions instead of each assuming it owns them.
+Jobs writing into the same output folder never run at the same time (they
+would share temp_*/concat_* file names).
+
+Jobs that were running when the process died go back to the queue on the
+next start; the fragment cache makes re-running their finished minutes cheap.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from dataclasses import replace
+
+from disk_cache import DATA_DIR
+from encoder_pool import EncoderSlots, EncoderHealth
+from merge_tesla_cam import TeslaCamMerger
+from progress_events import EventBus
+from render_worker import RenderWorkerPool
+
+JOBS_PATH = os.path.join(DATA_DIR, "jobs.json")
+KEEP_FINISHED = 100  # 和历史记录一样只保留最近 100 个已结束的任务
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobManager:
+    def __init__(self, events=None, path=JOBS_PATH, max_concurrent=None, on_finished=None, worker_token=None,
+                 fragment_cache_dir=None):
+        """events: global EventBus every job's events are copied to (tagged with the job id).
+        max_concurrent: callable returning how many jobs may run at once (read on every scheduling pass).
+        on_finished(job): called after a job ends, whatever the outcome.
+        worker_token: callable returning the render workers' shared secret (kept out of the persisted requests).
+        fragment_cache_dir: callable returning where the fragment cache lives (None: ~/.teslacam_merger)."""
+        self.events = events
+        self.path = path
+        self.max_concurrent = max_concurrent or (lambda: 1)
+        self.on_finished = on_finished
+        self.worker_token = worker_token or (lambda: None)
+        self.fragment_cache_dir = fragment_cache_dir or (lambda: None)
+        self.encoder_slots = EncoderSlots()
+        self.encoder_health = EncoderHealth()
+        self._cond = threading.Condition()
+        self._jobs = {}
+        self._running = {}  # job id -> {"merger", "events", "thread"}
+        self._thread = None
+        self._closed = False
+        self._load()
+
+    # --- persistence ---
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                jobs = json.load(f)
+        except (OSError, ValueError):
+            jobs = []
+        for job in jobs:
+            if job.get("status") == RUNNING:
+                # 上次进程崩溃或被杀时还在跑的任务重新排队
+                job["status"] = QUEUED
+                job["resumed"] = job.get("resumed", 0) + 1
+            self._jobs[job["id"]] = job
+
+    def _save(self):
+        finished = sorted((j for j in self._jobs.values() if j["status"] in FINISHED_STATES),
+                          key=lambda j: j.get("finished") or 0, reverse=True)
+        for job in finished[KEEP_FINISHED:]:
+            del self._jobs[job["id"]]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(sorted(self._jobs.values(), key=lambda j: j["created"]), f, indent=2, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Failed to save jobs: {e}")
+
+    # --- public API ---
+
+    def start(self):
+        """Starts the scheduler thread (idempotent)."""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._schedule, name="job-scheduler", daemon=True)
+                self._thread.start()
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            for handle in self._running.values():
+                if handle["merger"]:
+                    handle["merger"].stop()
+            self._cond.notify_all()
+
+    def submit(self, request, priority=0):
+        """Queues a job for a StartRequest-shaped dict. Returns the job."""
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "request": dict(request),
+            "priority": int(priority),
+            "status": QUEUED,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "progress": 0,
+            "output": None,
+            "error": None,
+        }
+        with self._cond:
+            self._jobs[job["id"]] = job
+            self._save()
+            self._cond.notify_all()
+        return dict(job)
+
+    def list(self):
+        """Running jobs first, then the queue in start order, then finished jobs (newest first)."""
+        with self._cond:
+            jobs = [dict(j) for j in self._jobs.values()]
+            live = {job_id: h["events"].progress for job_id, h in self._running.items()}
+        for job in jobs:
+            latest = live.get(job["id"])
+            if latest and latest.percent is not None:
+                job["progress"] = latest.percent
+        running = sorted((j for j in jobs if j["status"] == RUNNING), key=lambda j: j["started"])
+        queued = sorted((j for j in jobs if j["status"] == QUEUED), key=lambda j: (-j["priority"], j["created"]))
+        finished = sorted((j for j in jobs if j["status"] in FINISHED_STATES), key=lambda j: -(j["finished"] or 0))
+        return running + queued + finished
+
+    def get(self, job_id, log_limit=50):
+        """The job plus its most recent log lines, None if unknown."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if not job:
+                return None
+            job = dict(job)
+            handle = self._running.get(job_id)
+        if handle:
+            latest = handle["events"].progress
+            job["event"] = latest.to_dict() if latest else None
+            job["logs"] = [e.message for e in handle["events"].recent(log_limit, kinds=("log",))]
+        return job
+
+    def cancel(self, job_id):
+        """Cancels a queued job or stops a running one. Returns False if it had already finished."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if not job or job["status"] in FINISHED_STATES:
+                return False
+            if job["status"] == QUEUED:
+                job.update(status=CANCELLED, finished=time.time())
+                self._save()
+            else:
+                job["cancel_requested"] = True
+                merger = self._running[job_id]["merger"]
+                if merger:
+                    merger.stop()
+            self._cond.notify_all()
+            return True
+
+    def cancel_running(self):
+        """Stops every running job (the old single-job /api/stop). Returns how many were stopped."""
+        with self._cond:
+            running = [job_id for job_id in self._running]
+        return sum(1 for job_id in running if self.cancel(job_id))
+
+    def set_priority(self, job_id, priority):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if not job or job["status"] in FINISHED_STATES:
+                return False
+            job["priority"] = int(priority)
+            self._save()
+            self._cond.notify_all()
+            return True
+
+    @property
+    def is_running(self):
+        with self._cond:
+            return bool(self._running)
+
+    # --- scheduling ---
+
+    def _concurrency(self):
+        """max_concurrent() as a positive int; anything else (e.g. "two" typed into the config) counts as 1."""
+        value = self.max_concurrent()
+        try:
+            return max(1, int(value or 1))
+        except (TypeError, ValueError):
+            print(f"Invalid max_concurrent_jobs {value!r}, running one job at a time")
+            return 1
+
+    def _next_jobs(self):
+        """Queued jobs that may start now, best first."""
+        free = self._concurrency() - len(self._running)
+        if free <= 0:
+            return []
+        busy_outputs = {os.path.abspath(self._jobs[job_id]["request"]["output_path"]) for job_id in self._running}
+        picked = []
+        queued = sorted((j for j in self._jobs.values() if j["status"] == QUEUED),
+                        key=lambda j: (-j["priority"], j["created"]))
+        for job in queued:
+            output = os.path.abspath(job["request"]["output_path"])
+            if output in busy_outputs:
+                continue
+            busy_outputs.add(output)
+            picked.append(job)
+            if len(picked) >= free:
+                break
+        return picked
+
+    def _schedule(self):
+        with self._cond:
+            while not self._closed:
+                try:
+                    self._start_next()
+                except Exception as e:
+                    # 一次调度出错（坏配置、坏任务记录）不能让调度线程退出，下一轮再试
+                    print(f"Job scheduling failed: {e}")
+                self._cond.wait(timeout=5.0)
+
+    def _start_next(self):
+        for job in self._next_jobs():
+            job.update(status=RUNNING, started=time.time(), error=None)
+            handle = {"merger": None, "events": EventBus(capacity=500, echo=self._forwarder(job["id"]))}
+            handle["thread"] = threading.Thread(target=self._run, args=(job, handle), name=f"job-{job['id']}",
+                                                daemon=True)
+            self._running[job["id"]] = handle
+            self._save()
+            handle["thread"].start()
+
+    def _forwarder(self, job_id):
+        def forward(event):
+            if self.events:
+                # 复制一份：全局总线会重新编号 seq
+                self.events.publish(replace(event, job=job_id))
+        return forward
+
+    def _run(self, job, handle):
+        request = job["request"]
+        events = handle["events"]
+        output = None
+        error = None
+        try:
+            # 发送初始进度，确保 SSE 建立后立刻有反馈
+            events.emit("PROGRESS:1%:正在初始化合并引擎...")
+            workers = request.get("render_workers")
+            merger = TeslaCamMerger(request["source_path"], request["output_path"], events,
+                                    encoder_slots=self.encoder_slots, encoder_health=self.encoder_health,
+                                    wheel_sprites=bool(request.get("wheel_sprites")),
+                                    render_pool=RenderWorkerPool(workers, token=self.worker_token()) if workers else None,
+                                    highlight_triggers=request.get("highlight_triggers"),
+                                    fragment_cache_dir=self.fragment_cache_dir())
+            if request.get("target_timestamps"):
+                merger.target_timestamps = request["target_timestamps"]
+            with self._cond:
+                handle["merger"] = merger
+                cancelled = job.get("cancel_requested")
+            if not cancelled:
+                output = merger.merge_all(sample_count=request.get("sample_limit"), target_date=request.get("target_date"),
+                                          single_pass=bool(request.get("single_pass")),
+                                          highlights=bool(request.get("highlights")),
+                                          idle_mode=request.get("idle_mode"))
+        except Exception as e:
+            error = str(e)
+            events.emit(f"Error: {error}")
+
+        with self._cond:
+            if self._closed and not job.get("cancel_requested"):
+                # 进程退出时被打断的任务下次启动继续
+                state = QUEUED
+            elif job.get("cancel_requested"):
+                state = CANCELLED
+            elif error:
+                state = FAILED
+            else:
+                state = DONE
+            latest = events.progress
+            if state == DONE:
+                progress = 100
+            elif latest and latest.kind == "progress" and latest.percent is not None:
+                progress = latest.percent
+            else:
+                progress = job["progress"]
+            job.update(status=state, finished=time.time() if state != QUEUED else None, output=output, error=error,
+                       progress=progress)
+            job.pop("cancel_requested", None)
+            del self._running[job["id"]]
+            self._save()
+            self._cond.notify_all()
+        if state == DONE:
+            events.emit(f"COMPLETED:Successfully processed clips. Saved to {request['output_path']}")
+        if self.on_finished:
+            self.on_finished(dict(job))
@@ -1,16 +1,64 @@
 import os
+import json
 import threading
 import subprocess
 import glob
 import time
+import sqlite3
 from datetime import datetime
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from dashcam_parser import DashcamParser
+from encoder_pool import EncoderSlots, AdaptiveConcurrency, EncoderHealth, probe_encoders, encoder_family
+from disk_cache import shared_cache, file_identity, cache_key, free_space_budget
+from overlay_stage import OverlayStage, extract_overlay, remove_overlay
+from wheel_sprites import ensure_atlas, wheel_filter, write_commands, commands_path
+from telemetry_store import load_messages, load_or_extract
+from source_index import shared_index, parse_clip_name
+from mp4_check import check_fragment, validate_fragments
+from x264_calibration import calibrated_codec
+from highlights import resolve_triggers, find_triggers, plan_windows, describe_window, PRE_SECONDS, POST_SECONDS, FRAME_RATE
+from idle_detection import idle_intervals, frame_idle_intervals, plan_day, summarize, IDLE_MODES, TIMELAPSE_SPEED, MIN_SPAN_S
+from job_journal import JobJournal, clip_signature, day_signature, EXTRACTED, ENCODED, CONCATENATED, VERIFIED
+from progress_events import EventBus
+
+SW_CODEC = "libx264 -preset veryfast"
+
+# Define layout map: (key, x, y, width, height)
+GRID_LAYOUT = [
+    ("front", 480, 0, 960, 720),
+    ("left_repeater", 0, 600, 640, 480),
+    ("back", 640, 600, 640, 480),
+    ("right_repeater", 1280, 600, 640, 480)
+]
+
+# 改动分片的画面（布局、码率、字幕样式等）时递增，让旧缓存自然失效
+RENDER_VERSION = 2
+DEFAULT_FRAGMENT_CACHE_BYTES = 20 * 1024 ** 3
+# 小盘或快满的盘上缓存最多占（剩余空间 + 已缓存）的这个比例
+FRAGMENT_CACHE_FREE_SHARE = 0.25
+
+# 精彩片段/精简模式里每天进度中扫描行车数据占的比例，其余是渲染
+SCAN_PROGRESS_SHARE = 0.2
+
+# 单次渲染模式下缺失摄像头用黑场填充，长度需覆盖最长的单个片段
+FILLER_SECONDS = 65
+
+
+def open_fragment_cache(cache_dir=None):
+    """The shared fragment cache in cache_dir (default ~/.teslacam_merger). Its budget is
+    DEFAULT_FRAGMENT_CACHE_BYTES, scaled down to FRAGMENT_CACHE_FREE_SHARE of the volume's space."""
+    cache = shared_cache("fragments", DEFAULT_FRAGMENT_CACHE_BYTES, suffix=".mp4", root=cache_dir)
+    cache.max_bytes = free_space_budget(cache.root, DEFAULT_FRAGMENT_CACHE_BYTES, FRAGMENT_CACHE_FREE_SHARE,
+                                        cache.total_bytes())
+    return cache
 
 class TeslaCamMerger:
-    def __init__(self, source_path, output_dir, progress_callback=None):
+    def __init__(self, source_path, output_dir, progress_callback=None, max_workers=None, encoder_slots=None,
+                 fragment_cache=None, use_fragment_cache=True, wheel_sprites=False, encoder_health=None,
+                 source_index=None, use_source_index=True, render_pool=None, use_journal=True,
+                 highlight_triggers=None, fragment_cache_dir=None):
         self.source_path = source_path
         self.output_dir = output_dir
         self.progress_callback = progress_callback
@@ -22,6 +70,57 @@ class TeslaCamMerger:
         import platform
         self.is_windows = platform.system() == "Windows"
         self.default_hw_codec = "h264_videotoolbox" if not self.is_windows else "h264_nvenc"
+        # libx264 兜底的预设/线程数：跑过 x264_calibration 的机器用校准结果，否则 veryfast
+        self.sw_codec = calibrated_codec(self.get_ffmpeg_path("ffmpeg")) or SW_CODEC
+
+        # 并发控制：每个编码后端独立限额（可在多个 merger 之间共享），max_workers 为固定并发数（不自动调节）
+        self.max_workers = max_workers
+        self.encoder_slots = encoder_slots or EncoderSlots()
+
+        # 源目录索引（SQLite，按目录 mtime 增量刷新），避免每次都完整遍历 U 盘
+        self.source_index = None
+        if use_source_index:
+            try:
+                self.source_index = source_index or shared_index()
+            except (sqlite3.Error, OSError):
+                pass
+
+        # 编码器可用性：启动时探测一次（结果按机器缓存），运行中连续失败的后端由熔断器跳过
+        self.encoder_health = encoder_health or EncoderHealth()
+        self.encoder_probe = None  # encoder name -> bool
+
+        # 分片缓存：按源文件身份 + 渲染参数寻址，放在输出目录之外，重复/重叠的任务直接复用
+        # fragment_cache_dir 可以把它放到空间更大的盘上（比如输出所在的盘）
+        if use_fragment_cache:
+            self.fragment_cache = fragment_cache or open_fragment_cache(fragment_cache_dir)
+        else:
+            self.fragment_cache = None
+        self._cache_budget_warned = False
+        self._fragment_keys = {}  # 本次运行内缓存源文件身份哈希，调度线程和编码线程共用
+
+        # SEI 提取阶段（进程池），由流水线调度时创建
+        self.overlay_stage = None
+        self.sei_lookahead = 8
+
+        # 方向盘用预渲染的精灵图叠加（文字仍走 ASS），图集在 merge_all 开始时准备
+        self.wheel_sprites = wheel_sprites
+        self.wheel_atlas = None
+
+        # 局域网里的渲染 worker（render_worker.RenderWorkerPool）：片段优先派给它们，失败或都忙时本地编码
+        self.render_pool = render_pool
+        if render_pool:
+            render_pool.render_version = RENDER_VERSION
+            render_pool.log = self.log
+
+        # 断点续传日志（输出目录里的 .teslacam_journal.jsonl），merge_all 开始时打开
+        self.use_journal = use_journal
+        self.journal = None
+        self._clip_signatures = {}  # cameras -> 日志里的片段签名
+        self._timestamp_signatures = {}  # timestamp -> 片段签名，校验/拼接阶段用
+        self._day_signatures = {}  # date -> 当天所有片段签名的汇总
+
+        # 精彩片段模式的触发条件（highlights.HIGHLIGHT_TRIGGERS 按项覆盖）
+        self.highlight_triggers = resolve_triggers(highlight_triggers)
         
     def log(self, message):
         if self.progress_callback:
@@ -29,28 +128,37 @@ class TeslaCamMerger:
         else:
             print(message, flush=True)
 
+    def report_progress(self, message, **fields):
+        """Sends a PROGRESS: line; an EventBus callback also gets the structured fields (stage, clip, eta, ...)."""
+        if isinstance(self.progress_callback, EventBus):
+            self.progress_callback.emit(message, kind="progress", **fields)
+        else:
+            self.log(message)
+
     def group_videos(self):
-        """Finds and groups videos by date and timestamp within the source directory."""
+        """Finds and groups videos by date and timestamp within the source directory.
+        Uses the persistent source index (only changed folders are re-listed); walks the tree if it is unavailable."""
+        if self.source_index:
+            try:
+                self.source_index.refresh(self.source_path)
+                return self.source_index.grouped(self.source_path)
+            except (sqlite3.Error, OSError) as e:
+                self.log(f"DEBUG: Source index unavailable ({e}), scanning folders")
+        return self._walk_videos()
+
+    def _walk_videos(self):
         grouped = defaultdict(lambda: defaultdict(dict))
         
         found_files = 0
         # 递归遍历 source_path 及其所有子目录
         for root, _, filenames in os.walk(self.source_path):
             for filename in filenames:
-                if filename.endswith(".mp4") and not filename.startswith("._"):
-                    f = os.path.join(root, filename)
-                    try:
-                        # TeslaCam filename format: YYYY-MM-DD_HH-MM-SS-camera.mp4
-                        parts = filename.replace(".mp4", "").split("-")
-                        camera_name = parts[-1]
-                        timestamp_str = "-".join(parts[:-1]) 
-                        date_str = timestamp_str.split("_")[0] 
-                        
-                        grouped[date_str][timestamp_str][camera_name] = f
-                        found_files += 1
-                    except Exception as e:
-                        # self.log(f"Skipping file {f} due to format: {e}")
-                        pass
+                # TeslaCam filename format: YYYY-MM-DD_HH-MM-SS-camera.mp4
+                parsed = parse_clip_name(filename)
+                if parsed:
+                    date_str, timestamp_str, camera_name = parsed
+                    grouped[date_str][timestamp_str][camera_name] = os.path.join(root, filename)
+                    found_files += 1
                         
         return grouped, found_files
 
@@ -67,17 +175,14 @@ class TeslaCamMerger:
             # Normal mode: assume on PATH
             return f"{cmd}.exe" if self.is_windows else cmd
 
-    def create_grid_command(self, cameras, output_path, codec="h264_videotoolbox", ass_file=None):
-        """Creates a ffmpeg command to merge camera views into a grid layout (1080p)."""
-        # Define layout map: (key, x, y, width, height)
-        layout = [
-            ("front", 480, 0, 960, 720),
-            ("left_repeater", 0, 600, 640, 480),
-            ("back", 640, 600, 640, 480),
-            ("right_repeater", 1280, 600, 640, 480)
-        ]
-        
-        valid_cams = [(k, cameras[k], x, y, w, h) for k, x, y, w, h in layout if cameras.get(k)]
+    def create_grid_command(self, cameras, output_path, codec="h264_videotoolbox", ass_file=None, input_format=None, extra_args="",
+                            wheel_commands=None, speed=1):
+        """Creates a ffmpeg command to merge camera views into a grid layout (1080p).
+        With input_format="concat" the camera paths are ffconcat lists instead of single clips.
+        wheel_commands is the sendcmd file that drives the steering wheel sprite (sprite mode only).
+        speed > 1 renders a time-lapse from the keyframes only; output-side -ss/-t in extra_args then
+        refer to the sped-up timeline."""
+        valid_cams = [(k, cameras[k], x, y, w, h) for k, x, y, w, h in GRID_LAYOUT if cameras.get(k)]
         if not valid_cams:
             return None
         
@@ -95,6 +200,11 @@ class TeslaCamMerger:
         elif codec == "h264_nvenc":
             # For Nvidia, usually -hwaccel cuda or nvdec works well
             hw_in = "-hwaccel cuda "
+        if input_format == "concat":
+            hw_in += "-f concat -safe 0 "
+        if speed > 1:
+            # 延时摄影只解码关键帧，解码量也跟着降下来
+            hw_in += "-skip_frame nokey "
             
         inputs.append(f"{hw_in}-i \"{first_path}\"")
         filter_complex += f"[0:v] scale={first_w}:{first_h}, pad={canvas_w}:{canvas_h}:{first_x}:{first_y}:black [base]; "
@@ -105,6 +215,11 @@ class TeslaCamMerger:
             filter_complex += f"[{i}:v] scale={w}:{h} [v{k}]; "
             filter_complex += f"{current_node}[v{k}] overlay=x={x}:y={y}:eof_action=pass [tmp{i}]; "
             current_node = f"[tmp{i}]"
+
+        if wheel_commands and self.wheel_atlas:
+            filter_complex += wheel_filter(len(inputs), wheel_commands, current_node, "[with_wheel]")
+            inputs.append(f"-i \"{self.wheel_atlas}\"")
+            current_node = "[with_wheel]"
         
         if ass_file:
             # Escape the path for the FFMPEG filter
@@ -113,101 +228,858 @@ class TeslaCamMerger:
             final_node = "with_ass"
         else:
             final_node = current_node.strip("[]")
+        if speed > 1:
+            # 字幕和方向盘按原始时间戳画好之后再加速
+            filter_complex += f"[{final_node}] setpts=PTS/{speed} [timelapse]; "
+            final_node = "timelapse"
 
         # Bitrate and codec settings with compatibility flags for Apple QuickTime
         ffmpeg_bin = self.get_ffmpeg_path("ffmpeg")
         cmd = (f"\"{ffmpeg_bin}\" -y {' '.join(inputs)} -filter_complex \"{filter_complex}\" "
                f"-map \"[{final_node}]\" -c:v {codec} -b:v 3000k -r 25 -pix_fmt yuv420p "
                f"-color_range tv -colorspace bt709 -color_trc bt709 -color_primaries bt709 "
-               f"-movflags +faststart \"{output_path}\"")
+               f"-movflags +faststart {extra_args + ' ' if extra_args else ''}\"{output_path}\"")
         return cmd
 
+    def _run_encode(self, cmd, codec, timeout):
+        """Runs an encode once a session for `codec` is free. Returns None if stop was requested while waiting."""
+        with self.encoder_slots.slot(codec, should_stop=lambda: self.stop_requested) as acquired:
+            if not acquired:
+                return None
+            return subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=timeout)
+
+    def _abort_clip(self, timestamp, ass_file):
+        with self.lock:
+            if timestamp in self.active_tasks: del self.active_tasks[timestamp]
+        if ass_file: remove_overlay(ass_file)
+        return None
+
+    def _prepare_overlay(self, timestamp, cameras):
+        """Returns the .ass overlay for a clip: left over from an interrupted run, from the SEI stage if running,
+        else extracted inline."""
+        if "front" not in cameras:
+            return None
+        resumed = self._journaled_overlay(cameras)
+        if resumed:
+            self.log(f"DEBUG: Reusing ASS subtitle of an earlier run for {timestamp}")
+            if self.overlay_stage:
+                self.overlay_stage.discard(timestamp)
+            return resumed
+        if self.overlay_stage:
+            ass_file = self.overlay_stage.result(timestamp, cameras)
+        else:
+            ass_path = os.path.join(self.output_dir, f"sei_data_{timestamp}.ass")
+            ass_file = extract_overlay(cameras["front"], ass_path, timestamp, self.wheel_sprites)
+        if ass_file:
+            self.log(f"DEBUG: Successfully generated ASS subtitle for {timestamp}")
+            if self.journal:
+                self.journal.record_clip(self._clip_signature(cameras), timestamp, EXTRACTED, ass=ass_file)
+        return ass_file
+
+    def _journaled_overlay(self, cameras):
+        if not self.journal:
+            return None
+        ass_file = self.journal.overlay(self._clip_signature(cameras))
+        if ass_file and self.wheel_sprites and not os.path.exists(commands_path(ass_file)):
+            return None
+        return ass_file
+
+    def _clip_signature(self, cameras):
+        memo_key = tuple(sorted(cameras.items()))
+        with self.lock:
+            signature = self._clip_signatures.get(memo_key)
+        if signature is None:
+            signature = clip_signature(cameras, self.render_params())
+            with self.lock:
+                self._clip_signatures[memo_key] = signature
+        return signature
+
+    def _is_resumable(self, cameras):
+        """True if the journal already has this clip's fragment or overlay, so no SEI extraction is needed."""
+        if not self.journal:
+            return False
+        signature = self._clip_signature(cameras)
+        return bool(self.journal.fragment(signature) or self._journaled_overlay(cameras))
+
+    def _is_fragment_cached(self, cameras):
+        key = self._fragment_key(cameras)
+        return bool(key) and self.fragment_cache.contains(key)
+
+    def _finish_clip(self, timestamp, key, fragment, ass_file):
+        """Bookkeeping for a successfully rendered clip; moves the fragment into the cache if enabled."""
+        with self.lock:
+            if timestamp in self.active_tasks: del self.active_tasks[timestamp]
+        if ass_file: remove_overlay(ass_file)
+        if key:
+            return self._cache_fragment(key, fragment)
+        return fragment
+
+    def _cache_fragment(self, key, fragment):
+        """Moves a fragment into the cache, pinned until the day is merged."""
+        cached = self.fragment_cache.put(key, fragment, pin=True)
+        pinned, budget = self.fragment_cache.pinned_bytes(), self.fragment_cache.max_bytes
+        if pinned > budget and not self._cache_budget_warned:
+            # 正在用的分片不能淘汰，缓存只能先超出预算
+            self._cache_budget_warned = True
+            self.log(f"Warning: fragments in use ({pinned / 1024 ** 3:.1f} GB) exceed the fragment cache budget "
+                     f"({budget / 1024 ** 3:.1f} GB); the cache stays over budget until they are merged.")
+        return cached
+
+    def _render_remote(self, timestamp, cameras, key, temp_output):
+        """Renders the clip on a render worker. None if no worker was free or all attempts failed."""
+        with self.lock:
+            self.active_tasks[timestamp] = "远程渲染"
+        if self.render_pool.render(timestamp, cameras, self.render_params(), temp_output,
+                                   should_stop=lambda: self.stop_requested):
+            self.log(f"DEBUG: {timestamp} rendered remotely")
+            if self.overlay_stage:
+                self.overlay_stage.discard(timestamp)
+            return self._finish_clip(timestamp, key, temp_output, None)
+        with self.lock:
+            self.active_tasks.pop(timestamp, None)
+        return None
+
+    def render_params(self):
+        """Everything besides the source clips that changes how a fragment looks."""
+        return {
+            "version": RENDER_VERSION,
+            "layout": GRID_LAYOUT,
+            "encoders": self._encoder_chain(),
+            "bitrate": "3000k",
+            "fps": 25,
+            "overlay": "ass+wheel_sprites" if self.wheel_sprites else "ass",
+        }
+
+    def _fragment_key(self, cameras):
+        if not self.fragment_cache:
+            return None
+        memo_key = tuple(sorted(cameras.items()))
+        with self.lock:
+            if memo_key in self._fragment_keys:
+                return self._fragment_keys[memo_key]
+        try:
+            sources = {k: file_identity(p) for k, p in sorted(cameras.items())}
+        except OSError:
+            return None
+        key = cache_key(sources, self.render_params())
+        with self.lock:
+            self._fragment_keys[memo_key] = key
+        return key
+
+    def _release_fragments(self, fragments, discard=False):
+        """Unpins cached fragments (or drops them from the cache when discard=True)."""
+        if not self.fragment_cache:
+            return
+        for path in fragments:
+            key = self.fragment_cache.key_for_path(path)
+            if not key:
+                continue
+            if discard:
+                self.fragment_cache.discard(key)
+            else:
+                self.fragment_cache.unpin(key)
+
+    def _create_concurrency(self):
+        """Initial concurrency from the encoder slots; a fixed max_workers disables adaptation."""
+        if self.max_workers:
+            return AdaptiveConcurrency(self.max_workers, minimum=self.max_workers, maximum=self.max_workers)
+        first_slots = self.encoder_slots.limit(self._usable_encoders()[0])
+        sw_slots = self.encoder_slots.limit(self.sw_codec)
+        # 远程 worker 的容量直接加上去，本机负载高时也不缩减这部分
+        remote = self.render_pool.capacity if self.render_pool else 0
+        # 起步用首选（探测可用的）编码器的会话数；上限多留一个，让下一个片段的 SEI 提取和正在进行的编码重叠
+        return AdaptiveConcurrency(first_slots + remote, minimum=1 + remote, maximum=max(first_slots, sw_slots) + 1 + remote)
+
     def process_clip(self, timestamp, cameras):
         if self.stop_requested:
             return None
-        
+        if not self.journal:
+            return self._process_clip(timestamp, cameras)
+
+        signature = self._clip_signature(cameras)
+        with self.lock:
+            self._timestamp_signatures[timestamp] = signature
+        # 日志里记着上次已经渲染好的片段（且文件没变）：不再查缓存、提取 SEI 或校验
+        resumed = self.journal.fragment(signature)
+        if resumed:
+            key = self.fragment_cache.key_for_path(resumed) if self.fragment_cache else None
+            if not key or self.fragment_cache.get(key, pin=True):
+                self.log(f"DEBUG: {timestamp} already rendered by an earlier run")
+                if self.overlay_stage:
+                    self.overlay_stage.discard(timestamp)
+                return resumed
+        fragment = self._process_clip(timestamp, cameras)
+        if fragment:
+            self.journal.record_clip(signature, timestamp, ENCODED, fragment=fragment)
+        return fragment
+
+    def _process_clip(self, timestamp, cameras):
         temp_output = os.path.join(self.output_dir, f"temp_{timestamp}.mp4")
-        ffprobe_bin = self.get_ffmpeg_path("ffprobe")
-        
+
+        # 先查分片缓存，命中时连 SEI 提取都不需要
+        key = self._fragment_key(cameras)
+        if key:
+            cached = self.fragment_cache.get(key, pin=True)
+            if cached:
+                self.log(f"DEBUG: Fragment cache HIT for {timestamp}")
+                if self.overlay_stage:
+                    self.overlay_stage.discard(timestamp)
+                return cached
+
+        if self.render_pool:
+            fragment = self._render_remote(timestamp, cameras, key, temp_output)
+            if fragment:
+                return fragment
+
         # 提取行车数据 (SEI) 并生成字幕文件
-        ass_file = None
-        has_ass_data = False
-        if "front" in cameras:
-            ass_path = os.path.join(self.output_dir, f"sei_data_{timestamp}.ass")
-            parser = DashcamParser()
-            try:
-                has_ass_data = parser.extract_sei_to_ass(cameras["front"], ass_path, base_timestamp_str=timestamp)
-                if has_ass_data:
-                    ass_file = ass_path
-                    self.log(f"DEBUG: Successfully generated ASS subtitle for {timestamp}")
-            except Exception as e:
-                self.log(f"DEBUG: Failed to extract SEI data for {timestamp}: {e}")
+        ass_file = self._prepare_overlay(timestamp, cameras)
+        wheel_cmds = commands_path(ass_file) if ass_file and self.wheel_sprites else None
 
         # 优化：如果临时分片已生成且不为空，则跳过（支持断点续传）
         if os.path.exists(temp_output) and os.path.getsize(temp_output) > 1000:
             self.log(f"DEBUG: Found cached file for {timestamp}, checking validity...")
-            check = subprocess.run([ffprobe_bin, "-v", "error", temp_output], capture_output=True)
-            if check.returncode == 0:
+            if check_fragment(temp_output, self.get_ffmpeg_path("ffprobe"), self.log):
                 self.log(f"DEBUG: Cache for {timestamp} is VALID.")
-                return temp_output
+                return self._finish_clip(timestamp, key, temp_output, ass_file)
             else:
                 self.log(f"DEBUG: Cache for {timestamp} is INVALID, deleting...")
                 os.remove(temp_output)
 
         with self.lock:
             self.active_tasks[timestamp] = "正在转码"
-        
-        self.log(f"DEBUG: Processing {timestamp} - HW Start")
-        # 自动尝试硬件加速（macOS 为 videotoolbox, Windows 默认为 nvenc）
-        cmd_hw = self.create_grid_command(cameras, temp_output, codec=self.default_hw_codec, ass_file=ass_file)
-        try:
-            self.log(f"DEBUG: Executing HW CMD: {cmd_hw}")
-            result = subprocess.run(cmd_hw, shell=True, capture_output=True, text=True, timeout=300)
-            self.log(f"DEBUG: HW CMD Finished for {timestamp} with code {result.returncode}")
+
+        encoded = self._encode_grid(timestamp, cameras, temp_output, ass_file, wheel_cmds)
+        if encoded is None:
+            return self._abort_clip(timestamp, ass_file)
+        if encoded:
+            return self._finish_clip(timestamp, key, temp_output, ass_file)
+        with self.lock:
+            if timestamp in self.active_tasks: del self.active_tasks[timestamp]
+        if ass_file: remove_overlay(ass_file)
+        return None
+
+    def _encode_grid(self, label, cameras, output, ass_file=None, wheel_cmds=None, extra_args="", speed=1):
+        """Renders the grid into output with the first usable encoder that succeeds.
+        Returns True on success, False if every encoder failed, None if stop was requested."""
+        # 依次尝试可用的编码器；失败先记下来，只有后面的编码器成功了才算到前面的头上（全失败多半是源文件的问题）
+        failed = []
+        for codec in self._usable_encoders():
+            if os.path.exists(output): os.remove(output)
+            cmd = self.create_grid_command(cameras, output, codec=codec, ass_file=ass_file, extra_args=extra_args,
+                                           wheel_commands=wheel_cmds, speed=speed)
+            try:
+                self.log(f"DEBUG: Executing {codec} CMD: {cmd}")
+                result = self._run_encode(cmd, codec, timeout=600 if codec == self.sw_codec else 300)
+            except subprocess.TimeoutExpired:
+                self.log(f"Transcoding with {codec} TIMEOUT for {label}, trying next encoder...")
+                failed.append((codec, True))
+                continue
+            if result is None:
+                return None
+            self.log(f"DEBUG: {codec} CMD Finished for {label} with code {result.returncode}")
             if result.returncode == 0:
-                with self.lock:
-                    if timestamp in self.active_tasks: del self.active_tasks[timestamp]
-                return temp_output
-            else:
-                self.log(f"Hardware transcoding failed for {timestamp} (Code {result.returncode}), stderr: {result.stderr[:100]}")
-                # 如果是 Windows 且 nvenc 失败，尝试 qsv (Intel)
-                if self.is_windows and self.default_hw_codec == "h264_nvenc":
-                    self.log("Retrying with h264_qsv (Intel HW acceleration)...")
-                    cmd_qsv = self.create_grid_command(cameras, temp_output, codec="h264_qsv", ass_file=ass_file)
-                    result = subprocess.run(cmd_qsv, shell=True, capture_output=True, text=True, timeout=300)
-                    if result.returncode == 0:
-                        with self.lock:
-                            if timestamp in self.active_tasks: del self.active_tasks[timestamp]
-                        if ass_file and os.path.exists(ass_file): os.remove(ass_file)
-                        return temp_output
-
-        except subprocess.TimeoutExpired:
-            self.log(f"Hardware transcoding TIMEOUT for {timestamp}, switching to software fallback...")
-        
-        # 预案 2：软件解码 (Robust)
-        self.log(f"DEBUG: Retrying {timestamp} with software encoder (libx264)...")
+                self._record_encoder_results(codec, failed)
+                return True
+            self.log(f"Transcoding with {codec} failed for {label} (Code {result.returncode}), stderr: {result.stderr[:100]}")
+            failed.append((codec, False))
+
+        self.log(f"CRITICAL: All encoders failed for {label}.")
+        if os.path.exists(output): os.remove(output)
+        return False
+
+    def _record_encoder_results(self, codec, failed):
+        """Feeds the circuit breaker once an encode succeeded with `codec` after the `failed` ones."""
+        self.encoder_health.record_success(codec)
+        for failed_codec, fatal in failed:
+            if self.encoder_health.record_failure(failed_codec, fatal=fatal):
+                self.log(f"Encoder {encoder_family(failed_codec)} keeps failing, skipping it for now "
+                         f"(retry in {self.encoder_health.cooldown / 60:.0f} min)")
+
+    def probe_encoders(self, refresh=False):
+        """Finds out once which encoders of the chain work on this machine (cached per machine)."""
+        results, probed = probe_encoders(self.get_ffmpeg_path("ffmpeg"), self._encoder_chain(), refresh=refresh)
+        self.encoder_probe = results
+        summary = ", ".join(f"{name} {'OK' if ok else 'unavailable'}" for name, ok in results.items())
+        self.log(f"Encoder probe{'' if probed else ' (cached)'}: {summary}")
+        return results
+
+    def _usable_encoders(self):
+        """The encoder chain minus backends that failed the probe or whose circuit breaker is open.
+        libx264 is always kept as the last resort."""
+        usable = []
+        for codec in self._encoder_chain():
+            if codec != self.sw_codec:
+                if self.encoder_probe is not None and not self.encoder_probe.get(encoder_family(codec), True):
+                    continue
+                if not self.encoder_health.available(codec):
+                    continue
+            usable.append(codec)
+        return usable
+
+    def _encoder_chain(self):
+        """Encoders to try in order: platform HW encoder, Intel QSV on Windows, then libx264."""
+        chain = [self.default_hw_codec]
+        if self.is_windows and self.default_hw_codec == "h264_nvenc":
+            chain.append("h264_qsv")
+        chain.append(self.sw_codec)
+        return chain
+
+    def _ensure_filler(self):
+        """Black clip used in place of a missing camera minute in single-pass mode."""
+        filler = os.path.join(self.output_dir, "temp_filler_black.mp4")
+        if os.path.exists(filler) and os.path.getsize(filler) > 1000:
+            return filler
+        ffmpeg_bin = self.get_ffmpeg_path("ffmpeg")
+        cmd = [ffmpeg_bin, "-y", "-f", "lavfi", "-i", "color=black:s=640x480:r=36", "-t", str(FILLER_SECONDS),
+               "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", filler]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            self.log(f"Failed to create filler clip: {result.stderr[-200:]}")
+            return None
+        return filler
+
+    def _run_long_encode(self, cmd, codec, on_progress=None):
+        """Runs a long encode (started with -progress pipe:1) and reports encoded seconds via on_progress.
+        on_progress(seconds, fps, total_size) gets ffmpeg's own fps and output bytes (None until reported).
+        Kills ffmpeg on stop(). Returns (returncode, last error lines); returncode is None if stopped."""
+        with self.encoder_slots.slot(codec, should_stop=lambda: self.stop_requested) as acquired:
+            if not acquired:
+                return None, ""
+            errors = deque(maxlen=20)
+            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            last_report = 0
+            stats = {}
+            for line in proc.stdout:
+                if self.stop_requested:
+                    proc.kill()
+                    break
+                line = line.strip()
+                if line.startswith("out_time_us=") or line.startswith("out_time_ms="):
+                    # 两个字段的单位其实都是微秒
+                    value = line.split("=", 1)[1]
+                    if on_progress and value.isdigit() and time.monotonic() - last_report >= 2:
+                        last_report = time.monotonic()
+                        on_progress(int(value) / 1_000_000, stats.get("fps"), stats.get("total_size"))
+                elif line.startswith("fps=") or line.startswith("total_size="):
+                    key, _, value = line.partition("=")
+                    try:
+                        stats[key] = float(value) if key == "fps" else int(value)
+                    except ValueError:
+                        pass
+                elif "=" not in line and line:
+                    errors.append(line)
+            proc.wait()
+            if self.stop_requested:
+                return None, ""
+            return proc.returncode, "\n".join(errors)
+
+    def merge_day_single_pass(self, date_str, timestamps, progress_done=0, progress_total=None):
+        """Renders a whole day with one long-running ffmpeg: each camera's minute files become one
+        concat input and the grid is encoded straight into TeslaCam_{date}.mp4, without per-minute
+        fragments, ffprobe checks or a second concat pass."""
+        parser = DashcamParser()
+        progress_total = progress_total or len(timestamps)
+
+        # 每分钟以布局中第一个存在的摄像头时长为准（与分片模式的底图一致）
+        segments = []
+        for ts, cameras in sorted(timestamps.items()):
+            base_cam = next((cameras[k] for k, *_ in GRID_LAYOUT if cameras.get(k)), None)
+            duration = parser.read_duration(base_cam) if base_cam else None
+            if not duration:
+                self.log(f"Skipping {ts}: clip is unreadable or has no duration")
+                continue
+            segments.append((ts, cameras, duration))
+
+        if not segments:
+            self.log(f"Error: No readable clips for {date_str}, skipping.")
+            return None
+
+        used_cams = [k for k, *_ in GRID_LAYOUT if any(cams.get(k) for _, cams, _ in segments)]
+        filler = None
+        if any(not cams.get(k) for _, cams, _ in segments for k in used_cams):
+            filler = self._ensure_filler()
+            if not filler:
+                return None
+
+        # 每个摄像头一份 ffconcat 列表：duration 让各路时间轴按分钟对齐，outpoint 截掉超出基准时长的部分（填充片段也靠它裁剪）
+        concat_lists = {}
+        for k in used_cams:
+            list_path = os.path.join(self.output_dir, f"concat_{date_str}_{k}.txt")
+            with open(list_path, "w") as f:
+                f.write("ffconcat version 1.0\n")
+                for _, cams, duration in segments:
+                    src = os.path.abspath(cams.get(k) or filler).replace("'", "'\\''")
+                    f.write(f"file '{src}'\noutpoint {duration:.3f}\nduration {duration:.3f}\n")
+            concat_lists[k] = list_path
+
+        # 整天的行车数据写入同一个 ASS，按每分钟的起始偏移平移
+        ass_file = None
+        wheel_cmds = None
+        if "front" in used_cams:
+            ass_path = os.path.join(self.output_dir, f"sei_data_{date_str}.ass")
+            offsets, elapsed = [], 0.0
+            for ts, cams, duration in segments:
+                if cams.get("front"):
+                    offsets.append((cams["front"], ts, elapsed))
+                elapsed += duration
+            wheel_spans = [] if self.wheel_sprites else None
+            if parser.write_concatenated_ass(offsets, ass_path, loader=load_messages, wheel_spans=wheel_spans):
+                ass_file = ass_path
+                if self.wheel_sprites:
+                    wheel_cmds = commands_path(ass_path)
+                    write_commands(wheel_spans, wheel_cmds, parser.steering_quantum)
+                stats = parser.ass_stats
+                self.log(f"DEBUG: {date_str} overlay: {stats['text_events'] + stats['wheel_events']} ASS events "
+                         f"for {stats['samples']} telemetry samples (previously {2 * stats['samples']})")
+            elif os.path.exists(ass_path):
+                os.remove(ass_path)
+
+        total_duration = sum(d for *_, d in segments)
+        final_output = os.path.join(self.output_dir, f"TeslaCam_{date_str}.mp4")
+        temp_output = os.path.join(self.output_dir, f"temp_TeslaCam_{date_str}.mp4")
+        self.log(f"Single-pass rendering {date_str}: {len(segments)} clips, {total_duration / 60:.1f} min, cameras: {', '.join(used_cams)}")
+
+        result_path = None
+        failed = []
+        for codec in self._usable_encoders():
+            encode_start = time.monotonic()
+
+            def on_progress(seconds, fps, total_size, codec=codec, encode_start=encode_start):
+                day_fraction = min(seconds / total_duration, 1.0)
+                overall = (progress_done + day_fraction * len(timestamps)) / progress_total * 100
+                elapsed = time.monotonic() - encode_start
+                eta = elapsed * (1 - day_fraction) / day_fraction if day_fraction > 0 else None
+                self.report_progress(f"PROGRESS:{overall:.1f}%:单次渲染 {date_str} {day_fraction * 100:.0f}% ({codec.split()[0]});",
+                                     percent=overall, stage="single_pass", clip=date_str, fps=fps, bytes=total_size, eta=eta)
+
+            cmd = self.create_grid_command(concat_lists, temp_output, codec=codec, ass_file=ass_file,
+                                           input_format="concat", extra_args="-progress pipe:1 -nostats -v error",
+                                           wheel_commands=wheel_cmds)
+            self.log(f"DEBUG: Executing single-pass CMD: {cmd}")
+            returncode, errors = self._run_long_encode(cmd, codec, on_progress)
+            if returncode is None:
+                break
+            if returncode == 0:
+                self._record_encoder_results(codec, failed)
+                os.replace(temp_output, final_output)
+                signature = self._day_signatures.get(date_str)
+                if self.journal and signature:
+                    # 单次渲染直接写出整天的文件，编码成功即视为拼接完成
+                    self.journal.record_day(date_str, CONCATENATED, signature, final_output)
+                    if check_fragment(final_output, self.get_ffmpeg_path("ffprobe"), self.log):
+                        self.journal.record_day(date_str, VERIFIED, signature, final_output)
+                self.log(f"Successfully created {final_output}")
+                result_path = final_output
+                break
+            self.log(f"Single-pass encode with {codec} failed for {date_str} (Code {returncode}): {errors[-200:]}")
+            failed.append((codec, False))
+
+        for list_path in concat_lists.values():
+            if os.path.exists(list_path): os.remove(list_path)
+        if ass_file: remove_overlay(ass_file)
         if os.path.exists(temp_output): os.remove(temp_output)
-        
-        cmd_sw = self.create_grid_command(cameras, temp_output, codec="libx264 -preset veryfast", ass_file=ass_file)
-        try:
-            self.log(f"DEBUG: Executing SW CMD: {cmd_sw}")
-            result = subprocess.run(cmd_sw, shell=True, capture_output=True, text=True, timeout=600)
-            self.log(f"DEBUG: SW CMD Finished for {timestamp} with code {result.returncode}")
-            if result.returncode == 0:
-                with self.lock:
-                    if timestamp in self.active_tasks: del self.active_tasks[timestamp]
-                return temp_output
+        return result_path
+
+    def _merge_days_single_pass(self, grouped_days, total_timestamps):
+        last_successful_output = None
+        processed_count = 0
+        for date_str, timestamps in sorted(grouped_days.items()):
+            if self.stop_requested: break
+            self.log(f"Processing date: {date_str} ({len(timestamps)} clips)")
+            output = self.merge_day_single_pass(date_str, timestamps, processed_count, total_timestamps)
+            processed_count += len(timestamps)
+            if output:
+                last_successful_output = output
+        return last_successful_output
+
+    def _merge_days_pipelined(self, grouped_days, total_timestamps):
+        """Encodes the clips of all days from one global queue (in date order) and concatenates
+        each day on a separate thread as soon as its last clip is done, so encoders keep working
+        on day N+1 while day N is validated and merged. Days are finalized strictly in order."""
+        concurrency = self._create_concurrency()
+        self.log(f"Concurrency: starting with {concurrency.target} parallel clips (max {concurrency.maximum}), encoder slots: {self.encoder_slots.snapshot()}")
+
+        days = sorted(grouped_days.items())
+        queue = [(day_idx, ts, cameras) for day_idx, (_, timestamps) in enumerate(days)
+                 for ts, cameras in sorted(timestamps.items())]
+        remaining = [len(timestamps) for _, timestamps in days]
+        day_results = [[] for _ in days]  # (timestamp, fragment)
+        started_days = set()
+        next_day_to_finalize = 0
+        finalize_futures = []
+        processed_count = 0
+        output_bytes = 0
+
+        next_idx = 0
+        in_flight = {}
+        # SEI 提取在独立进程池中先行，领先编码器 sei_lookahead 个片段；已缓存的片段不提取
+        self.overlay_stage = OverlayStage(self.output_dir, log=self.log, wheel_sprites=self.wheel_sprites)
+        prefetched = 0
+        # 拼接单独一个线程，按日期顺序执行；编码线程池不用等待当天拼接完成
+        with ThreadPoolExecutor(max_workers=1) as finalizer, \
+             ThreadPoolExecutor(max_workers=concurrency.maximum) as executor:
+            while True:
+                # 依次提交已经全部编码完成的日期（包括没有片段的空日期）
+                while next_day_to_finalize < len(days) and remaining[next_day_to_finalize] == 0 and not self.stop_requested:
+                    date_str = days[next_day_to_finalize][0]
+                    finalize_futures.append(finalizer.submit(self._finalize_day, date_str, day_results[next_day_to_finalize]))
+                    next_day_to_finalize += 1
+
+                target = concurrency.update()
+                while not self.stop_requested and len(in_flight) < target and next_idx < len(queue):
+                    day_idx, ts, cameras = queue[next_idx]
+                    next_idx += 1
+                    if day_idx not in started_days:
+                        started_days.add(day_idx)
+                        self.log(f"Processing date: {days[day_idx][0]} ({len(days[day_idx][1])} clips)")
+                    in_flight[executor.submit(self.process_clip, ts, cameras)] = (day_idx, ts)
+
+                prefetched = max(prefetched, next_idx)
+                while not self.stop_requested and prefetched < min(len(queue), next_idx + self.sei_lookahead):
+                    _, ts, cameras = queue[prefetched]
+                    prefetched += 1
+                    # 有远程 worker 时片段多半不在本机渲染，不预先提取 SEI
+                    if not self.render_pool and not self._is_fragment_cached(cameras) and not self._is_resumable(cameras):
+                        self.overlay_stage.submit(ts, cameras)
+
+                if not in_flight:
+                    if self.stop_requested or next_day_to_finalize >= len(days):
+                        break
+                    continue
+
+                done, _ = wait(in_flight, timeout=1.0, return_when=FIRST_COMPLETED)
+                if self.stop_requested:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+
+                for future in done:
+                    day_idx, ts = in_flight.pop(future)
+                    res = future.result()
+                    concurrency.record()
+                    remaining[day_idx] -= 1
+                    if res:
+                        day_results[day_idx].append((ts, res))
+                        try:
+                            output_bytes += os.path.getsize(res)
+                        except OSError:
+                            pass
+                        status_text = f"完成 {ts}"
+                    else:
+                        status_text = f"失败 {ts}"
+
+                    processed_count += 1
+                    # Progress update
+                    progress = (processed_count / total_timestamps) * 100
+
+                    # 构造并行进度信息
+                    with self.lock:
+                        active = list(self.active_tasks.keys())
+                    active_info = ";".join([f"🔥 正在处理: {k}" for k in active])
+
+                    rate = concurrency.clips_per_minute
+                    concurrency_info = f"并发 {concurrency.target}, {rate:.1f} 段/分钟"
+                    self.report_progress(
+                        f"PROGRESS:{progress:.1f}%:{status_text} ({processed_count}/{total_timestamps}) [{concurrency_info}];{active_info}",
+                        percent=progress, stage="encode", clip=ts, clips_per_minute=rate, bytes=output_bytes,
+                        eta=(total_timestamps - processed_count) * 60 / rate if rate else None, active=active)
+
+        self.overlay_stage.shutdown()
+        self.overlay_stage = None
+
+        outputs = [f.result() for f in finalize_futures]
+        return next((o for o in reversed(outputs) if o), None)
+
+    def _merge_days_highlights(self, grouped_days, total_timestamps, pre=PRE_SECONDS, post=POST_SECONDS):
+        """Highlight mode: finds trigger moments in each clip's telemetry and renders only padded windows
+        around them, concatenated into TeslaCam_{date}_highlights.mp4."""
+        last_successful_output = None
+        shares = self._day_progress_shares(grouped_days, total_timestamps)
+        for date_str, timestamps in sorted(grouped_days.items()):
+            if self.stop_requested: break
+            clips = []
+            for scanned, (ts, cameras) in enumerate(sorted(timestamps.items()), start=1):
+                duration, triggers = 60.0, []
+                telemetry = load_or_extract(cameras["front"]) if "front" in cameras else None
+                if telemetry is not None:
+                    if len(telemetry):
+                        duration = len(telemetry) / FRAME_RATE
+                    triggers = find_triggers(telemetry, self.highlight_triggers)
+                    telemetry.close()
+                clips.append((ts, duration, triggers))
+                percent = self._day_percent(shares[date_str], SCAN_PROGRESS_SHARE * scanned / len(timestamps))
+                self.report_progress(f"PROGRESS:{percent:.1f}%:扫描行车数据 {ts} ({scanned}/{len(timestamps)})",
+                                     percent=percent, stage="scan", clip=ts)
+
+            windows = plan_windows(clips, pre, post)
+            footage = sum(duration for _, duration, _ in clips)
+            if not windows:
+                self.log(f"{date_str}: no highlight triggers in {len(clips)} clips.")
+                continue
+            spans = [(ts, start, end, 1) for window in windows for ts, start, end in window["spans"]]
+            self.log(f"{date_str}: {sum(len(t) for _, _, t in clips)} triggers -> {len(windows)} highlights, "
+                     f"{sum(end - start for _, start, end, _ in spans):.0f}s of {footage:.0f}s to render")
+            for window in windows:
+                self.log(f"  {describe_window(window)}")
+
+            fragments = self._render_spans(date_str, timestamps, spans, shares[date_str])
+            output = self._concat_spans(date_str, fragments, "_highlights")
+            last_successful_output = output or last_successful_output
+        return last_successful_output
+
+    def _merge_days_condensed(self, grouped_days, total_timestamps, idle_mode="drop", speed=TIMELAPSE_SPEED):
+        """Condensed mode: splits each day into driving and idle (parked, Sentry) segments, renders the driving ones
+        and drops the idle ones or renders them as a time-lapse, into TeslaCam_{date}_condensed.mp4.
+        The per-segment decisions are written to TeslaCam_{date}_condensed.json."""
+        last_successful_output = None
+        shares = self._day_progress_shares(grouped_days, total_timestamps)
+        ffmpeg_bin = self.get_ffmpeg_path("ffmpeg")
+        for date_str, timestamps in sorted(grouped_days.items()):
+            if self.stop_requested: break
+            clips = []
+            for scanned, (ts, cameras) in enumerate(sorted(timestamps.items()), start=1):
+                clips.append((ts, *self._scan_idle(cameras, ffmpeg_bin)))
+                percent = self._day_percent(shares[date_str], SCAN_PROGRESS_SHARE * scanned / len(timestamps))
+                self.report_progress(f"PROGRESS:{percent:.1f}%:分析停车片段 {ts} ({scanned}/{len(timestamps)})",
+                                     percent=percent, stage="scan", clip=ts)
+
+            segments = plan_day(clips)
+            spans = []
+            for ts in sorted(timestamps):
+                clip_segments = [s for s in segments if s["timestamp"] == ts]
+                if len(clip_segments) == 1 and not clip_segments[0]["idle"]:
+                    # 整分钟都在开车：按普通分片渲染，和完整合并共用分片缓存
+                    clip_segments[0]["action"] = "keep"
+                    spans.append((ts, 0.0, None, 1))
+                    continue
+                for segment in clip_segments:
+                    start, end = segment["start"], segment["end"]
+                    if not segment["idle"]:
+                        segment["action"] = "keep"
+                        spans.append((ts, start, end, 1))
+                    elif idle_mode == "timelapse" and (end - start) / speed >= MIN_SPAN_S:
+                        segment["action"] = "timelapse"
+                        spans.append((ts, start, end, speed))
+                    else:
+                        segment["action"] = "drop"
+
+            summary = summarize(segments)
+            lapsed = sum(end - start for _, start, end, s in spans if s != 1)
+            expected = summary["drive_s"] + lapsed / speed
+            self.log(f"{date_str}: {summary['drive_s']:.0f}s driving, {summary['idle_s']:.0f}s idle in "
+                     f"{summary['idle_spans']} spans -> about {expected:.0f}s of video "
+                     f"({'idle as ' + str(speed) + 'x time-lapse' if idle_mode == 'timelapse' else 'idle dropped'})")
+            output = None
+            if spans:
+                fragments = self._render_spans(date_str, timestamps, spans, shares[date_str], label="行车片段")
+                output = self._concat_spans(date_str, fragments, "_condensed")
             else:
-                self.log(f"CRITICAL: Software fallback failed for {timestamp}: {result.stderr[:100]}")
-        except subprocess.TimeoutExpired:
-            self.log(f"CRITICAL: Software fallback TIMEOUT for {timestamp}.")
-        
+                self.log(f"{date_str}: no driving footage, nothing to render.")
+            self._write_idle_decisions(date_str, idle_mode, speed, segments, summary, output)
+            last_successful_output = output or last_successful_output
+        return last_successful_output
+
+    def _scan_idle(self, cameras, ffmpeg_bin):
+        """(duration, idle intervals, source) of one clip, from the front camera's telemetry or, without SEI,
+        from frame differences.  A clip that cannot be analysed counts as driving."""
+        front = cameras.get("front")
+        telemetry = load_or_extract(front) if front else None
+        if telemetry is not None:
+            try:
+                if len(telemetry):
+                    return len(telemetry) / FRAME_RATE, idle_intervals(telemetry), "telemetry"
+            finally:
+                telemetry.close()
+        path = front or next((p for p in cameras.values() if p), None)
+        result = frame_idle_intervals(ffmpeg_bin, path) if path else None
+        if result:
+            return (*result, "frames")
+        return 60.0, [], "none"
+
+    def _write_idle_decisions(self, date_str, idle_mode, speed, segments, summary, output):
+        path = os.path.join(self.output_dir, f"TeslaCam_{date_str}_condensed.json")
+        data = {"date": date_str, "mode": idle_mode, "timelapse_speed": speed if idle_mode == "timelapse" else None,
+                "output": os.path.basename(output) if output else None, **summary, "segments": segments}
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _concat_spans(self, date_str, fragments, suffix):
+        """Validates span fragments and concatenates them into TeslaCam_{date}{suffix}.mp4; None if nothing is left."""
+        if not fragments:
+            return None
+        valid_files, invalid_files = validate_fragments(fragments, self.get_ffmpeg_path("ffprobe"), self.log)
+        for tf in invalid_files:
+            self._release_fragments([tf], discard=True)
+            if os.path.exists(tf) and not (self.fragment_cache and self.fragment_cache.key_for_path(tf)):
+                os.remove(tf)
+        try:
+            return self._concat_day(date_str, valid_files, suffix=suffix) if valid_files else None
+        finally:
+            self._release_fragments(valid_files)
+
+    @staticmethod
+    def _day_progress_shares(grouped_days, total_timestamps):
+        """{date: (offset, share)} in percent: each day owns a slice of 0-100 by its clip count,
+        so scanning and rendering the days one after another never move the bar backwards."""
+        shares, offset = {}, 0.0
+        for date_str, timestamps in sorted(grouped_days.items()):
+            share = 100.0 * len(timestamps) / total_timestamps if total_timestamps else 0.0
+            shares[date_str] = (offset, share)
+            offset += share
+        return shares
+
+    @staticmethod
+    def _day_percent(day_share, fraction):
+        offset, share = day_share
+        return offset + share * fraction
+
+    def _render_spans(self, date_str, timestamps, spans, day_share, label="精彩片段"):
+        """Renders (timestamp, start, end, speed) spans of one day, one clip's spans per task so they share its overlay.
+        end=None is the whole clip at normal speed, rendered (and cached) like a regular fragment.
+        day_share: the day's (offset, share) of the overall progress.
+        Returns the fragments in span order (failed spans are left out)."""
+        by_clip = defaultdict(list)
+        for i, (ts, start, end, speed) in enumerate(spans):
+            by_clip[ts].append((i, start, end, speed))
+        results = [None] * len(spans)
+        done = 0
+        concurrency = self._create_concurrency()
+        with ThreadPoolExecutor(max_workers=concurrency.target) as executor:
+            futures = {executor.submit(self._render_clip_spans, ts, timestamps[ts], clip_spans, label): ts
+                       for ts, clip_spans in by_clip.items()}
+            for future in futures:
+                for i, fragment in future.result():
+                    results[i] = fragment
+                done += 1
+                # 当天进度的前 SCAN_PROGRESS_SHARE 是扫描，渲染占剩下的部分
+                progress = self._day_percent(day_share, SCAN_PROGRESS_SHARE + (1 - SCAN_PROGRESS_SHARE) * done / len(futures))
+                self.report_progress(f"PROGRESS:{progress:.1f}%:渲染{label} {futures[future]} ({done}/{len(futures)})",
+                                     percent=progress, stage="encode", clip=futures[future])
+        return [fragment for fragment in results if fragment]
+
+    def _render_clip_spans(self, timestamp, cameras, clip_spans, label="精彩片段"):
+        """[(span index, fragment or None)] for the spans of one clip."""
+        if self.stop_requested:
+            return []
+        if len(clip_spans) == 1 and clip_spans[0][2] is None:
+            return [(clip_spans[0][0], self.process_clip(timestamp, cameras))]
+        base_key = self._fragment_key(cameras)
+        ass_file = None
+        overlay_ready = False
+        rendered = []
         with self.lock:
-            if timestamp in self.active_tasks: del self.active_tasks[timestamp]
-        if ass_file and os.path.exists(ass_file): os.remove(ass_file)
+            self.active_tasks[timestamp] = label
+        try:
+            for i, start, end, speed in clip_spans:
+                if speed == 1:
+                    key = cache_key(base_key, "highlight", start, end) if base_key else None
+                else:
+                    key = cache_key(base_key, "timelapse", start, end, speed) if base_key else None
+                cached = self.fragment_cache.get(key, pin=True) if key else None
+                if cached:
+                    rendered.append((i, cached))
+                    continue
+                if not overlay_ready:
+                    ass_file = self._prepare_overlay(timestamp, cameras)
+                    overlay_ready = True
+                wheel_cmds = commands_path(ass_file) if ass_file and self.wheel_sprites else None
+                output = os.path.join(self.output_dir, f"temp_highlight_{timestamp}_{i}.mp4")
+                # 输出端 -ss/-t：只编码窗口内的帧，时间戳不变，字幕/方向盘叠加照样对得上
+                encoded = self._encode_grid(f"{timestamp} [{start:.0f}-{end:.0f}s]", cameras, output, ass_file, wheel_cmds,
+                                            extra_args=f"-ss {start / speed:.3f} -t {(end - start) / speed:.3f}",
+                                            speed=speed)
+                if encoded is None:
+                    break
+                if encoded:
+                    rendered.append((i, self._cache_fragment(key, output) if key else output))
+        finally:
+            with self.lock:
+                self.active_tasks.pop(timestamp, None)
+            if ass_file: remove_overlay(ass_file)
+        return rendered
+
+    def _finalize_day(self, date_str, fragments):
+        """Validates a day's fragments and concatenates them into TeslaCam_{date}.mp4."""
+        if not fragments or self.stop_requested:
+            self._release_fragments([path for _, path in fragments])
+            return None
+
+        # Chronological sort
+        daily_temp_files = [path for _, path in sorted(fragments)]
+
+        # 最终检查：核对分片是否真实存在且不是坏块
+        # 进程内读 moov 检查结构，只有看不懂的文件才调用 ffprobe；上次运行已校验过且没变的分片直接跳过
+        trusted = {p for p in daily_temp_files if self.journal and self.journal.validated(p)}
+        checked, invalid_files = validate_fragments([p for p in daily_temp_files if p not in trusted],
+                                                    self.get_ffmpeg_path("ffprobe"), self.log)
+        if self.journal:
+            if trusted:
+                self.log(f"DEBUG: {len(trusted)} fragments of {date_str} were validated by an earlier run")
+            for ts, path in fragments:
+                signature = self._timestamp_signatures.get(ts)
+                if signature and path in checked:
+                    self.journal.record_validated(signature, ts, path)
+        checked = set(checked)
+        valid_files = [p for p in daily_temp_files if p in trusted or p in checked]
+        for tf in invalid_files:
+            self.log(f"Removing invalid fragment: {os.path.basename(tf)}")
+            if self.fragment_cache and self.fragment_cache.key_for_path(tf):
+                self._release_fragments([tf], discard=True)
+            elif os.path.exists(tf): os.remove(tf)
+
+        if len(valid_files) < len(daily_temp_files):
+            self.log(f"Warning: {len(daily_temp_files) - len(valid_files)} fragments were corrupted and removed.")
+
+        if not valid_files:
+            self.log(f"Error: No valid fragments for {date_str}, skipping merge.")
+            return None
+
+        try:
+            return self._concat_day(date_str, valid_files)
+        finally:
+            self._release_fragments(valid_files)
+
+    def _concat_day(self, date_str, valid_files, suffix=""):
+        """Stream-copies the validated fragments into TeslaCam_{date}{suffix}.mp4.
+        Only the plain day file (no suffix) is recorded in the job journal."""
+        concat_list_path = os.path.join(self.output_dir, f"concat_{date_str}{suffix}.txt")
+        with open(concat_list_path, "w") as f:
+            for temp_file in valid_files:
+                f.write(f"file '{os.path.abspath(temp_file)}'\n")
+
+        final_output = os.path.join(self.output_dir, f"TeslaCam_{date_str}{suffix}.mp4")
+        self.log(f"Merging daily video for {date_str} ({len(valid_files)} clips)...")
+
+        ffmpeg_bin = self.get_ffmpeg_path("ffmpeg")
+        concat_cmd = f"\"{ffmpeg_bin}\" -y -f concat -safe 0 -i \"{concat_list_path}\" -c copy \"{final_output}\""
+        result = subprocess.run(concat_cmd, shell=True, capture_output=True, text=True)
+
+        if result.returncode == 0:
+            signature = self._day_signatures.get(date_str)
+            if self.journal and signature and not suffix:
+                self.journal.record_day(date_str, CONCATENATED, signature, final_output)
+                if not check_fragment(final_output, self.get_ffmpeg_path("ffprobe"), self.log):
+                    self.log(f"Error: {os.path.basename(final_output)} failed verification after merging.")
+                    return None
+                self.journal.record_day(date_str, VERIFIED, signature, final_output)
+            # 缓存中的分片保留给以后的任务复用，只删除输出目录里的临时分片
+            for temp_file in valid_files:
+                if self.fragment_cache and self.fragment_cache.key_for_path(temp_file):
+                    continue
+                if os.path.exists(temp_file): os.remove(temp_file)
+            if os.path.exists(concat_list_path): os.remove(concat_list_path)
+            self.log(f"Successfully created {final_output}")
+            return final_output
+        self.log(f"Failed to merge {date_str}: {result.stderr}")
         return None
 
-    def merge_all(self, sample_count=None, target_date=None):
+    def merge_all(self, sample_count=None, target_date=None, single_pass=False, highlights=False, idle_mode=None):
+        """idle_mode: None for a full merge, "drop" or "timelapse" for the condensed merge that leaves out or
+        speeds up parked footage (see idle_detection)."""
+        if idle_mode and idle_mode not in IDLE_MODES:
+            self.log(f"ERROR: idle_mode must be one of {', '.join(IDLE_MODES)}")
+            return
         os.makedirs(self.output_dir, exist_ok=True)
         self.log("Scanning videos...")
         grouped_days, total_files = self.group_videos()
@@ -251,95 +1123,77 @@ class TeslaCamMerger:
                 limited_ts = {ts: grouped_days[d][ts] for ts in sorted_ts[:sample_count]}
                 grouped_days[d] = limited_ts
 
+        # 方向盘图集要在算片段签名（render_params 含 overlay）之前定下来，否则跳过已完成日期时记下的签名和实际渲染的对不上
+        if self.wheel_sprites and not self.wheel_atlas:
+            self.wheel_atlas = ensure_atlas(self.get_ffmpeg_path("ffmpeg"), log=self.log)
+            if not self.wheel_atlas:
+                self.log("Steering wheel sprites unavailable, drawing the wheel with ASS instead.")
+                self.wheel_sprites = False
+
+        resumed_output = None
+        if self.use_journal and not highlights and not idle_mode:
+            self.journal = JobJournal(self.output_dir)
+            grouped_days, resumed_output = self._skip_finished_days(grouped_days)
+
         total_timestamps = sum(len(ts) for ts in grouped_days.values())
-        processed_count = 0
         
         self.log(f"Starting processing {total_timestamps} clips across {len(grouped_days)} days...")
 
-        last_successful_output = None
-        for date_str, timestamps in sorted(grouped_days.items()):
-            if self.stop_requested: break
-            
-            self.log(f"Processing date: {date_str} ({len(timestamps)} clips)")
-            daily_temp_files = []
-            
-            # Parallel processing for 1-minute clips
-            # 限制并发数：M 系列芯片上硬件加速建议设为 2，防止过载导致超时
-            max_workers = 2
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_ts = {executor.submit(self.process_clip, ts, cameras): ts 
-                               for ts, cameras in timestamps.items()}
-                
-                for future in as_completed(future_to_ts):
-                    if self.stop_requested: 
-                        executor.shutdown(wait=False, cancel_futures=True)
-                        break
-                    
-                    res = future.result()
-                    ts = future_to_ts[future]
-                    if res:
-                        daily_temp_files.append(res)
-                        status_text = f"完成 {ts}"
-                    else:
-                        status_text = f"失败 {ts}"
-                    
-                    processed_count += 1
-                    # Progress update
-                    progress = (processed_count / total_timestamps) * 100
-                    
-                    # 构造并行进度信息
-                    with self.lock:
-                        active_info = ";".join([f"🔥 正在处理: {k}" for k in self.active_tasks.keys()])
-                    
-                    self.log(f"PROGRESS:{progress:.1f}%:{status_text} ({processed_count}/{total_timestamps});{active_info}")
-
-            if daily_temp_files and not self.stop_requested:
-                # Chronological sort
-                daily_temp_files.sort() 
-                
-                # 最终检查：核对分片是否真实存在且不是坏块
-                valid_files = []
-                ffprobe_bin = self.get_ffmpeg_path("ffprobe")
-                for tf in daily_temp_files:
-                    # 使用 ffprobe 检查文件头是否完整
-                    check = subprocess.run([ffprobe_bin, "-v", "error", tf], capture_output=True)
-                    if check.returncode == 0:
-                        valid_files.append(tf)
-                    else:
-                        self.log(f"Removing invalid fragment: {os.path.basename(tf)}")
-                        if os.path.exists(tf): os.remove(tf)
-
-                if len(valid_files) < len(daily_temp_files):
-                    self.log(f"Warning: {len(daily_temp_files) - len(valid_files)} fragments were corrupted and removed.")
-                
-                if not valid_files:
-                    self.log(f"Error: No valid fragments for {date_str}, skipping merge.")
-                    continue
+        if self.encoder_probe is None:
+            self.probe_encoders()
 
-                concat_list_path = os.path.join(self.output_dir, f"concat_{date_str}.txt")
-                with open(concat_list_path, "w") as f:
-                    for temp_file in valid_files:
-                        f.write(f"file '{os.path.abspath(temp_file)}'\n")
-                
-                final_output = os.path.join(self.output_dir, f"TeslaCam_{date_str}.mp4")
-                self.log(f"Merging daily video for {date_str} ({len(valid_files)} clips)...")
-                
-                ffmpeg_bin = self.get_ffmpeg_path("ffmpeg")
-                concat_cmd = f"\"{ffmpeg_bin}\" -y -f concat -safe 0 -i \"{concat_list_path}\" -c copy \"{final_output}\""
-                result = subprocess.run(concat_cmd, shell=True, capture_output=True, text=True)
-                
-                if result.returncode == 0:
-                    for temp_file in daily_temp_files:
-                        if os.path.exists(temp_file): os.remove(temp_file)
-                    if os.path.exists(concat_list_path): os.remove(concat_list_path)
-                    self.log(f"Successfully created {final_output}")
-                    last_successful_output = final_output
-                else:
-                    self.log(f"Failed to merge {date_str}: {result.stderr}")
+        if self.render_pool and not single_pass and not highlights:
+            healthy = self.render_pool.check_health(force=True)
+            self.log(f"Render workers: {healthy}/{len(self.render_pool.workers)} online, capacity {self.render_pool.capacity}")
+
+        if highlights:
+            last_successful_output = self._merge_days_highlights(grouped_days, total_timestamps)
+        elif idle_mode:
+            last_successful_output = self._merge_days_condensed(grouped_days, total_timestamps, idle_mode)
+        elif single_pass:
+            last_successful_output = self._merge_days_single_pass(grouped_days, total_timestamps)
+        else:
+            last_successful_output = self._merge_days_pipelined(grouped_days, total_timestamps)
+        last_successful_output = last_successful_output or resumed_output
+
+        filler = os.path.join(self.output_dir, "temp_filler_black.mp4")
+        if os.path.exists(filler): os.remove(filler)
+
+        if self.fragment_cache:
+            self.fragment_cache.save()
+            cs = self.fragment_cache.stats()
+            self.log(f"Fragment cache: {cs['hits']} hits, {cs['misses']} misses, {cs['evictions']} evicted, "
+                     f"{cs['entries']} entries / {cs['bytes'] / 1024 ** 3:.2f} GB of {cs['max_bytes'] / 1024 ** 3:.1f} GB "
+                     f"in {self.fragment_cache.root}")
 
         self.log("COMPLETED:Processing finished.")
         return last_successful_output
 
+    def _skip_finished_days(self, grouped_days):
+        """Drops the days whose merged file an earlier run already wrote and verified from exactly these clips.
+        Returns (remaining days, the last skipped day's output)."""
+        remaining, last_output = {}, None
+        for date_str, timestamps in sorted(grouped_days.items()):
+            if not timestamps:
+                remaining[date_str] = timestamps
+                continue
+            signature = day_signature(self._clip_signature(cameras) for cameras in timestamps.values())
+            self._day_signatures[date_str] = signature
+            output = self.journal.day_output(date_str, signature)
+            if not output:
+                # 拼好了但没来得及校验：补一次校验就行
+                output = self.journal.day_output(date_str, signature, state=CONCATENATED)
+                if output and check_fragment(output, self.get_ffmpeg_path("ffprobe"), self.log):
+                    self.journal.record_day(date_str, VERIFIED, signature, output)
+                else:
+                    output = None
+            if output:
+                self.log(f"Resuming: {date_str} was already merged into {os.path.basename(output)}, skipping.")
+                last_output = output
+            else:
+                remaining[date_str] = timestamps
+        return remaining, last_output
+
     def stop(self):
         self.stop_requested = True
 
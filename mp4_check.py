@@ -0,0 +1,190 @@
+"""In-process structural check of MP4 fragments.
+
+Every fragment used to be validated with `ffprobe -v error` (once when a
+leftover temp file is reused, once more before the daily concat), i.e. one
+process launch per minute of footage.  `inspect_mp4` reads only the box
+headers and the small tables inside `moov` (a few KB per file) and checks
+what the concat step actually needs: the top-level boxes add up to the file
+size (nothing truncated), there is an `mdat` with data, and `moov` has a
+video track with a known codec, samples, a duration and chunk offsets that
+point into the file.
+
+Files that are clearly broken are rejected outright; files the reader does
+not fully understand (unknown codec, odd box layout) are "suspect" and
+`validate_fragments` hands only those to ffprobe.
+"""
+import os
+import struct
+import subprocess
+
+OK = "ok"
+BAD = "bad"
+SUSPECT = "suspect"
+
+# 我们自己编码出来的分片只会是这几种；其他编码交给 ffprobe 判断
+KNOWN_VIDEO_CODECS = {"avc1", "avc3", "hvc1", "hev1"}
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts", b"dinf"}
+MAX_TABLE_BYTES = 16 * 1024 * 1024  # stco/co64 再大就不是一分钟的分片了
+
+
+class Mp4Error(Exception):
+    pass
+
+
+def _boxes(fp, start, end):
+    """Yields (type, payload_offset, box_end) for the boxes between start and end."""
+    pos = start
+    while pos + 8 <= end:
+        fp.seek(pos)
+        size32, box_type = struct.unpack(">I4s", fp.read(8))
+        header_size = 8
+        if size32 == 1:
+            large = fp.read(8)
+            if len(large) != 8:
+                raise Mp4Error("truncated box header")
+            box_size = struct.unpack(">Q", large)[0]
+            header_size = 16
+        elif size32 == 0:
+            box_size = end - pos
+        else:
+            box_size = size32
+        if box_size < header_size:
+            raise Mp4Error(f"invalid size for box {box_type!r}")
+        if pos + box_size > end:
+            raise Mp4Error(f"box {box_type.decode('latin-1')} runs past the end ({pos + box_size} > {end})")
+        yield box_type, pos + header_size, pos + box_size
+        pos += box_size
+    if pos != end:
+        raise Mp4Error(f"{end - pos} trailing bytes")
+
+
+def _read(fp, offset, length):
+    fp.seek(offset)
+    data = fp.read(length)
+    if len(data) != length:
+        raise Mp4Error("truncated box payload")
+    return data
+
+
+def _track(fp, start, end, file_size):
+    """Reads the fields of one trak box that matter for concat."""
+    track = {"handler": None, "codec": None, "duration": None, "samples": 0, "chunks": 0}
+    stack = [(start, end)]
+    while stack:
+        s, e = stack.pop()
+        for box_type, payload, box_end in _boxes(fp, s, e):
+            if box_type in CONTAINER_BOXES:
+                stack.append((payload, box_end))
+            elif box_type == b"mdhd":
+                version = _read(fp, payload, 1)[0]
+                if version == 1:
+                    timescale, duration = struct.unpack(">IQ", _read(fp, payload + 20, 12))
+                else:
+                    timescale, duration = struct.unpack(">II", _read(fp, payload + 12, 8))
+                track["duration"] = duration / timescale if timescale else None
+            elif box_type == b"hdlr":
+                track["handler"] = _read(fp, payload + 8, 4).decode("latin-1")
+            elif box_type == b"stsd":
+                count = struct.unpack(">I", _read(fp, payload + 4, 4))[0]
+                if count:
+                    track["codec"] = _read(fp, payload + 12, 4).decode("latin-1")
+            elif box_type == b"stsz":
+                track["samples"] = struct.unpack(">I", _read(fp, payload + 8, 4))[0]
+            elif box_type in (b"stco", b"co64"):
+                count = struct.unpack(">I", _read(fp, payload + 4, 4))[0]
+                width = 4 if box_type == b"stco" else 8
+                if count * width > min(box_end - payload - 8, MAX_TABLE_BYTES):
+                    raise Mp4Error("chunk offset table larger than its box")
+                if count:
+                    offsets = struct.unpack(f">{count}{'I' if width == 4 else 'Q'}", _read(fp, payload + 8, count * width))
+                    if max(offsets) >= file_size:
+                        raise Mp4Error("chunk offset points past the end of the file")
+                track["chunks"] = count
+    return track
+
+
+def inspect_mp4(path):
+    """Structural summary of an MP4 file:
+    {"verdict", "reason", "duration", "tracks": [{"handler", "codec", "duration", "samples", "chunks"}]}."""
+    info = {"verdict": BAD, "reason": None, "duration": None, "tracks": []}
+    try:
+        with open(path, "rb") as fp:
+            file_size = os.fstat(fp.fileno()).st_size
+            top = {}
+            for box_type, payload, box_end in _boxes(fp, 0, file_size):
+                top.setdefault(box_type, (payload, box_end))
+            for required in (b"ftyp", b"moov", b"mdat"):
+                if required not in top:
+                    info["reason"] = f"no {required.decode()} box"
+                    return info
+            mdat_start, mdat_end = top[b"mdat"]
+            if mdat_end <= mdat_start:
+                info["reason"] = "empty mdat"
+                return info
+
+            moov_start, moov_end = top[b"moov"]
+            for box_type, payload, box_end in _boxes(fp, moov_start, moov_end):
+                if box_type == b"mvhd":
+                    version = _read(fp, payload, 1)[0]
+                    if version == 1:
+                        timescale, duration = struct.unpack(">IQ", _read(fp, payload + 20, 12))
+                    else:
+                        timescale, duration = struct.unpack(">II", _read(fp, payload + 12, 8))
+                    info["duration"] = duration / timescale if timescale else None
+                elif box_type == b"trak":
+                    info["tracks"].append(_track(fp, payload, box_end, file_size))
+    except (OSError, struct.error, Mp4Error) as e:
+        info["reason"] = str(e)
+        return info
+
+    video = [t for t in info["tracks"] if t["handler"] == "vide"]
+    if not video:
+        info["reason"] = "no video track"
+        return info
+    if not any(t["samples"] and t["chunks"] for t in video):
+        info["reason"] = "video track has no samples"
+        return info
+    info["verdict"] = OK
+    if not info["duration"]:
+        info.update(verdict=SUSPECT, reason="zero duration in mvhd")
+    elif any(t["codec"] not in KNOWN_VIDEO_CODECS for t in video):
+        info.update(verdict=SUSPECT, reason=f"unexpected codec {video[0]['codec']}")
+    return info
+
+
+def _ffprobe_ok(path, ffprobe_bin):
+    try:
+        return subprocess.run([ffprobe_bin, "-v", "error", path], capture_output=True, timeout=60).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def check_fragment(path, ffprobe_bin="ffprobe", log=None):
+    """True if path looks like a complete MP4; ffprobe is only spawned for suspect files."""
+    info = inspect_mp4(path)
+    if info["verdict"] == SUSPECT:
+        if log:
+            log(f"DEBUG: {os.path.basename(path)}: {info['reason']}, asking ffprobe")
+        return _ffprobe_ok(path, ffprobe_bin)
+    if info["verdict"] == BAD and log:
+        log(f"DEBUG: {os.path.basename(path)} is invalid: {info['reason']}")
+    return info["verdict"] == OK
+
+
+def validate_fragments(paths, ffprobe_bin="ffprobe", log=None):
+    """Checks a day's fragments in one pass. Returns (valid, invalid) in input order.
+    Only the suspect ones cost an ffprobe launch."""
+    valid, invalid, suspects = [], [], 0
+    for path in paths:
+        info = inspect_mp4(path)
+        if info["verdict"] == SUSPECT:
+            suspects += 1
+            ok = _ffprobe_ok(path, ffprobe_bin)
+        else:
+            ok = info["verdict"] == OK
+        if not ok and log:
+            log(f"DEBUG: {os.path.basename(path)} is invalid: {info['reason']}")
+        (valid if ok else invalid).append(path)
+    if suspects and log:
+        log(f"DEBUG: {suspects} of {len(paths)} fragments needed ffprobe")
+    return valid, invalid
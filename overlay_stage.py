@@ -0,0 +1,125 @@
+"""SEI telemetry extraction as a separate pipeline stage.
+
+The parser is pure Python, so running it on the encoder threads makes it
+compete for the GIL.  `OverlayStage` runs it in a process pool and is fed
+ahead of the encoders, so the .ass overlay for clip N+k is usually ready
+by the time an encoder slot frees up.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dashcam_parser import DashcamParser
+from telemetry_store import load_or_extract
+from wheel_sprites import write_commands, commands_path
+
+
+def extract_overlay(front_path, ass_path, timestamp, wheel_sprites=False):
+    """Worker entry point (module level so it can be pickled). Returns ass_path or None.
+    Telemetry comes from the columnar cache, so a clip is only parsed once across runs.
+    With wheel_sprites the .ass only holds the text and the wheel goes to a sendcmd file next to it."""
+    try:
+        telemetry = load_or_extract(front_path)
+        if telemetry is None:
+            return None
+        parser = DashcamParser()
+        spans = [] if wheel_sprites else None
+        if parser.write_ass(telemetry.rows(), ass_path, timestamp, wheel_spans=spans):
+            if wheel_sprites:
+                write_commands(spans, commands_path(ass_path), parser.steering_quantum)
+            return ass_path
+    except Exception:
+        pass
+    return None
+
+
+def remove_overlay(ass_path):
+    """Deletes an overlay and its wheel sendcmd file, if any."""
+    for path in (ass_path, commands_path(ass_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class OverlayStage:
+    def __init__(self, output_dir, max_workers=None, log=None, wheel_sprites=False):
+        self.output_dir = output_dir
+        self.wheel_sprites = wheel_sprites
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 2) // 2))
+        self.log = log or (lambda message: None)
+        self.lock = threading.Lock()
+        self.futures = {}  # timestamp -> Future
+        self.executor = None
+        self.broken = False
+
+    def _ass_path(self, timestamp):
+        return os.path.join(self.output_dir, f"sei_data_{timestamp}.ass")
+
+    def _get_executor(self):
+        if self.executor is None and not self.broken:
+            try:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            except (OSError, NotImplementedError) as e:
+                self.log(f"DEBUG: SEI process pool unavailable ({e}), extracting inline")
+                self.broken = True
+        return self.executor
+
+    def submit(self, timestamp, cameras):
+        """Queues extraction for a clip (no-op without a front camera or if already queued)."""
+        front = cameras.get("front")
+        if not front:
+            return
+        with self.lock:
+            if timestamp in self.futures:
+                return
+            executor = self._get_executor()
+            if executor is None:
+                return
+            try:
+                self.futures[timestamp] = executor.submit(extract_overlay, front, self._ass_path(timestamp), timestamp,
+                                                           self.wheel_sprites)
+            except (BrokenProcessPool, RuntimeError):
+                self.broken = True
+
+    def result(self, timestamp, cameras):
+        """Blocks until the overlay for timestamp is ready. Returns the .ass path or None."""
+        front = cameras.get("front")
+        if not front:
+            return None
+        self.submit(timestamp, cameras)
+        with self.lock:
+            future = self.futures.pop(timestamp, None)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as e:
+                self.log(f"DEBUG: SEI worker failed for {timestamp}: {e}, extracting inline")
+        return extract_overlay(front, self._ass_path(timestamp), timestamp, self.wheel_sprites)
+
+    def discard(self, timestamp):
+        """Drops a prefetched overlay that is no longer needed (e.g. the fragment was cached)."""
+        with self.lock:
+            future = self.futures.pop(timestamp, None)
+        if future is None or future.cancel():
+            return
+        future.add_done_callback(lambda f: self._remove(f))
+
+    def _remove(self, future):
+        try:
+            path = future.result()
+        except Exception:
+            return
+        if path:
+            remove_overlay(path)
+
+    def shutdown(self):
+        """Cancels queued work and removes overlays that were prefetched but never used."""
+        with self.lock:
+            leftovers = list(self.futures.items())
+            self.futures.clear()
+        for _, future in leftovers:
+            if not future.cancel():
+                future.add_done_callback(lambda f: self._remove(f))
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,155 @@
+"""Structured progress events for the merger and the web UI.
+
+The merger historically reports through strings such as
+`PROGRESS:12.3%:完成 ...;🔥 正在处理: ...`, which the backend re-parsed and
+pushed into one asyncio queue per SSE client for every single line,
+ffmpeg command lines included.  `EventBus` keeps the last N events in a
+ring buffer (a deque, so trimming is O(1)), tags each with a level and a
+sequence number, and lets readers pull "everything after seq N" at their own
+pace.  The SSE endpoint polls it at a fixed rate and only forwards the latest
+progress event per tick (`coalesce`), so a large batch costs the event loop
+and the browser a few messages per second no matter how chatty the merger is.
+
+The bus is callable, so it can be passed anywhere a `progress_callback`
+is expected; plain strings are classified by `event_from_message`.
+"""
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+LEVEL_NAMES = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+
+def parse_level(name, default=INFO):
+    return LEVEL_NAMES.get(str(name or "").lower(), default)
+
+
+@dataclass
+class Event:
+    kind: str  # "log" | "progress" | "completed"
+    message: str  # 旧格式的原始文本，老前端直接用它
+    level: int = INFO
+    seq: int = 0
+    time: float = 0.0
+    percent: Optional[float] = None
+    stage: Optional[str] = None  # "scan" | "encode" | "single_pass" | "concat"
+    clip: Optional[str] = None
+    fps: Optional[float] = None
+    clips_per_minute: Optional[float] = None
+    bytes: Optional[int] = None
+    eta: Optional[float] = None  # seconds
+    active: List[str] = field(default_factory=list)
+    job: Optional[str] = None  # 后端任务队列里的任务 id
+
+    def to_dict(self):
+        data = {k: v for k, v in asdict(self).items() if v is not None}
+        data["level"] = logging.getLevelName(self.level).lower()
+        return data
+
+
+def event_from_message(message):
+    """Classifies a legacy progress string."""
+    if message.startswith("PROGRESS:"):
+        _, _, rest = message.partition(":")
+        percent_text, _, detail = rest.partition(":")
+        try:
+            percent = float(percent_text.replace("%", ""))
+        except ValueError:
+            percent = None
+        parts = detail.split(";")
+        active = [p.split(": ", 1)[-1] for p in parts[1:] if p]
+        return Event("progress", message, percent=percent, active=active)
+    if message.startswith("COMPLETED:"):
+        return Event("completed", message, percent=100.0)
+    if message.startswith("DEBUG:"):
+        return Event("log", message, level=DEBUG)
+    if "Error" in message or "CRITICAL" in message or "Failed" in message:
+        return Event("log", message, level=ERROR)
+    if message.startswith("Warning") or "WARNING" in message:
+        return Event("log", message, level=WARNING)
+    return Event("log", message)
+
+
+class EventBus:
+    def __init__(self, capacity=2000, echo=None):
+        self._events = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._progress = None
+        self.echo = echo
+
+    def __call__(self, message):
+        self.emit(message)
+
+    def emit(self, message, **fields):
+        """Publishes a legacy string; keyword fields (kind, percent, stage, ...) override what parsing finds."""
+        event = event_from_message(message)
+        for key, value in fields.items():
+            setattr(event, key, value)
+        return self.publish(event)
+
+    def publish(self, event):
+        with self._lock:
+            self._seq += 1
+            event.seq = self._seq
+            event.time = time.time()
+            self._events.append(event)
+            if event.kind in ("progress", "completed"):
+                self._progress = event
+        if self.echo:
+            self.echo(event)
+        return event
+
+    @property
+    def seq(self):
+        return self._seq
+
+    @property
+    def progress(self):
+        """The most recent progress (or completion) event, None before the first one."""
+        return self._progress
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()
+            self._progress = None
+
+    def since(self, seq, min_level=INFO):
+        """(events newer than seq at or above min_level, current seq, events lost to the ring buffer)."""
+        with self._lock:
+            current = self._seq
+            if seq >= current:
+                return [], current, 0
+            newer = []
+            for event in reversed(self._events):
+                if event.seq <= seq:
+                    break
+                newer.append(event)
+            oldest = newer[-1].seq if newer else current + 1
+        dropped = max(0, oldest - seq - 1) if seq else 0
+        newer.reverse()
+        return [e for e in newer if e.level >= min_level or e.kind != "log"], current, dropped
+
+    def recent(self, limit=50, min_level=INFO, kinds=None):
+        """The last `limit` events at or above min_level, optionally only of the given kinds."""
+        with self._lock:
+            events = list(self._events)
+        selected = [e for e in events if (e.level >= min_level or e.kind != "log") and (not kinds or e.kind in kinds)]
+        return selected[-limit:] if limit else selected
+
+
+def coalesce(events):
+    """Keeps every log/completion event but only the last progress event of a batch (in its original position)."""
+    last_progress = None
+    for i, event in enumerate(events):
+        if event.kind == "progress":
+            last_progress = i
+    return [e for i, e in enumerate(events) if e.kind != "progress" or i == last_progress]
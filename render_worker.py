@@ -0,0 +1,371 @@
+"""Render clips on other machines: an HTTP worker around process_clip and the coordinator's pool.
+
+Worker (one per machine, needs fastapi + uvicorn like backend.py):
+
+    python render_worker.py --port 8790 --work-dir /tmp/teslacam_worker --token SECRET --source-root /mnt/teslacam
+
+Coordinator:
+
+    pool = RenderWorkerPool(["http://10.0.0.5:8790", "http://10.0.0.6:8790"], token="SECRET")
+    TeslaCamMerger(source, output, render_pool=pool).merge_all()
+
+Every request carries the shared secret in the X-Render-Token header (both
+sides also read it from TESLACAM_WORKER_TOKEN); the worker refuses to start
+without one and answers 401 to anything else.  The worker only reads source
+files in place under --source-root; any other path counts as missing and has
+to be uploaded, so a client can never make it render an arbitrary local file.
+
+Protocol (stdlib urllib on the coordinator side, no multipart):
+
+    GET  /health                    -> {"render_version", "capacity", "in_flight", "encoders"}
+    POST /clips                     {"timestamp", "cameras": {cam: {"path", "size"}}, "params"}
+                                    -> {"id", "missing": [cams the worker cannot read at that path]}
+    PUT  /clips/{id}/{camera}       raw file body, only for the missing cameras
+    POST /clips/{id}/render         -> the fragment (video/mp4), 500 with the error otherwise
+    DELETE /clips/{id}
+
+Workers that share the footage (NAS mount at the same path, inside their
+--source-root) skip the upload.
+The coordinator checks health lazily, never gives a worker more clips than
+its encoder capacity, retries a failed clip on another worker and returns
+False when no worker could render it, so merge_all encodes that clip locally.
+Fragments are validated with mp4_check before they are used.
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import uuid
+import shutil
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+from mp4_check import check_fragment
+
+HEALTH_INTERVAL_S = 30.0  # 健康检查结果的有效期；不健康的 worker 过了这段时间再重试
+FAILURE_THRESHOLD = 2  # 连续失败次数达到后，在下次健康检查前不再派活
+UPLOAD_CHUNK = 1024 * 1024
+TOKEN_HEADER = "X-Render-Token"
+TOKEN_ENV = "TESLACAM_WORKER_TOKEN"
+
+# 这些渲染参数不同，两边渲染出的分片就对不上
+PARAMS_MUST_MATCH = ("version", "layout", "bitrate", "fps")
+
+
+class WorkerError(Exception):
+    def __init__(self, message, retryable=True, unhealthy=False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.unhealthy = unhealthy
+
+
+class RenderWorkerPool:
+    def __init__(self, urls, timeout=900, retries=2, health_interval=HEALTH_INTERVAL_S, log=None, token=None):
+        self.workers = [{"url": url.rstrip("/"), "healthy": False, "capacity": 0, "in_flight": 0, "failures": 0,
+                         "checked_at": 0.0, "rendered": 0, "error": None} for url in urls]
+        self.timeout = timeout
+        self.retries = retries
+        self.health_interval = health_interval
+        self.log = log or (lambda message: None)
+        self.token = token or os.environ.get(TOKEN_ENV)
+        self._lock = threading.Lock()
+        self.render_version = None
+
+    # --- health ---
+
+    def _check(self, worker):
+        request = urllib.request.Request(f"{worker['url']}/health", headers=self._auth())
+        try:
+            with urllib.request.urlopen(request, timeout=5) as resp:
+                info = json.load(resp)
+        except (OSError, ValueError) as e:
+            return False, 0, str(e)
+        if self.render_version is not None and info.get("render_version") != self.render_version:
+            return False, 0, f"render version {info.get('render_version')} != {self.render_version}"
+        return True, max(1, int(info.get("capacity", 1))), None
+
+    def check_health(self, force=False):
+        """Refreshes stale health entries (all of them with force=True). Returns the healthy count."""
+        now = time.monotonic()
+        with self._lock:
+            due = [w for w in self.workers if force or now - w["checked_at"] >= self.health_interval]
+        for worker in due:
+            healthy, capacity, error = self._check(worker)
+            with self._lock:
+                was_healthy = worker["healthy"]
+                worker.update(healthy=healthy, capacity=capacity, error=error, checked_at=time.monotonic(),
+                              failures=0 if healthy else worker["failures"])
+            if healthy != was_healthy:
+                self.log(f"Render worker {worker['url']} {'online, capacity ' + str(capacity) if healthy else 'offline: ' + str(error)}")
+        with self._lock:
+            return sum(1 for w in self.workers if w["healthy"])
+
+    @property
+    def capacity(self):
+        """Clips the healthy workers can take at once."""
+        with self._lock:
+            return sum(w["capacity"] for w in self.workers if w["healthy"])
+
+    def snapshot(self):
+        with self._lock:
+            return [{k: w[k] for k in ("url", "healthy", "capacity", "in_flight", "rendered", "error")} for w in self.workers]
+
+    # --- dispatch ---
+
+    def _acquire(self, exclude):
+        self.check_health()
+        with self._lock:
+            free = [w for w in self.workers if w["healthy"] and w["url"] not in exclude and w["in_flight"] < w["capacity"]]
+            if not free:
+                return None
+            worker = min(free, key=lambda w: w["in_flight"] / w["capacity"])
+            worker["in_flight"] += 1
+            return worker
+
+    def _release(self, worker, error=None):
+        with self._lock:
+            worker["in_flight"] -= 1
+            if error is None:
+                worker["failures"] = 0
+                worker["rendered"] += 1
+                return
+            worker["failures"] += 1
+            worker["error"] = str(error)
+            if error.unhealthy or worker["failures"] >= FAILURE_THRESHOLD:
+                worker["healthy"] = False
+                worker["checked_at"] = time.monotonic()
+
+    def render(self, timestamp, cameras, params, dest, should_stop=None):
+        """Renders one clip remotely into dest. False if no worker was free or every attempt failed."""
+        tried = set()
+        for _ in range(self.retries + 1):
+            if should_stop and should_stop():
+                return False
+            worker = self._acquire(tried)
+            if not worker:
+                return False
+            tried.add(worker["url"])
+            try:
+                self._render_on(worker, timestamp, cameras, params, dest)
+            except WorkerError as e:
+                self._release(worker, e)
+                self.log(f"Render worker {worker['url']} failed {timestamp}: {e}")
+                if os.path.exists(dest):
+                    os.remove(dest)
+                if not e.retryable:
+                    return False
+                continue
+            self._release(worker)
+            return True
+        return False
+
+    def _auth(self):
+        return {TOKEN_HEADER: self.token} if self.token else {}
+
+    def _request(self, url, data=None, method="GET", headers=None, timeout=60):
+        request = urllib.request.Request(url, data=data, method=method, headers={**self._auth(), **(headers or {})})
+        try:
+            return urllib.request.urlopen(request, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            detail = e.read()[:300].decode("utf-8", "replace")
+            # 409: 参数不一致，换哪个 worker 都一样；5xx: 这次渲染失败，可以换一台重试；401: 令牌不对，别再派活
+            raise WorkerError(f"HTTP {e.code}: {detail}", retryable=e.code >= 500, unhealthy=e.code == 401)
+        except OSError as e:
+            raise WorkerError(str(e), unhealthy=True)
+
+    def manifest(self, timestamp, cameras, params):
+        """What the worker gets before any upload; it reads cameras directly when the path exists there too."""
+        return {"timestamp": timestamp, "params": params,
+                "cameras": {cam: {"path": os.path.abspath(path), "size": os.path.getsize(path)}
+                            for cam, path in cameras.items()}}
+
+    def _render_on(self, worker, timestamp, cameras, params, dest):
+        base = worker["url"]
+        manifest = self.manifest(timestamp, cameras, params)
+        with self._request(f"{base}/clips", json.dumps(manifest).encode("utf-8"), "POST",
+                           {"Content-Type": "application/json"}) as resp:
+            clip = json.load(resp)
+        clip_url = f"{base}/clips/{clip['id']}"
+        try:
+            for cam in clip.get("missing", []):
+                with open(cameras[cam], "rb") as f:
+                    self._request(f"{clip_url}/{cam}", f, "PUT",
+                                  {"Content-Length": str(manifest["cameras"][cam]["size"]),
+                                   "Content-Type": "application/octet-stream"}, timeout=self.timeout).close()
+            part = dest + ".part"
+            with self._request(f"{clip_url}/render", b"", "POST", timeout=self.timeout) as resp, open(part, "wb") as out:
+                shutil.copyfileobj(resp, out, UPLOAD_CHUNK)
+            os.replace(part, dest)
+        finally:
+            try:
+                self._request(clip_url, method="DELETE", timeout=10).close()
+            except WorkerError:
+                pass
+        if not check_fragment(dest):
+            raise WorkerError("returned fragment is not a valid MP4")
+
+
+def create_app(work_dir, token, source_root=None, log=print):
+    """The worker's FastAPI app. Each clip is rendered by its own TeslaCamMerger in its own folder
+    (so leftover temp files of one clip can never be reused for another); they share encoder slots.
+    token: the shared secret every request must carry. source_root: the only folder whose files are
+    read in place (None: everything is uploaded)."""
+    from fastapi import FastAPI, HTTPException, Request
+    from fastapi.responses import FileResponse, JSONResponse
+    from starlette.background import BackgroundTask
+
+    from encoder_pool import EncoderSlots, EncoderHealth
+    from merge_tesla_cam import TeslaCamMerger, RENDER_VERSION
+    from wheel_sprites import ensure_atlas
+
+    if not token:
+        raise ValueError("a render worker needs a shared token")
+    app = FastAPI()
+    root = os.path.realpath(source_root) if source_root else None
+    clips_dir = os.path.join(work_dir, "clips")
+    os.makedirs(clips_dir, exist_ok=True)
+    shared = {"slots": EncoderSlots(), "health": EncoderHealth(), "atlas": None, "in_flight": 0}
+    clips = {}
+    lock = threading.Lock()
+
+    def new_merger(clip_dir, wheel_sprites=False):
+        merger = TeslaCamMerger(clip_dir, clip_dir, log, encoder_slots=shared["slots"], encoder_health=shared["health"],
+                                use_fragment_cache=False, use_source_index=False, wheel_sprites=wheel_sprites)
+        merger.encoder_probe = shared.get("probe")
+        return merger
+
+    reference = new_merger(clips_dir)
+    shared["probe"] = reference.probe_encoders()
+
+    def capacity():
+        return reference.encoder_slots.limit(reference._usable_encoders()[0])
+
+    @app.middleware("http")
+    async def require_token(request, call_next):
+        if not hmac.compare_digest(request.headers.get(TOKEN_HEADER, "").encode("utf-8"), token.encode("utf-8")):
+            return JSONResponse({"detail": "missing or wrong render token"}, status_code=401)
+        return await call_next(request)
+
+    def shared_path(path):
+        """The real path if it is a file under source_root, else None (the client has to upload it)."""
+        if not root or not path:
+            return None
+        real = os.path.realpath(path)
+        if os.path.commonpath([real, root]) != root or not os.path.isfile(real):
+            return None
+        return real
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok", "render_version": RENDER_VERSION, "capacity": capacity(),
+                "in_flight": shared["in_flight"], "encoders": shared["probe"]}
+
+    @app.post("/clips")
+    def create_clip(manifest: dict):
+        own = json.loads(json.dumps(reference.render_params()))  # 元组 -> 列表，和收到的 JSON 可比
+        params = manifest.get("params") or {}
+        mismatch = [k for k in PARAMS_MUST_MATCH if params.get(k) != own[k]]
+        if mismatch:
+            raise HTTPException(409, f"render parameters differ: {', '.join(mismatch)}")
+        clip_id = uuid.uuid4().hex
+        clip_dir = os.path.join(clips_dir, clip_id)
+        os.makedirs(clip_dir)
+        cameras, missing = {}, []
+        for cam, src in manifest["cameras"].items():
+            # 只认 source_root 下的文件（解析符号链接后），其余一律要求上传
+            path = shared_path(src.get("path"))
+            if path and os.path.getsize(path) == src.get("size"):
+                cameras[cam] = path  # 共享存储上同一路径可读，直接用
+            else:
+                cameras[cam] = os.path.join(clip_dir, f"{manifest['timestamp']}-{cam}.mp4")
+                missing.append(cam)
+        with lock:
+            clips[clip_id] = {"dir": clip_dir, "timestamp": manifest["timestamp"], "cameras": cameras,
+                              "sizes": {cam: src.get("size") for cam, src in manifest["cameras"].items()},
+                              "wheel_sprites": params.get("overlay") == "ass+wheel_sprites"}
+        return {"id": clip_id, "missing": missing}
+
+    def get_clip(clip_id):
+        with lock:
+            clip = clips.get(clip_id)
+        if not clip:
+            raise HTTPException(404, "unknown clip")
+        return clip
+
+    @app.put("/clips/{clip_id}/{camera}")
+    async def upload(clip_id: str, camera: str, request: Request):
+        clip = get_clip(clip_id)
+        if camera not in clip["cameras"] or not clip["cameras"][camera].startswith(clip["dir"]):
+            raise HTTPException(400, "unexpected camera")
+        path = clip["cameras"][camera]
+        with open(path + ".part", "wb") as f:
+            async for chunk in request.stream():
+                f.write(chunk)
+        if os.path.getsize(path + ".part") != clip["sizes"][camera]:
+            os.remove(path + ".part")
+            raise HTTPException(400, "incomplete upload")
+        os.replace(path + ".part", path)
+        return {"status": "ok"}
+
+    def cleanup(clip_id):
+        with lock:
+            clip = clips.pop(clip_id, None)
+        if clip:
+            shutil.rmtree(clip["dir"], ignore_errors=True)
+
+    @app.post("/clips/{clip_id}/render")
+    def render(clip_id: str):
+        clip = get_clip(clip_id)
+        for cam, path in clip["cameras"].items():
+            if not os.path.exists(path):
+                raise HTTPException(400, f"{cam} was not uploaded")
+        if clip["wheel_sprites"] and not shared["atlas"]:
+            shared["atlas"] = ensure_atlas(reference.get_ffmpeg_path("ffmpeg"), log=log)
+        merger = new_merger(clip["dir"], wheel_sprites=clip["wheel_sprites"] and bool(shared["atlas"]))
+        merger.wheel_atlas = shared["atlas"]
+        with lock:
+            shared["in_flight"] += 1
+        try:
+            fragment = merger.process_clip(clip["timestamp"], clip["cameras"])
+        finally:
+            with lock:
+                shared["in_flight"] -= 1
+        if not fragment:
+            cleanup(clip_id)
+            raise HTTPException(500, f"rendering {clip['timestamp']} failed")
+        return FileResponse(fragment, media_type="video/mp4", background=BackgroundTask(cleanup, clip_id))
+
+    @app.delete("/clips/{clip_id}")
+    def delete(clip_id: str):
+        cleanup(clip_id)
+        return {"status": "ok"}
+
+    return app
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=8790)
+    ap.add_argument("--work-dir", help="scratch folder for uploads and fragments (default: a temp dir)")
+    ap.add_argument("--token", default=os.environ.get(TOKEN_ENV),
+                    help=f"shared secret clients must send in {TOKEN_HEADER} (default: ${TOKEN_ENV})")
+    ap.add_argument("--source-root", help="shared footage folder whose files may be read in place (default: none, "
+                                          "every camera file is uploaded)")
+    args = ap.parse_args(argv)
+    if not args.token:
+        ap.error(f"--token (or {TOKEN_ENV}) is required")
+
+    import uvicorn
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="teslacam_worker_")
+    uvicorn.run(create_app(work_dir, args.token, args.source_root), host=args.host, port=args.port,
+                log_level="warning")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""Persistent index of the TeslaCam clips under a source folder.
+
+`group_videos` used to `os.walk` the whole source on every call, i.e. on
+every calendar click in the UI.  `SourceIndex` keeps date -> timestamp ->
+camera -> (path, size, mtime) in SQLite under ~/.teslacam_merger and
+refreshes incrementally: a directory is only listed again when its own
+mtime changed (a file or subfolder was added, removed or renamed), so an
+unchanged archive costs one stat() per folder instead of one per file.
+
+Files rewritten in place keep their directory mtime; their size/mtime in
+the index is refreshed the next time the folder changes.
+"""
+import os
+import time
+import sqlite3
+import threading
+from contextlib import closing
+
+from disk_cache import DATA_DIR
+
+INDEX_PATH = os.path.join(DATA_DIR, "source_index.sqlite3")
+SCHEMA_VERSION = 1  # bump when the tables change; the index is simply rebuilt
+
+# FAT/exFAT 的 mtime 精度是 2 秒：扫描前后 2 秒内改过的目录下次仍要重新列出
+MTIME_SLACK_S = 2.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    parent TEXT,
+    mtime_ns INTEGER,
+    scanned_at REAL,
+    PRIMARY KEY (root, path)
+);
+CREATE TABLE IF NOT EXISTS clips (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    date TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    camera TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    PRIMARY KEY (root, path)
+);
+CREATE INDEX IF NOT EXISTS clips_by_date ON clips (root, date, timestamp);
+CREATE INDEX IF NOT EXISTS clips_by_dir ON clips (root, dir);
+CREATE INDEX IF NOT EXISTS dirs_by_parent ON dirs (root, parent);
+"""
+
+
+def parse_clip_name(filename):
+    """(date, timestamp, camera) for 'YYYY-MM-DD_HH-MM-SS-camera.mp4', None for anything else."""
+    if not filename.endswith(".mp4") or filename.startswith("._"):
+        return None
+    parts = filename.replace(".mp4", "").split("-")
+    if len(parts) < 2:
+        return None
+    camera = parts[-1]
+    timestamp = "-".join(parts[:-1])
+    return timestamp.split("_")[0], timestamp, camera
+
+
+class SourceIndex:
+    def __init__(self, db_path=INDEX_PATH):
+        self.db_path = db_path
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                conn.executescript("DROP TABLE IF EXISTS dirs; DROP TABLE IF EXISTS clips;")
+                conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            conn.executescript(SCHEMA)
+
+    def _root_lock(self, root):
+        with self._locks_guard:
+            return self._locks.setdefault(root, threading.Lock())
+
+    @staticmethod
+    def normalize(root):
+        return os.path.abspath(root)
+
+    def refresh(self, root):
+        """Brings the index of root up to date. Returns {"dirs", "rescanned", "clips"}."""
+        root = self.normalize(root)
+        with self._root_lock(root), closing(self._connect()) as conn, conn:
+            known = {path: (mtime, scanned_at) for path, mtime, scanned_at in
+                     conn.execute("SELECT path, mtime_ns, scanned_at FROM dirs WHERE root=?", (root,))}
+            children = {}
+            for path, parent in conn.execute("SELECT path, parent FROM dirs WHERE root=?", (root,)):
+                children.setdefault(parent, []).append(path)
+
+            seen = set()
+            rescanned = 0
+            stack = [root]
+            while stack:
+                path = stack.pop()
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                seen.add(path)
+                stored = known.get(path)
+                if stored and stored[0] == mtime_ns and stored[1] - mtime_ns / 1e9 > MTIME_SLACK_S:
+                    stack.extend(children.get(path, []))
+                    continue
+                stack.extend(self._scan_dir(conn, root, path, mtime_ns))
+                rescanned += 1
+
+            gone = [path for path in known if path not in seen]
+            for path in gone:
+                conn.execute("DELETE FROM dirs WHERE root=? AND path=?", (root, path))
+                conn.execute("DELETE FROM clips WHERE root=? AND dir=?", (root, os.path.relpath(path, root)))
+            count = conn.execute("SELECT COUNT(*) FROM clips WHERE root=?", (root,)).fetchone()[0]
+        return {"dirs": len(seen), "rescanned": rescanned, "clips": count}
+
+    def _scan_dir(self, conn, root, path, mtime_ns):
+        """Lists one directory into the index. Returns its subdirectories."""
+        scanned_at = time.time()
+        rel_dir = os.path.relpath(path, root)
+        subdirs, rows = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                            continue
+                        parsed = parse_clip_name(entry.name)
+                        if not parsed:
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    rows.append((root, os.path.relpath(entry.path, root), rel_dir, *parsed, st.st_size, st.st_mtime_ns))
+        except OSError:
+            pass
+
+        conn.execute("DELETE FROM clips WHERE root=? AND dir=?", (root, rel_dir))
+        conn.executemany("INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        parent = os.path.dirname(path) if path != root else None
+        conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)", (root, path, parent, mtime_ns, scanned_at))
+        return subdirs
+
+    def grouped(self, root):
+        """Same shape as TeslaCamMerger.group_videos: ({date: {timestamp: {camera: path}}}, file count).
+        Paths are joined onto root as given, like os.walk would."""
+        grouped = {}
+        count = 0
+        with closing(self._connect()) as conn:
+            for date, ts, camera, rel in conn.execute(
+                    "SELECT date, timestamp, camera, path FROM clips WHERE root=? ORDER BY path", (self.normalize(root),)):
+                grouped.setdefault(date, {}).setdefault(ts, {})[camera] = os.path.join(root, rel)
+                count += 1
+        return grouped, count
+
+    def directories(self, root):
+        """Absolute paths of every indexed folder under root (root included)."""
+        with closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute("SELECT path FROM dirs WHERE root=?", (self.normalize(root),))]
+
+    def dates(self, root):
+        root = self.normalize(root)
+        with closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT DISTINCT date FROM clips WHERE root=? ORDER BY date DESC", (root,))]
+
+    def clips(self, root, date):
+        """{timestamp: {camera: {"path", "size", "mtime_ns"}}} for one date."""
+        result = {}
+        with closing(self._connect()) as conn:
+            for ts, camera, rel, size, mtime_ns in conn.execute(
+                    "SELECT timestamp, camera, path, size, mtime_ns FROM clips WHERE root=? AND date=? ORDER BY path",
+                    (self.normalize(root), date)):
+                result.setdefault(ts, {})[camera] = {"path": os.path.join(root, rel), "size": size, "mtime_ns": mtime_ns}
+        return result
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_index():
+    """Process-wide SourceIndex (the API and every merger share one database)."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = SourceIndex()
+        return _shared
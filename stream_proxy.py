@@ -0,0 +1,215 @@
+"""Low-bitrate HLS proxies for previewing source clips.
+
+`/api/stream` hands the webview the original camera file, so scrubbing a
+clip pulls full-bitrate video off the (often USB) source drive.
+`ProxyStreamer` instead describes a clip, or the 4-up grid of one
+timestamp, as an HLS playlist of short MPEG-TS segments.  A segment is
+encoded the first time it is requested (input seek plus a few seconds of
+360p libx264, which is much cheaper than the decode the browser would do
+otherwise).  It then lives in a DiskCache keyed by the identity of the
+source files, so the byte budget bounds the cache and replaying a clip
+costs nothing.
+
+Segments are encoded independently, each starting on a keyframe, with
+`-output_ts_offset` keeping the timestamps continuous.  Seeking therefore
+only ever encodes the segment being looked at.  After serving a segment
+the next few are rendered in the background, so playback does not stall
+at every boundary.  `proxy_mp4` is the same idea in one file, for webviews
+without HLS support.
+
+The proxies are opt-in ("preview_proxy": true in the backend's config.json);
+without it the backend keeps streaming the original file.
+"""
+import os
+import math
+import threading
+import subprocess
+from collections import OrderedDict
+
+from disk_cache import shared_cache, file_identity, cache_key
+from mp4_check import inspect_mp4
+
+PROXY_VERSION = 1
+PROXY_CACHE_BYTES = 2 * 1024 ** 3
+SEGMENT_SECONDS = 6
+PREFETCH_SEGMENTS = 2
+PROXY_HEIGHT = 360
+PROXY_BITRATE = "600k"
+PROXY_FPS = 24
+GRID_CELL = (320, 180)
+IDENTITY_MEMO_SIZE = 1024  # 最近预览过的源文件，超出后丢掉最久没用的
+# 2x2 预览网格：前/后 在上，左/右 在下
+GRID_CAMERAS = ("front", "back", "left_repeater", "right_repeater")
+
+
+def _encode_args():
+    return ["-c:v", "libx264", "-preset", "veryfast", "-b:v", PROXY_BITRATE, "-maxrate", PROXY_BITRATE,
+            "-bufsize", "1200k", "-pix_fmt", "yuv420p", "-r", str(PROXY_FPS), "-an"]
+
+
+def segment_command(ffmpeg_bin, sources, start, duration, out, container="mpegts"):
+    """ffmpeg arguments for one proxy segment.
+    sources is {"": path} for a single clip or {camera: path} for the 4-up grid."""
+    cmd = [ffmpeg_bin, "-v", "error", "-y"]
+    if "" in sources:
+        cmd += ["-ss", f"{start:.3f}", "-i", sources[""], "-t", f"{duration:.3f}",
+                "-vf", f"scale=-2:{PROXY_HEIGHT}"]
+    else:
+        w, h = GRID_CELL
+        filters = []
+        for i, camera in enumerate(GRID_CAMERAS):
+            if sources.get(camera):
+                cmd += ["-ss", f"{start:.3f}", "-i", sources[camera]]
+            else:
+                # 缺失的摄像头用黑块占位
+                cmd += ["-f", "lavfi", "-i", f"color=c=black:s={w}x{h}:r={PROXY_FPS}"]
+            filters.append(f"[{i}:v]scale={w}:{h},setsar=1[c{i}]")
+        filters.append("[c0][c1][c2][c3]xstack=inputs=4:layout=0_0|w0_0|0_h0|w0_h0[v]")
+        cmd += ["-filter_complex", ";".join(filters), "-map", "[v]", "-t", f"{duration:.3f}"]
+    cmd += _encode_args()
+    if container == "mpegts":
+        # 每个分片独立编码，偏移时间戳让播放器看到连续的时间线
+        cmd += ["-output_ts_offset", f"{start:.3f}", "-f", "mpegts", out]
+    else:
+        cmd += ["-movflags", "+faststart", "-f", "mp4", out]
+    return cmd
+
+
+def build_playlist(duration, segment_url, segment_seconds=SEGMENT_SECONDS):
+    """VOD m3u8 text for a stream of `duration` seconds; segment_url(i) gives each segment's URI."""
+    count = max(1, math.ceil(duration / segment_seconds))
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{segment_seconds}",
+             "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    for i in range(count):
+        length = min(segment_seconds, duration - i * segment_seconds)
+        lines += [f"#EXTINF:{length:.3f},", segment_url(i)]
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+class ProxyStreamer:
+    def __init__(self, ffmpeg_bin="ffmpeg", cache=None, log=None):
+        self.ffmpeg_bin = ffmpeg_bin
+        self.cache = cache or shared_cache("proxy", PROXY_CACHE_BYTES)
+        self.log = log or (lambda message: None)
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> threading.Event, 同一个分片只编码一次
+        self._identities = OrderedDict()  # (path, size, mtime_ns) -> (file_identity, duration), LRU
+        self._prefetching = threading.Semaphore(1)
+
+    def _identity(self, path):
+        st = os.stat(path)
+        stat_key = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._identities.get(stat_key)
+            if cached is not None:
+                self._identities.move_to_end(stat_key)
+        if cached is None:
+            cached = (file_identity(path), inspect_mp4(path)["duration"])
+            with self._lock:
+                self._identities[stat_key] = cached
+                if len(self._identities) > IDENTITY_MEMO_SIZE:
+                    self._identities.popitem(last=False)
+        return cached
+
+    def duration(self, sources):
+        """Length of the proxy stream in seconds (the longest camera), None if no source is readable."""
+        durations = []
+        for path in sources.values():
+            try:
+                durations.append(self._identity(path)[1])
+            except OSError:
+                continue
+        durations = [d for d in durations if d]
+        return max(durations) if durations else None
+
+    def _key(self, sources, kind, index=0):
+        identities = {camera: self._identity(path)[0] for camera, path in sorted(sources.items())}
+        params = {"version": PROXY_VERSION, "kind": kind, "index": index, "segment": SEGMENT_SECONDS,
+                  "height": PROXY_HEIGHT, "bitrate": PROXY_BITRATE, "fps": PROXY_FPS}
+        return cache_key(identities, params)
+
+    def playlist(self, sources, segment_url):
+        duration = self.duration(sources)
+        return build_playlist(duration, segment_url) if duration else None
+
+    def segment(self, sources, index):
+        """Path of proxy segment `index` (encoded now if needed), None on failure."""
+        duration = self.duration(sources)
+        if not duration or not 0 <= index < math.ceil(duration / SEGMENT_SECONDS):
+            return None
+        path = self._ensure(sources, "ts", index, duration)
+        if path:
+            self._prefetch(sources, index + 1, duration)
+        return path
+
+    def proxy_mp4(self, sources):
+        """The whole clip as one low-bitrate faststart MP4 (for players without HLS)."""
+        duration = self.duration(sources)
+        return self._ensure(sources, "mp4", 0, duration) if duration else None
+
+    def _ensure(self, sources, kind, index, duration):
+        try:
+            key = self._key(sources, kind, index)
+        except OSError:
+            return None
+        with self._lock:
+            path = self.cache.get(key)
+            if path:
+                return path
+            done = self._pending.get(key)
+            owner = done is None
+            if owner:
+                done = self._pending[key] = threading.Event()
+        if not owner:
+            done.wait(120)
+            return self.cache.get(key)
+        try:
+            self._encode(sources, kind, index, duration, key)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            done.set()
+        return self.cache.get(key)
+
+    def _encode(self, sources, kind, index, duration, key):
+        if kind == "ts":
+            start = index * SEGMENT_SECONDS
+            length = min(SEGMENT_SECONDS, duration - start)
+            container = "mpegts"
+        else:
+            start, length, container = 0.0, duration, "mp4"
+        # .tmp 结尾：进程中途退出时 DiskCache 加载索引会忽略它
+        out = self.cache.path_for(key) + ".encode.tmp"
+        cmd = segment_command(self.ffmpeg_bin, sources, start, length, out, container)
+        name = os.path.basename(next(iter(sources.values())))
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.log(f"DEBUG: proxy {kind} {index} of {name} failed: {e}")
+            return
+        if result.returncode != 0 or not os.path.exists(out):
+            self.log(f"DEBUG: proxy {kind} {index} of {name} failed: {result.stderr[-200:]}")
+            if os.path.exists(out):
+                os.remove(out)
+            return
+        self.cache.put(key, out)
+
+    def _prefetch(self, sources, first, duration):
+        count = math.ceil(duration / SEGMENT_SECONDS)
+        wanted = range(first, min(count, first + PREFETCH_SEGMENTS))
+        if not wanted or not self._prefetching.acquire(blocking=False):
+            return  # 已经有一个预取在跑
+
+        def run():
+            try:
+                for index in wanted:
+                    self._ensure(sources, "ts", index, duration)
+            finally:
+                self._prefetching.release()
+        threading.Thread(target=run, name="proxy-prefetch", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            encoding = len(self._pending)
+        return {**self.cache.stats(), "encoding": encoding}
@@ -0,0 +1,397 @@
+"""Searchable index of the SEI telemetry of a TeslaCam archive.
+
+Answering "every minute last month where autopilot disengaged above
+80 km/h" used to mean merging everything and watching it.  `TelemetryIndex`
+reads each front-camera clip once, through the columnar telemetry cache,
+and stores three things in SQLite under ~/.teslacam_merger:
+
+    clips     one summary row per minute (max/avg speed, autopilot and brake
+              time, hardest deceleration, GPS bounding box, event counts)
+    seconds   one row per second of footage (speed, autopilot, brake, gear,
+              accelerations, position) for arbitrary range queries
+    events    discrete moments: autopilot engaged/disengaged, hard braking
+
+Clips are re-read only when their size or mtime changed, and the per-clip
+work runs in a process pool.  Queries are plain indexed SQL, so they take
+milliseconds.  Speeds are stored in m/s; the query helpers take and return
+km/h like the overlay shows them.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+
+from disk_cache import DATA_DIR
+from source_index import shared_index
+from telemetry_store import load_or_extract
+
+INDEX_PATH = os.path.join(DATA_DIR, "telemetry_index.sqlite3")
+SCHEMA_VERSION = 1
+
+FRAME_RATE = 36.0  # SEI 每帧一条，和 DashcamParser 的默认值一致
+HARD_BRAKE_MPS2 = 4.0  # 1 秒内减速超过 ~0.4 g 记为急刹
+KMH = 3.6
+
+AUTOPILOT_ENGAGED = "autopilot_engaged"
+AUTOPILOT_DISENGAGED = "autopilot_disengaged"
+HARD_BRAKE = "hard_brake"
+EVENT_KINDS = (AUTOPILOT_ENGAGED, AUTOPILOT_DISENGAGED, HARD_BRAKE)
+GEARS = {"P": 0, "D": 1, "R": 2, "N": 3}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    date TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    samples INTEGER,
+    duration REAL,
+    max_speed REAL,
+    avg_speed REAL,
+    max_decel REAL,
+    autopilot_seconds REAL,
+    brake_seconds REAL,
+    hard_brakes INTEGER,
+    disengagements INTEGER,
+    min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL,
+    PRIMARY KEY (root, path)
+);
+CREATE TABLE IF NOT EXISTS seconds (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    date TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    speed REAL,
+    autopilot INTEGER,
+    brake INTEGER,
+    gear INTEGER,
+    accel_x REAL,
+    accel_y REAL,
+    latitude REAL,
+    longitude REAL
+);
+CREATE TABLE IF NOT EXISTS events (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    date TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    offset REAL NOT NULL,
+    kind TEXT NOT NULL,
+    speed REAL,
+    value REAL,
+    latitude REAL,
+    longitude REAL
+);
+CREATE INDEX IF NOT EXISTS clips_by_date ON clips (root, date, timestamp);
+CREATE INDEX IF NOT EXISTS seconds_by_date ON seconds (root, date, timestamp);
+CREATE INDEX IF NOT EXISTS seconds_by_path ON seconds (root, path);
+CREATE INDEX IF NOT EXISTS events_by_kind ON events (root, kind, date);
+CREATE INDEX IF NOT EXISTS events_by_path ON events (root, path);
+"""
+
+
+def _valid_position(lat, lon):
+    return (lat or lon) and -90 <= lat <= 90 and -180 <= lon <= 180
+
+
+def summarize_clip(path):
+    """Worker entry point (module level so it can be pickled).
+    Returns (summary dict, per-second tuples, event tuples), or None if the clip has no readable telemetry."""
+    telemetry = load_or_extract(path)
+    if telemetry is None:
+        return None
+    try:
+        cols = telemetry.columns
+        n = len(telemetry)
+        speed = cols["vehicle_speed_mps"]
+        autopilot = cols["autopilot_state"]
+        brake = cols["brake_applied"]
+        gear = cols["gear_state"]
+        ax = cols["linear_acceleration_mps2_x"]
+        ay = cols["linear_acceleration_mps2_y"]
+        lat = cols["latitude_deg"]
+        lon = cols["longitude_deg"]
+        step = int(FRAME_RATE)
+
+        seconds, events = [], []
+        summary = {"samples": n, "duration": n / FRAME_RATE, "max_speed": 0.0, "avg_speed": 0.0, "max_decel": 0.0,
+                   "autopilot_seconds": 0.0, "brake_seconds": 0.0, "hard_brakes": 0, "disengagements": 0,
+                   "min_lat": None, "max_lat": None, "min_lon": None, "max_lon": None}
+        if not n:
+            return summary, seconds, events
+
+        total_speed = 0.0
+        autopilot_frames = brake_frames = 0
+        for i in range(n):
+            v = speed[i]
+            total_speed += v
+            if v > summary["max_speed"]:
+                summary["max_speed"] = v
+            if autopilot[i]:
+                autopilot_frames += 1
+            if brake[i]:
+                brake_frames += 1
+            if i and bool(autopilot[i]) != bool(autopilot[i - 1]):
+                kind = AUTOPILOT_ENGAGED if autopilot[i] else AUTOPILOT_DISENGAGED
+                if kind == AUTOPILOT_DISENGAGED:
+                    summary["disengagements"] += 1
+                position = (lat[i], lon[i]) if _valid_position(lat[i], lon[i]) else (None, None)
+                events.append((i / FRAME_RATE, kind, v, autopilot[i - 1] if kind == AUTOPILOT_DISENGAGED else autopilot[i],
+                               *position))
+        summary.update(avg_speed=total_speed / n, autopilot_seconds=autopilot_frames / FRAME_RATE,
+                       brake_seconds=brake_frames / FRAME_RATE)
+
+        braking = False
+        for start in range(0, n, step):
+            end = min(n, start + step)
+            window = range(start, end)
+            # 一秒一行：速度取这一秒内的最大值，刹车/辅助驾驶只要出现过就算
+            position = next(((lat[i], lon[i]) for i in window if _valid_position(lat[i], lon[i])), (None, None))
+            seconds.append((start // step, max(speed[i] for i in window), max(autopilot[i] for i in window),
+                            int(any(brake[i] for i in window)), gear[end - 1],
+                            sum(ax[i] for i in window) / len(window), sum(ay[i] for i in window) / len(window),
+                            *position))
+            if position[0] is not None:
+                summary["min_lat"] = min(position[0], summary["min_lat"] if summary["min_lat"] is not None else 90)
+                summary["max_lat"] = max(position[0], summary["max_lat"] if summary["max_lat"] is not None else -90)
+                summary["min_lon"] = min(position[1], summary["min_lon"] if summary["min_lon"] is not None else 180)
+                summary["max_lon"] = max(position[1], summary["max_lon"] if summary["max_lon"] is not None else -180)
+
+            # 急刹：和一秒前相比的速度下降（比 IMU 的轴向约定更可靠），连续的一段只记一次
+            if start >= step:
+                decel = speed[start - step] - speed[start]
+                summary["max_decel"] = max(summary["max_decel"], decel)
+                if decel >= HARD_BRAKE_MPS2:
+                    if not braking:
+                        summary["hard_brakes"] += 1
+                        events.append((start / FRAME_RATE, HARD_BRAKE, speed[start - step], decel, *position))
+                    braking = True
+                else:
+                    braking = False
+        return summary, seconds, events
+    finally:
+        telemetry.close()
+
+
+class TelemetryIndex:
+    def __init__(self, db_path=INDEX_PATH, source_index=None):
+        self.db_path = db_path
+        self.source_index = source_index
+        self._write_lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                conn.executescript("DROP TABLE IF EXISTS clips; DROP TABLE IF EXISTS seconds; DROP TABLE IF EXISTS events;")
+                conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            conn.executescript(SCHEMA)
+
+    @staticmethod
+    def normalize(root):
+        return os.path.abspath(root)
+
+    # --- building ---
+
+    def pending(self, root, date_prefix=None):
+        """Front clips under root (optionally only dates starting with date_prefix) as
+        ([(date, timestamp, path, size, mtime_ns) needing (re)indexing], number of clips considered)."""
+        index = self.source_index or shared_index()
+        index.refresh(root)
+        root = self.normalize(root)
+        with closing(self._connect()) as conn:
+            known = {row["path"]: (row["size"], row["mtime_ns"])
+                     for row in conn.execute("SELECT path, size, mtime_ns FROM clips WHERE root=?", (root,))}
+        todo, total = [], 0
+        for date in index.dates(root):
+            if date_prefix and not date.startswith(date_prefix):
+                continue
+            for ts, cameras in index.clips(root, date).items():
+                front = cameras.get("front")
+                if not front:
+                    continue
+                total += 1
+                if known.get(front["path"]) != (front["size"], front["mtime_ns"]):
+                    todo.append((date, ts, front["path"], front["size"], front["mtime_ns"]))
+        return sorted(todo), total
+
+    def update(self, root, date_prefix=None, progress=None, should_stop=None, max_workers=None):
+        """Indexes new or changed clips under root. progress(done, total) is called after each clip.
+        Returns {"indexed", "failed", "total"}."""
+        todo, total = self.pending(root, date_prefix)
+        root = self.normalize(root)
+        self._prune(root, date_prefix)
+        indexed = failed = 0
+        if not todo:
+            return {"indexed": 0, "failed": 0, "total": total}
+        with ProcessPoolExecutor(max_workers=max_workers or min(4, os.cpu_count() or 1)) as pool:
+            futures = [(clip, pool.submit(summarize_clip, clip[2])) for clip in todo]
+            for done, (clip, future) in enumerate(futures, 1):
+                if should_stop and should_stop():
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    break
+                try:
+                    result = future.result()
+                except Exception:
+                    result = None
+                if result is None:
+                    failed += 1
+                else:
+                    self._store(root, clip, *result)
+                    indexed += 1
+                if progress:
+                    progress(done, len(todo))
+        return {"indexed": indexed, "failed": failed, "total": total}
+
+    def _store(self, root, clip, summary, seconds, events):
+        date, ts, path, size, mtime_ns = clip
+        with self._write_lock, closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM seconds WHERE root=? AND path=?", (root, path))
+            conn.execute("DELETE FROM events WHERE root=? AND path=?", (root, path))
+            conn.execute("INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (root, path, date, ts, size, mtime_ns, summary["samples"], summary["duration"],
+                          summary["max_speed"], summary["avg_speed"], summary["max_decel"], summary["autopilot_seconds"],
+                          summary["brake_seconds"], summary["hard_brakes"], summary["disengagements"],
+                          summary["min_lat"], summary["max_lat"], summary["min_lon"], summary["max_lon"]))
+            conn.executemany("INSERT INTO seconds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(root, path, date, ts, *row) for row in seconds])
+            conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(root, path, date, ts, *row) for row in events])
+
+    def _prune(self, root, date_prefix):
+        """Drops clips that are no longer on disk."""
+        with closing(self._connect()) as conn:
+            paths = [row["path"] for row in conn.execute(
+                "SELECT path FROM clips WHERE root=? AND date LIKE ?", (root, f"{date_prefix or ''}%"))]
+        gone = [p for p in paths if not os.path.exists(p)]
+        if not gone:
+            return
+        with self._write_lock, closing(self._connect()) as conn, conn:
+            for table in ("clips", "seconds", "events"):
+                conn.executemany(f"DELETE FROM {table} WHERE root=? AND path=?", [(root, p) for p in gone])
+
+    # --- queries ---
+
+    @staticmethod
+    def _date_filter(start, end):
+        sql, args = "", []
+        # start/end 可以是 YYYY-MM-DD 或 YYYY-MM；end 按前缀包含
+        if start:
+            sql += " AND date >= ?"
+            args.append(start)
+        if end:
+            sql += " AND date <= ?"
+            args.append(end + "\uffff")
+        return sql, args
+
+    def stats(self, root):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT COUNT(*), MIN(date), MAX(date), SUM(duration) FROM clips WHERE root=?",
+                               (self.normalize(root),)).fetchone()
+        return {"clips": row[0], "first_date": row[1], "last_date": row[2], "hours": round((row[3] or 0) / 3600, 2)}
+
+    def clips(self, root, start=None, end=None, min_speed=None, autopilot=None, hard_brake=None, limit=500):
+        """Per-minute summaries (speeds in km/h)."""
+        sql = "SELECT * FROM clips WHERE root=?"
+        args = [self.normalize(root)]
+        date_sql, date_args = self._date_filter(start, end)
+        sql += date_sql
+        args += date_args
+        if min_speed is not None:
+            sql += " AND max_speed >= ?"
+            args.append(min_speed / KMH)
+        if autopilot is not None:
+            sql += " AND autopilot_seconds > 0" if autopilot else " AND autopilot_seconds = 0"
+        if hard_brake:
+            sql += " AND hard_brakes > 0"
+        sql += " ORDER BY timestamp LIMIT ?"
+        args.append(limit)
+        with closing(self._connect()) as conn:
+            rows = [dict(row) for row in conn.execute(sql, args)]
+        for row in rows:
+            del row["root"]
+            for key in ("max_speed", "avg_speed"):
+                row[key] = round(row[key] * KMH, 1)
+        return rows
+
+    def events(self, root, kind=None, start=None, end=None, min_speed=None, max_speed=None, limit=500):
+        """Discrete events, oldest first; speed is the speed when it happened (km/h)."""
+        sql = "SELECT date, timestamp, path, offset, kind, speed, value, latitude, longitude FROM events WHERE root=?"
+        args = [self.normalize(root)]
+        if kind:
+            sql += " AND kind=?"
+            args.append(kind)
+        date_sql, date_args = self._date_filter(start, end)
+        sql += date_sql
+        args += date_args
+        if min_speed is not None:
+            sql += " AND speed >= ?"
+            args.append(min_speed / KMH)
+        if max_speed is not None:
+            sql += " AND speed <= ?"
+            args.append(max_speed / KMH)
+        sql += " ORDER BY timestamp, offset LIMIT ?"
+        args.append(limit)
+        with closing(self._connect()) as conn:
+            rows = [dict(row) for row in conn.execute(sql, args)]
+        for row in rows:
+            row["speed"] = round(row["speed"] * KMH, 1)
+        return rows
+
+    def search(self, root, start=None, end=None, min_speed=None, max_speed=None, autopilot=None, brake=None,
+               gear=None, limit=500):
+        """Minutes with at least one second matching every given condition.
+        Returns [{date, timestamp, path, first_offset, matching_seconds, max_speed}] (km/h)."""
+        sql = ("SELECT date, timestamp, path, MIN(offset) AS first_offset, COUNT(*) AS matching_seconds, "
+               "MAX(speed) AS max_speed FROM seconds WHERE root=?")
+        args = [self.normalize(root)]
+        date_sql, date_args = self._date_filter(start, end)
+        sql += date_sql
+        args += date_args
+        if min_speed is not None:
+            sql += " AND speed >= ?"
+            args.append(min_speed / KMH)
+        if max_speed is not None:
+            sql += " AND speed <= ?"
+            args.append(max_speed / KMH)
+        if autopilot is not None:
+            sql += " AND autopilot > 0" if autopilot else " AND autopilot = 0"
+        if brake is not None:
+            sql += " AND brake = ?"
+            args.append(int(bool(brake)))
+        if gear is not None:
+            sql += " AND gear = ?"
+            args.append(GEARS.get(str(gear).upper(), gear))
+        sql += " GROUP BY path ORDER BY timestamp LIMIT ?"
+        args.append(limit)
+        with closing(self._connect()) as conn:
+            rows = [dict(row) for row in conn.execute(sql, args)]
+        for row in rows:
+            row["max_speed"] = round(row["max_speed"] * KMH, 1)
+        return rows
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_telemetry_index():
+    """Process-wide TelemetryIndex."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = TelemetryIndex()
+        return _shared
@@ -0,0 +1,225 @@
+"""Compact columnar cache of the SeiMetadata telemetry of a clip.
+
+Parsing SEI out of an MP4 yields ~2,160 protobuf objects per minute that
+are used once and thrown away.  This module stores every `dashcam.proto`
+field as a typed array in a small binary file, keyed by the identity of
+the source clip, so overlays, APIs and analytics can memory-map it again
+instead of re-parsing the video.
+
+File layout (all offsets relative to the start of the file):
+
+    b"TCTL" | u32 format version | u32 header length | JSON header | columns
+
+The JSON header lists each column's name, array typecode, byte offset and
+the byte order.  Columns are 8-byte aligned so they can be cast in place.
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import tempfile
+from array import array
+from collections import namedtuple
+
+from dashcam_parser import DashcamParser
+from disk_cache import shared_cache, file_identity, cache_key
+
+MAGIC = b"TCTL"
+FORMAT_VERSION = 1
+DEFAULT_TELEMETRY_CACHE_BYTES = 2 * 1024 ** 3
+
+# (field, array typecode) —— 与 dashcam.proto 的字段一一对应
+COLUMNS = [
+    ("version", "I"),
+    ("gear_state", "B"),
+    ("frame_seq_no", "Q"),
+    ("vehicle_speed_mps", "f"),
+    ("accelerator_pedal_position", "f"),
+    ("steering_wheel_angle", "f"),
+    ("blinker_on_left", "B"),
+    ("blinker_on_right", "B"),
+    ("brake_applied", "B"),
+    ("autopilot_state", "B"),
+    ("latitude_deg", "d"),
+    ("longitude_deg", "d"),
+    ("heading_deg", "d"),
+    ("linear_acceleration_mps2_x", "d"),
+    ("linear_acceleration_mps2_y", "d"),
+    ("linear_acceleration_mps2_z", "d"),
+]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+BOOL_COLUMNS = {"blinker_on_left", "blinker_on_right", "brake_applied"}
+
+# 行视图：属性名与 SeiMetadata 相同，可以直接交给 DashcamParser 生成 ASS
+TelemetryRow = namedtuple("TelemetryRow", COLUMN_NAMES)
+
+
+class TelemetryRows:
+    """Lazy sequence of TelemetryRow over the columns (rows are built only when indexed)."""
+
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+
+    def __len__(self):
+        return len(self.telemetry)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        cols = self.telemetry.columns
+        return TelemetryRow(*(bool(cols[name][i]) if name in BOOL_COLUMNS else cols[name][i] for name in COLUMN_NAMES))
+
+
+class Telemetry:
+    """Typed columns of one clip. Columns are arrays, or memoryviews into an mmap when loaded from disk."""
+
+    def __init__(self, columns, rows, source=None, _mmap=None, _view=None):
+        self.columns = columns
+        self.rows_count = rows
+        self.source = source
+        self._mmap = _mmap
+        self._view = _view
+
+    def __len__(self):
+        return self.rows_count
+
+    def column(self, name):
+        return self.columns[name]
+
+    def rows(self):
+        return TelemetryRows(self)
+
+    def detached(self):
+        """A copy whose columns are plain arrays, usable after close(); self if nothing is memory-mapped."""
+        if self._mmap is None:
+            return self
+        columns = {name: array(code, self.columns[name].tobytes()) for name, code in COLUMNS}
+        return Telemetry(columns, self.rows_count, self.source)
+
+    @classmethod
+    def from_messages(cls, messages, source=None):
+        columns = {name: array(code) for name, code in COLUMNS}
+        for meta in messages:
+            for name, _ in COLUMNS:
+                columns[name].append(getattr(meta, name))
+        return cls(columns, len(messages), source)
+
+    def write(self, path):
+        """Writes the columnar file atomically."""
+        descriptors = []
+        offset = 0
+        blobs = []
+        for name, code in COLUMNS:
+            data = array(code, self.columns[name]).tobytes()
+            offset = (offset + 7) & ~7
+            descriptors.append({"name": name, "type": code, "offset": offset, "bytes": len(data)})
+            blobs.append((offset, data))
+            offset += len(data)
+
+        header = {"rows": self.rows_count, "source": self.source, "byteorder": sys.byteorder, "columns": descriptors}
+        header_bytes = json.dumps(header).encode("utf-8")
+        data_start = (12 + len(header_bytes) + 7) & ~7
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + struct.pack("<II", FORMAT_VERSION, len(header_bytes)) + header_bytes)
+            for col_offset, data in blobs:
+                f.seek(data_start + col_offset)
+                f.write(data)
+            f.truncate(data_start + offset)
+        os.replace(tmp, path)
+
+    @classmethod
+    def open(cls, path):
+        """Memory-maps a columnar file. Returns None if it is missing or not a telemetry file."""
+        try:
+            with open(path, "rb") as f:
+                if f.read(4) != MAGIC:
+                    return None
+                version, header_len = struct.unpack("<II", f.read(8))
+                if version != FORMAT_VERSION:
+                    return None
+                header = json.loads(f.read(header_len).decode("utf-8"))
+                data_start = (12 + header_len + 7) & ~7
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) > data_start else None
+        except (OSError, ValueError, struct.error):
+            return None
+
+        columns = {}
+        view = memoryview(mm) if mm is not None else None
+        for desc in header["columns"]:
+            start = data_start + desc["offset"]
+            raw = view[start:start + desc["bytes"]] if view is not None else memoryview(b"")
+            if header.get("byteorder", sys.byteorder) != sys.byteorder:
+                # 字节序不同的机器上写的文件：只能复制一份再交换
+                col = array(desc["type"], raw.tobytes())
+                col.byteswap()
+                columns[desc["name"]] = col
+            else:
+                columns[desc["name"]] = raw.cast(desc["type"])
+        return cls(columns, header["rows"], header.get("source"), mm, view)
+
+    def close(self):
+        """Releases the mmap (columns must not be used afterwards)."""
+        if self._mmap is not None:
+            for col in self.columns.values():
+                if isinstance(col, memoryview):
+                    col.release()
+            self.columns = {}
+            if self._view is not None:
+                self._view.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+def telemetry_cache():
+    return shared_cache("telemetry", DEFAULT_TELEMETRY_CACHE_BYTES, suffix=".tct")
+
+
+def load_or_extract(video_path, parser=None):
+    """Telemetry of a clip, from the cache if the source is unchanged, otherwise parsed and cached.
+    Returns None if the clip cannot be read; an empty Telemetry if it has no SEI."""
+    try:
+        identity = file_identity(video_path)
+    except OSError:
+        return None
+    cache = telemetry_cache()
+    key = cache_key("telemetry", FORMAT_VERSION, identity)
+    cached = cache.get(key)
+    if cached:
+        telemetry = Telemetry.open(cached)
+        if telemetry is not None:
+            return telemetry
+        cache.discard(key)
+
+    parser = parser or DashcamParser()
+    try:
+        messages = parser.extract_sei_messages(video_path)
+    except Exception:
+        return None
+    telemetry = Telemetry.from_messages(messages, source=identity)
+
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=cache.root)
+    os.close(fd)
+    try:
+        telemetry.write(tmp)
+        cache.put(key, tmp)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return telemetry
+
+
+def load_messages(video_path):
+    """Drop-in replacement for DashcamParser.extract_sei_messages backed by the telemetry cache."""
+    telemetry = load_or_extract(video_path)
+    if telemetry is None:
+        raise RuntimeError(f"cannot read telemetry from {video_path}")
+    # 行视图是惰性的，先把列复制出来再关掉 mmap，否则每个片段的映射要等 GC 才释放
+    try:
+        return telemetry.detached().rows()
+    finally:
+        telemetry.close()
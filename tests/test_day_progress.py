@@ -0,0 +1,57 @@
+"""Progress of the per-day modes (highlights, condensed) must never go backwards across days."""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import merge_tesla_cam
+from merge_tesla_cam import TeslaCamMerger
+
+
+def two_days():
+    days = {}
+    for date, clips in (("2024-01-01", 3), ("2024-01-02", 3)):
+        days[date] = {f"{date}_08-0{i}-00": {"front": f"/nonexistent/{date}-{i}-front.mp4"} for i in range(clips)}
+    return days
+
+
+def make_merger(monkeypatch):
+    out = tempfile.mkdtemp(prefix="teslacam_test_")
+    merger = TeslaCamMerger(out, out, max_workers=2, use_fragment_cache=False, use_source_index=False,
+                            use_journal=False)
+    percents = []
+    monkeypatch.setattr(merger, "report_progress", lambda message, **fields: percents.append(fields["percent"]))
+    monkeypatch.setattr(merger, "log", lambda message: None)
+    monkeypatch.setattr(merger, "_render_clip_spans",
+                        lambda ts, cameras, clip_spans, label="": [(i, f"{ts}-{i}.mp4") for i, *_ in clip_spans])
+    monkeypatch.setattr(merger, "_concat_spans", lambda date_str, fragments, suffix: f"TeslaCam_{date_str}{suffix}.mp4")
+    return merger, percents
+
+
+def assert_monotonic(percents, days):
+    assert percents, "no progress reported"
+    assert all(b >= a for a, b in zip(percents, percents[1:])), percents
+    assert 0 < percents[0] and abs(percents[-1] - 100.0) < 1e-6
+    # 第一天结束时正好到它那一份（一半），不会提前冲到 100%
+    assert any(abs(p - 50.0) < 1e-6 for p in percents), percents
+
+
+def test_highlight_progress_spans_days(monkeypatch):
+    merger, percents = make_merger(monkeypatch)
+    days = two_days()
+    monkeypatch.setattr(merge_tesla_cam, "load_or_extract", lambda path: None)
+    monkeypatch.setattr(merge_tesla_cam, "plan_windows", lambda clips, pre, post: [
+        {"start": 0, "end": 5, "kinds": ["hard_brake"], "spans": [(ts, 0.0, 5.0) for ts, _, _ in clips]}])
+    monkeypatch.setattr(merge_tesla_cam, "describe_window", lambda window: "window")
+    merger._merge_days_highlights(days, sum(len(v) for v in days.values()))
+    assert_monotonic(percents, days)
+
+
+def test_condensed_progress_spans_days(monkeypatch):
+    merger, percents = make_merger(monkeypatch)
+    days = two_days()
+    monkeypatch.setattr(merger, "_scan_idle", lambda cameras, ffmpeg_bin: (60.0, [], "telemetry"))
+    monkeypatch.setattr(merger, "_write_idle_decisions", lambda *args: None)
+    merger._merge_days_condensed(days, sum(len(v) for v in days.values()), "drop")
+    assert_monotonic(percents, days)
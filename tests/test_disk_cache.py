@@ -0,0 +1,39 @@
+"""Two DiskCache instances on one directory stand in for two processes sharing the cache."""
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from disk_cache import DiskCache
+
+
+def write(path, data=b"x" * 10):
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def test_get_adopts_file_put_by_another_process(tmp_path):
+    a = DiskCache("c", 1 << 20, ".bin", root=str(tmp_path))
+    b = DiskCache("c", 1 << 20, ".bin", root=str(tmp_path))
+    a.put("k1", write(str(tmp_path / "src1")))
+    assert b.contains("k1")
+    assert b.get("k1") == b.path_for("k1")
+    assert b.stats()["hits"] == 1 and b.stats()["bytes"] == 10
+
+
+def test_save_merges_index_written_by_another_process(tmp_path):
+    a = DiskCache("c", 1 << 20, ".bin", root=str(tmp_path))
+    b = DiskCache("c", 1 << 20, ".bin", root=str(tmp_path))
+    a.put("k1", write(str(tmp_path / "src1")))
+    b.put("k2", write(str(tmp_path / "src2")))
+    with open(os.path.join(a.root, "index.json"), encoding="utf-8") as f:
+        assert set(json.load(f)) == {"k1", "k2"}
+    # 被别的进程淘汰（文件已删）的条目不会被合并回来
+    a.discard("k1")
+    a.save()
+    b.save()
+    with open(os.path.join(a.root, "index.json"), encoding="utf-8") as f:
+        assert set(json.load(f)) == {"k2"}
+    assert not [name for name in os.listdir(a.root) if name.endswith(".tmp")]
@@ -0,0 +1,40 @@
+"""The per-file identity memos of the preview services stay bounded."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stream_proxy
+import thumbnails
+from disk_cache import DiskCache
+from stream_proxy import ProxyStreamer
+from thumbnails import ThumbnailService
+
+
+def make_files(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"clip{i}.mp4"
+        path.write_bytes(b"x" * (i + 1))
+        paths.append(str(path))
+    return paths
+
+
+def test_thumbnail_identities_are_lru_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails, "IDENTITY_MEMO_SIZE", 2)
+    service = ThumbnailService(cache=DiskCache("thumbs", 1 << 20, ".jpg", root=str(tmp_path)))
+    first, second, third = make_files(tmp_path, 3)
+    service.key_for(first)
+    service.key_for(second)
+    service.key_for(first)  # 最近用过，不该被挤掉
+    service.key_for(third)
+    assert [key[0] for key in service._identities] == [first, third]
+
+
+def test_proxy_identities_are_lru_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(stream_proxy, "IDENTITY_MEMO_SIZE", 2)
+    streamer = ProxyStreamer(cache=DiskCache("proxy", 1 << 20, root=str(tmp_path)))
+    first, second, third = make_files(tmp_path, 3)
+    for path in (first, second, first, third):
+        streamer._identity(path)
+    assert [key[0] for key in streamer._identities] == [first, third]
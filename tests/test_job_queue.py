@@ -0,0 +1,38 @@
+"""The job scheduler must survive bad settings and failing passes."""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_queue import JobManager
+
+
+def test_invalid_max_concurrent_falls_back_to_one(tmp_path):
+    for value in ("two", None, 0, -3, [2]):
+        manager = JobManager(path=str(tmp_path / "jobs.json"), max_concurrent=lambda value=value: value)
+        assert manager._concurrency() == 1
+    manager = JobManager(path=str(tmp_path / "jobs.json"), max_concurrent=lambda: "3")
+    assert manager._concurrency() == 3
+
+
+def test_scheduler_survives_a_failing_pass(tmp_path, monkeypatch):
+    manager = JobManager(path=str(tmp_path / "jobs.json"))
+    passes = []
+
+    def start_next():
+        passes.append(time.time())
+        if len(passes) == 1:
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(manager, "_start_next", start_next)
+    manager.start()
+    with manager._cond:
+        manager._cond.notify_all()
+    deadline = time.time() + 3
+    while len(passes) < 2 and time.time() < deadline:
+        with manager._cond:
+            manager._cond.notify_all()
+        time.sleep(0.05)
+    assert manager._thread.is_alive() and len(passes) >= 2
+    manager.shutdown()
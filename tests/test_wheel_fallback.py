@@ -0,0 +1,34 @@
+"""Clip signatures must be taken after the wheel sprite fallback has settled the overlay."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import merge_tesla_cam
+from merge_tesla_cam import TeslaCamMerger
+
+
+class Stop(Exception):
+    pass
+
+
+def test_atlas_fallback_happens_before_finished_days_are_checked(monkeypatch):
+    out = tempfile.mkdtemp(prefix="teslacam_test_")
+    merger = TeslaCamMerger(out, out, progress_callback=lambda message: None, wheel_sprites=True,
+                            use_fragment_cache=False, use_source_index=False)
+    days = {"2024-01-01": {"2024-01-01_08-00-00": {"front": os.path.join(out, "front.mp4")}}}
+    monkeypatch.setattr(merger, "group_videos", lambda: (days, 1))
+    monkeypatch.setattr(merge_tesla_cam, "ensure_atlas", lambda ffmpeg_bin, log=None: None)
+    seen = []
+
+    def skip_finished_days(grouped_days):
+        seen.append(merger.render_params()["overlay"])
+        raise Stop()
+
+    monkeypatch.setattr(merger, "_skip_finished_days", skip_finished_days)
+    with pytest.raises(Stop):
+        merger.merge_all()
+    assert seen == ["ass"]
@@ -0,0 +1,196 @@
+"""Small JPEG previews of source clips for the clip browser.
+
+`/api/videos` used to hand the UI a raw camera MP4 per minute, so showing
+what a minute looks like meant downloading and decoding a full 36 fps clip.
+`ThumbnailService` renders, per camera file, either one keyframe ("frame")
+or a strip of ten keyframes across the minute ("sprite"), decoding only
+keyframes (`-skip_frame nokey`) at reduced CPU priority.  Results live in a
+DiskCache keyed by the source identity, so a clip is rendered once no
+matter how often the day is browsed.
+
+A single background thread works through a queue: pages the user is
+looking at jump ahead, and `prefetch` (called after the index was
+refreshed for a day) queues the rest at low priority.  A new prefetch
+replaces the previous one, so clicking through the calendar does not
+pile up work for days nobody looks at any more.
+"""
+import os
+import heapq
+import shutil
+import platform
+import itertools
+import threading
+import subprocess
+from collections import OrderedDict
+
+from disk_cache import shared_cache, file_identity, cache_key
+
+THUMB_VERSION = 1
+THUMB_CACHE_BYTES = 512 * 1024 ** 2
+FRAME_WIDTH = 320
+SPRITE_FRAMES = 10
+SPRITE_WIDTH = 160  # 每一格的宽度
+KINDS = ("frame", "sprite")
+IDENTITY_MEMO_SIZE = 8192  # 约一天四个摄像头的文件数，超出后丢掉最久没用的
+
+PRIORITY_NOW = 0
+PRIORITY_BACKGROUND = 1
+
+
+def _low_priority(cmd):
+    """(cmd, subprocess kwargs) that start ffmpeg at idle priority.
+    No preexec_fn: the backend is multithreaded, so nothing may run in the child between fork and exec."""
+    if platform.system() == "Windows":
+        return cmd, {"creationflags": getattr(subprocess, "IDLE_PRIORITY_CLASS", 0)}
+    nice = shutil.which("nice")
+    return ([nice, "-n", "19"] + cmd if nice else cmd), {"start_new_session": True}
+
+
+def thumbnail_command(ffmpeg_bin, src, out, kind="frame"):
+    """ffmpeg arguments for one thumbnail; only keyframes are decoded."""
+    if kind == "sprite":
+        # 每隔 60/SPRITE_FRAMES 秒取一张关键帧横向拼接；片段较短时 tile 用黑色补齐
+        # （fps 滤镜对短于一个间隔的片段什么都不输出，所以用 select）
+        step = 60 / SPRITE_FRAMES
+        vf = (f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{step:g})',"
+              f"scale={SPRITE_WIDTH}:-2,tile={SPRITE_FRAMES}x1")
+    else:
+        vf = f"scale={FRAME_WIDTH}:-2"
+    return [ffmpeg_bin, "-v", "error", "-y", "-skip_frame", "nokey", "-i", src,
+            "-vf", vf, "-frames:v", "1", "-q:v", "5", "-an", "-f", "image2", "-c:v", "mjpeg", out]
+
+
+class ThumbnailService:
+    def __init__(self, ffmpeg_bin="ffmpeg", cache=None, log=None):
+        self.ffmpeg_bin = ffmpeg_bin
+        self.cache = cache or shared_cache("thumbnails", THUMB_CACHE_BYTES, suffix=".jpg")
+        self.log = log or (lambda message: None)
+        self._cond = threading.Condition()
+        self._queue = []  # (priority, generation, order, key, src, kind)
+        self._pending = {}  # key -> threading.Event, 同一个缩略图只生成一次
+        self._failed = set()
+        self._identities = OrderedDict()  # (path, size, mtime_ns) -> file_identity, LRU
+        self._generation = 0
+        self._unsaved = 0
+        self._order = itertools.count()
+        self._thread = None
+
+    def key_for(self, src, kind="frame"):
+        st = os.stat(src)
+        stat_key = (src, st.st_size, st.st_mtime_ns)
+        with self._cond:
+            identity = self._identities.get(stat_key)
+            if identity is not None:
+                self._identities.move_to_end(stat_key)
+        if identity is None:
+            identity = file_identity(src)
+            with self._cond:
+                self._identities[stat_key] = identity
+                if len(self._identities) > IDENTITY_MEMO_SIZE:
+                    self._identities.popitem(last=False)
+        params = {"version": THUMB_VERSION, "kind": kind,
+                  "width": SPRITE_WIDTH if kind == "sprite" else FRAME_WIDTH,
+                  "frames": SPRITE_FRAMES if kind == "sprite" else 1}
+        return cache_key(identity, params)
+
+    def cached(self, src, kind="frame"):
+        """Cached JPEG path or None, without generating anything."""
+        try:
+            key = self.key_for(src, kind)
+        except OSError:
+            return None
+        return self.cache.get(key)
+
+    def get(self, src, kind="frame", timeout=20.0):
+        """The JPEG for src, generated now (ahead of any background work) if needed. None on failure."""
+        try:
+            key = self.key_for(src, kind)
+        except OSError:
+            return None
+        path = self.cache.get(key)
+        if path:
+            return path
+        done = self._enqueue(key, src, kind, PRIORITY_NOW)
+        if done is None or not done.wait(timeout):
+            return None
+        return self.cache.get(key)
+
+    def prefetch(self, sources, kind="frame"):
+        """Queues thumbnails for sources at background priority, dropping older prefetches."""
+        with self._cond:
+            self._generation += 1
+        queued = 0
+        for src in sources:
+            try:
+                key = self.key_for(src, kind)
+            except OSError:
+                continue
+            if not self.cache.contains(key) and self._enqueue(key, src, kind, PRIORITY_BACKGROUND):
+                queued += 1
+        return queued
+
+    def _enqueue(self, key, src, kind, priority):
+        with self._cond:
+            if key in self._failed:
+                return None
+            done = self._pending.get(key)
+            if done is None:
+                done = self._pending[key] = threading.Event()
+            # 已经在排队的项目被再次请求时按更高的优先级再放一份，worker 取到重复项会跳过
+            heapq.heappush(self._queue, (priority, -self._generation if priority else 0, next(self._order), key, src, kind))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name="thumbnails", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return done
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                priority, generation, _, key, src, kind = heapq.heappop(self._queue)
+                done = self._pending.get(key)
+                if done is None:
+                    continue  # 已经生成过
+                if priority == PRIORITY_BACKGROUND and -generation != self._generation:
+                    # 过期的预取：没人在等就丢掉
+                    if not any(item[3] == key for item in self._queue):
+                        del self._pending[key]
+                        done.set()
+                    continue
+            ok = self._render(key, src, kind)
+            with self._cond:
+                if not ok:
+                    self._failed.add(key)
+                self._pending.pop(key, None)
+            done.set()
+
+    def _render(self, key, src, kind):
+        # .tmp 结尾：进程中途退出时 DiskCache 加载索引会忽略它
+        out = self.cache.path_for(key) + ".render.tmp"
+        cmd, options = _low_priority(thumbnail_command(self.ffmpeg_bin, src, out, kind))
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60, **options)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.log(f"DEBUG: thumbnail for {os.path.basename(src)} failed: {e}")
+            return False
+        if result.returncode != 0 or not os.path.exists(out):
+            self.log(f"DEBUG: thumbnail for {os.path.basename(src)} failed: {result.stderr[-200:]}")
+            if os.path.exists(out):
+                os.remove(out)
+            return False
+        self.cache.put(key, out, persist=False)
+        with self._cond:
+            self._unsaved += 1
+            idle = not self._queue
+        # 索引只记录最近使用时间，攒一批或队列空了再写
+        if idle or self._unsaved >= 50:
+            self._unsaved = 0
+            self.cache.save()
+        return True
+
+    def stats(self):
+        with self._cond:
+            queued = len(self._pending)
+        return {**self.cache.stats(), "queued": queued, "failed": len(self._failed)}
@@ -0,0 +1,353 @@
+"""Long-running watch mode: render new TeslaCam minutes as they arrive.
+
+`TeslaCamWatcher` keeps a `TeslaCamMerger` around and every few seconds
+asks the source index (cheap, see source_index.py) which minute groups are
+new.  A group is rendered once its files have stopped changing for
+`settle_seconds` (they may still be copying), then appended to the day's
+TeslaCam_{date}.mp4 with a stream copy.  A minute that arrives out of order
+(earlier than what the day's output already holds) triggers a rebuild of
+that day instead; its other minutes come straight from the fragment cache.
+So does a minute that gains a camera file after it was rendered (a slow
+copy): the handled state records which cameras each minute had.  A day file
+the watcher did not write itself (e.g. an earlier merge_all into the same
+folder) is never replaced by just the new minutes: the first new minute of
+such a day rebuilds it from every handled minute of that date.
+
+Appending stream-copies the whole day file again each time, so over a long
+day the I/O grows quadratically with the number of appends (the encode cost
+does not; only new minutes are rendered).
+
+On Linux, inotify wakes the loop as soon as files are written; elsewhere
+(or when inotify runs out of watches) it simply polls.
+
+    python watch_mode.py /srv/teslacam /srv/teslacam_out --settle 60
+"""
+import os
+import sys
+import json
+import time
+import errno
+import select
+import argparse
+import threading
+
+from merge_tesla_cam import TeslaCamMerger
+from wheel_sprites import ensure_atlas
+
+STATE_FILE = ".teslacam_watch.json"
+
+
+class _Inotify:
+    """Minimal inotify wrapper via ctypes (Linux only), used only to wake the poll loop early."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+        self.full = False
+        self.ctypes = ctypes
+
+    def add(self, path):
+        """Returns False once the kernel watch limit is reached (the caller keeps polling)."""
+        if path in self.watched or self.full:
+            return not self.full
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            err = self.ctypes.get_errno()
+            if err == errno.ENOSPC:
+                self.full = True
+                return False
+            return True  # 目录刚被删掉等情况，忽略
+        self.watched.add(path)
+        return True
+
+    def wait(self, timeout):
+        """Blocks up to timeout seconds; True if any event arrived (events are drained)."""
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TeslaCamWatcher:
+    def __init__(self, source_path, output_dir, progress_callback=None, interval=30.0, settle_seconds=60.0,
+                 backfill=False, merger=None, use_inotify=True):
+        self.merger = merger or TeslaCamMerger(source_path, output_dir, progress_callback)
+        self.source_path = source_path
+        self.output_dir = output_dir
+        self.interval = interval
+        self.settle_seconds = settle_seconds
+        self.backfill = backfill
+        self.use_inotify = use_inotify
+        self.state_path = os.path.join(output_dir, STATE_FILE)
+        # handled: 已处理（或启动时作为存量跳过）的分钟及当时有哪些摄像头；output: 已写进当天输出文件的分钟
+        self.state = {"handled": {}, "output": {}}
+        self.pending = {}  # timestamp -> (file signature, first time seen with that signature)
+        self._stop = threading.Event()
+        self._inotify = None
+
+    def log(self, message):
+        self.merger.log(message)
+
+    def stop(self):
+        self._stop.set()
+        self.merger.stop()
+
+    # --- state ---
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.state = {"handled": data.get("handled", {}), "output": data.get("output", {})}
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def _save_state(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    def _handled_day(self, date_str):
+        """{ts: set of cameras handled, or None if unknown} of one date."""
+        handled = self._handled.get(date_str)
+        if handled is None:
+            stored = self.state["handled"].get(date_str, {})
+            # 旧版状态文件只记了时间戳，不知道当时有哪些摄像头
+            if isinstance(stored, list):
+                handled = {ts: None for ts in stored}
+            else:
+                handled = {ts: set(cams) if cams is not None else None for ts, cams in stored.items()}
+            self._handled[date_str] = handled
+        return handled
+
+    def _is_handled(self, date_str, ts, cameras):
+        """True if ts was handled with (at least) these cameras; a minute that gained a camera is new again."""
+        handled = self._handled_day(date_str)
+        if ts not in handled:
+            return False
+        return handled[ts] is None or set(cameras) <= handled[ts]
+
+    def _mark_handled(self, date_str, timestamps, in_output=None):
+        """timestamps: {ts: cameras} that were rendered (or skipped)."""
+        handled = self._handled_day(date_str)
+        for ts, cameras in timestamps.items():
+            handled[ts] = (handled.get(ts) or set()) | set(cameras)
+        self.state["handled"][date_str] = {ts: sorted(cams) if cams is not None else None
+                                           for ts, cams in sorted(handled.items())}
+        if in_output is not None:
+            self.state["output"][date_str] = sorted(in_output)
+
+    # --- detection ---
+
+    @staticmethod
+    def _signature(cameras):
+        sig = []
+        for cam, path in sorted(cameras.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            sig.append((cam, st.st_size, st.st_mtime_ns))
+        return tuple(sig)
+
+    def _ready_groups(self, grouped):
+        """New minute groups whose files have not changed for settle_seconds, as {date: {ts: cameras}}."""
+        now = time.time()
+        ready = {}
+        live = set()
+        for date_str, timestamps in grouped.items():
+            for ts, cameras in timestamps.items():
+                # 慢速拷贝时某个摄像头可能在这一分钟处理完之后才到，届时重新渲染这一分钟
+                if self._is_handled(date_str, ts, cameras):
+                    continue
+                live.add(ts)
+                # 索引里的 size 只在目录变化时更新，正在复制的文件要直接 stat
+                sig = self._signature(cameras)
+                if sig is None:
+                    continue
+                previous = self.pending.get(ts)
+                if not previous or previous[0] != sig:
+                    self.pending[ts] = (sig, now)
+                    continue
+                newest_mtime = max(m for _, _, m in sig) / 1e9
+                if now - previous[1] >= self.settle_seconds and now - newest_mtime >= self.settle_seconds:
+                    ready.setdefault(date_str, {})[ts] = cameras
+        for ts in list(self.pending):
+            if ts not in live:
+                del self.pending[ts]
+        return ready
+
+    def _next_wait(self):
+        """Sleep until the next poll, or earlier when a pending group is about to settle."""
+        wait = self.interval
+        now = time.time()
+        for _, first_seen in self.pending.values():
+            wait = min(wait, max(1.0, first_seen + self.settle_seconds - now + 0.5))
+        return wait
+
+    def _watch_new_dirs(self):
+        if not self._inotify:
+            return
+        for path in self.merger.source_index.directories(self.source_path):
+            if not self._inotify.add(path):
+                self.log("inotify watch limit reached, falling back to polling for new folders")
+                break
+
+    # --- rendering ---
+
+    def _render_day(self, date_str, new_clips):
+        """Renders new_clips ({ts: cameras}) and appends them to (or rebuilds) TeslaCam_{date}.mp4."""
+        merger = self.merger
+        final_output = os.path.join(self.output_dir, f"TeslaCam_{date_str}.mp4")
+        in_output = list(self.state["output"].get(date_str, []))
+        append = bool(in_output) and os.path.exists(final_output) and min(new_clips) > max(in_output)
+        # 输出目录里已有不是本进程写的当天文件：不能只用新分钟覆盖它，按所有已处理的分钟重建
+        foreign = not in_output and os.path.exists(final_output)
+
+        if (in_output and not append) or foreign:
+            # 乱序到达（或输出文件丢失）：整天重建，已渲染过的分钟从分片缓存直接取
+            grouped, _ = merger.group_videos()
+            day = grouped.get(date_str, {})
+            base = self._handled_day(date_str) if foreign else in_output
+            clips = {ts: day[ts] for ts in base if ts in day}
+            clips.update(new_clips)
+            self.log(f"Watch: rebuilding {date_str} with {len(new_clips)} new of {len(clips)} clips")
+        else:
+            clips = new_clips
+            self.log(f"Watch: rendering {len(clips)} new clips for {date_str}")
+
+        fragments = []
+        for ts, cameras in sorted(clips.items()):
+            if self._stop.is_set():
+                merger._release_fragments([p for _, p in fragments])
+                return False
+            fragment = merger.process_clip(ts, cameras)
+            if fragment:
+                fragments.append((ts, fragment))
+            else:
+                self.log(f"Watch: failed to render {ts}, skipping it")
+        rendered = {ts for ts, _ in fragments}
+        if not fragments:
+            self._mark_handled(date_str, new_clips, in_output)
+            return True
+
+        if append:
+            previous = os.path.join(self.output_dir, f"temp_prev_TeslaCam_{date_str}.mp4")
+            os.replace(final_output, previous)
+            # 空字符串排在所有时间戳前面：旧的整天输出作为第一段，新分片接在后面
+            result = merger._finalize_day(date_str, [("", previous)] + fragments)
+            if not result and os.path.exists(previous):
+                os.replace(previous, final_output)
+                return False
+            in_output = set(in_output) | rendered
+        else:
+            result = merger._finalize_day(date_str, fragments)
+            if not result:
+                return False
+            in_output = rendered
+
+        self._mark_handled(date_str, new_clips, in_output)
+        self.log(f"Watch: {final_output} now has {len(in_output)} clips")
+        return True
+
+    # --- main loop ---
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._handled = {}
+        merger = self.merger
+        merger.probe_encoders()
+        if merger.wheel_sprites and not merger.wheel_atlas:
+            merger.wheel_atlas = ensure_atlas(merger.get_ffmpeg_path("ffmpeg"), log=self.log)
+            merger.wheel_sprites = bool(merger.wheel_atlas)
+
+        grouped, total = merger.group_videos()
+        if not self._load_state() and not self.backfill:
+            # 第一次启动：现有存档不处理，只盯新来的分钟
+            for date_str, timestamps in grouped.items():
+                self._mark_handled(date_str, timestamps)
+            self._save_state()
+            self.log(f"Watch: {total} existing files marked as handled (use backfill to render them)")
+
+        if self.use_inotify and sys.platform.startswith("linux") and merger.source_index:
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError) as e:
+                self.log(f"DEBUG: inotify unavailable ({e}), polling every {self.interval:.0f}s")
+        self.log(f"Watching {self.source_path} ({'inotify' if self._inotify else 'polling'}, "
+                 f"settle {self.settle_seconds:.0f}s)")
+
+        try:
+            while not self._stop.is_set():
+                self._watch_new_dirs()
+                ready = self._ready_groups(grouped)
+                for date_str, clips in sorted(ready.items()):
+                    if self._stop.is_set():
+                        break
+                    for ts in clips:
+                        self.pending.pop(ts, None)
+                    self._render_day(date_str, clips)
+                    self._save_state()
+                if self._stop.is_set():
+                    break
+                wait = self._next_wait()
+                if self._inotify:
+                    if self._inotify.wait(wait):
+                        self._stop.wait(1.0)  # 一次复制会触发一串事件，稍等让它们合并
+                else:
+                    self._stop.wait(wait)
+                grouped, _ = merger.group_videos()
+        finally:
+            if self._inotify:
+                self._inotify.close()
+                self._inotify = None
+            if merger.fragment_cache:
+                merger.fragment_cache.save()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("source")
+    ap.add_argument("output")
+    ap.add_argument("--interval", type=float, default=30.0, help="poll interval in seconds")
+    ap.add_argument("--settle", type=float, default=60.0, help="seconds a minute's files must stay unchanged")
+    ap.add_argument("--backfill", action="store_true", help="also render footage that exists at first start")
+    ap.add_argument("--no-inotify", action="store_true")
+    ap.add_argument("--fragment-cache-dir", help="where to keep the fragment cache (default: ~/.teslacam_merger)")
+    args = ap.parse_args(argv)
+
+    merger = TeslaCamMerger(args.source, args.output, print, fragment_cache_dir=args.fragment_cache_dir)
+    watcher = TeslaCamWatcher(args.source, args.output, progress_callback=print, interval=args.interval,
+                              settle_seconds=args.settle, backfill=args.backfill, merger=merger,
+                              use_inotify=not args.no_inotify)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
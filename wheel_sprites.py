@@ -0,0 +1,141 @@
+"""Pre-rendered steering wheel sprites for the burned-in overlay.
+
+With the plain ASS overlay libass has to parse and rasterize the wheel
+drawing again for every event.  In sprite mode the wheel is rendered once
+per quantized angle into an atlas PNG (cached under ~/.teslacam_merger),
+and the encode only crops the current cell and overlays it: a `sendcmd`
+file, written next to the text-only .ass, moves the crop window whenever
+the quantized angle changes.
+
+The atlas is rendered by libass itself (on black and on white, the
+difference gives the alpha), so the sprites look exactly like the ASS wheel.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+from dashcam_parser import ASS_HEADER, WHEEL_VECTOR, STEERING_QUANTUM_DEG, format_time_ass
+from disk_cache import DATA_DIR
+
+ATLAS_VERSION = 1
+SPRITE_DIR = os.path.join(DATA_DIR, "sprites")
+
+# 方向盘在 1920x1080 画布上的中心（即 ASS 里的 \pos(380,430)），单元格 = 半径 50 + 描边和阴影
+WHEEL_CENTER = (380, 430)
+CELL_SIZE = 112
+ATLAS_COLUMNS = 15
+
+_atlas_lock = threading.Lock()
+
+
+def sprite_quantum(quantum):
+    """Angle step between atlas cells; finer than 1° would only bloat the atlas."""
+    return max(quantum or 0, 1.0)
+
+
+def cell_count(quantum):
+    return int(round(360 / sprite_quantum(quantum)))
+
+
+def cell_index(angle, quantum):
+    return int(round(angle / sprite_quantum(quantum))) % cell_count(quantum)
+
+
+def cell_origin(index):
+    return (index % ATLAS_COLUMNS) * CELL_SIZE, (index // ATLAS_COLUMNS) * CELL_SIZE
+
+
+def commands_path(ass_path):
+    """The sendcmd file that belongs to a text-only .ass overlay."""
+    return os.path.splitext(ass_path)[0] + ".wheel.cmd"
+
+
+def write_commands(spans, path, quantum=STEERING_QUANTUM_DEG):
+    """Writes a sendcmd script from (start, end, angle) spans. Returns the number of crop moves."""
+    moves = 0
+    last = None
+    with open(path, "w", encoding="utf-8") as f:
+        for start, _, angle in spans:
+            index = cell_index(angle, quantum)
+            if index == last:
+                continue
+            x, y = cell_origin(index)
+            f.write(f"{start:.3f} crop@wheel x {x}, crop@wheel y {y};\n")
+            last = index
+            moves += 1
+    return moves
+
+
+def _escape(path):
+    return path.replace('\\', '\\\\').replace(':', '\\:').replace("'", "\\'")
+
+
+def wheel_filter(input_index, cmd_path, in_node, out_node):
+    """filter_complex snippet that overlays the atlas input onto in_node.
+    The atlas is decoded and converted once and then repeated with the loop filter; `-loop 1` on the
+    input would decode the PNG again for every frame."""
+    x = WHEEL_CENTER[0] - CELL_SIZE // 2
+    y = WHEEL_CENTER[1] - CELL_SIZE // 2
+    return (f"[{input_index}:v] format=yuva420p, loop=loop=-1:size=1, setpts=N/25/TB, "
+            f"sendcmd=f='{_escape(cmd_path)}', crop@wheel=w={CELL_SIZE}:h={CELL_SIZE}:x=0:y=0 [wheel]; "
+            f"{in_node}[wheel] overlay=x={x}:y={y}:shortest=1 {out_node}; ")
+
+
+def _atlas_ass(path, quantum):
+    """One event per cell, one second each, centered on a CELL_SIZE canvas at the overlay's 1:1 scale."""
+    center = CELL_SIZE // 2
+    header = ASS_HEADER.replace("PlayResX: 1920", f"PlayResX: {CELL_SIZE}").replace("PlayResY: 1080", f"PlayResY: {CELL_SIZE}")
+    step = sprite_quantum(quantum)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(header)
+        for i in range(cell_count(quantum)):
+            f.write(f"Dialogue: 0,{format_time_ass(i)},{format_time_ass(i + 1)},DashWheel,,0,0,0,,"
+                    f"{{\\an7\\pos({center},{center})\\org({center},{center})\\frz{i * step:g}}}{{\\p1}}{WHEEL_VECTOR}{{\\p0}}\n")
+
+
+def atlas_path(quantum=STEERING_QUANTUM_DEG):
+    digest = hashlib.sha1(f"{ATLAS_VERSION}|{CELL_SIZE}|{sprite_quantum(quantum)}|{WHEEL_VECTOR}|{ASS_HEADER}".encode("utf-8"))
+    return os.path.join(SPRITE_DIR, f"wheel_atlas_{digest.hexdigest()[:16]}.png")
+
+
+def ensure_atlas(ffmpeg_bin="ffmpeg", quantum=STEERING_QUANTUM_DEG, log=None):
+    """Returns the atlas PNG, rendering it on first use. None if ffmpeg could not build it."""
+    path = atlas_path(quantum)
+    with _atlas_lock:
+        if os.path.exists(path):
+            return path
+        os.makedirs(SPRITE_DIR, exist_ok=True)
+        rows = -(-cell_count(quantum) // ATLAS_COLUMNS)
+        frames = rows * ATLAS_COLUMNS
+        with tempfile.TemporaryDirectory(dir=SPRITE_DIR) as tmp:
+            ass = os.path.join(tmp, "wheel.ass")
+            _atlas_ass(ass, quantum)
+            src = f"s={CELL_SIZE}x{CELL_SIZE}:r=1:d={frames}"
+            render = f"format=gbrp, ass='{_escape(ass)}', tile={ATLAS_COLUMNS}x{rows}"
+            # 黑底和白底各渲染一次：alpha = 255 - (白 - 黑)，颜色 = 黑底结果 / alpha（overlay 要非预乘的颜色）
+            alpha = "clip(255-(x-y),0,255)"
+            color = "if(gte(y-x,255),0,clip(x*255/(255-(y-x)),0,255))"
+            graph = (f"[0:v] {render}, split [b1][b2]; [1:v] {render}, split [w1][w2]; "
+                     f"[w1][b1] lut2=c0='{alpha}', extractplanes=g [alpha]; "
+                     f"[b2][w2] lut2=c0='{color}':c1='{color}':c2='{color}', format=gbrap [color]; "
+                     f"[color][alpha] alphamerge, format=rgba [atlas]")
+            out = os.path.join(tmp, "atlas.png")
+            cmd = [ffmpeg_bin, "-v", "error", "-y",
+                   "-f", "lavfi", "-i", f"color=c=black:{src}",
+                   "-f", "lavfi", "-i", f"color=c=white:{src}",
+                   "-filter_complex", graph, "-map", "[atlas]", "-frames:v", "1", "-update", "1", out]
+            try:
+                result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                result = None
+                error = str(e)
+            else:
+                error = result.stderr[-200:]
+            if result is None or result.returncode != 0 or not os.path.exists(out):
+                if log:
+                    log(f"DEBUG: Could not render steering wheel atlas: {error}")
+                return None
+            os.replace(out, path)
+        return path
@@ -0,0 +1,164 @@
+"""Per-machine calibration of the libx264 fallback.
+
+The software encoder used to be `libx264 -preset veryfast` on every host.
+That is needlessly fast on a desktop with many cores and can fall behind on
+a small NAS.  `calibrate` renders a short synthetic 4-up clip through the
+merger's own `create_grid_command`, running `concurrency` encodes side by
+side the way the pipeline does, for each preset (fastest first) and a
+couple of thread counts.  It keeps the slowest preset whose combined
+real-time factor still reaches `target_rtf`.  The bitrate stays at the
+fixed 3000k of the grid command, so a slower preset means better quality
+for the same file size rather than a smaller file.
+
+The result is stored per machine and ffmpeg build (like the encoder probe),
+and `calibrated_codec` turns it into the codec string TeslaCamMerger puts
+last in its encoder chain.  Run `python x264_calibration.py` to
+(re)calibrate.
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from disk_cache import DATA_DIR
+from encoder_pool import ffmpeg_identity, default_slot_count
+
+CALIBRATION_PATH = os.path.join(DATA_DIR, "x264_calibration.json")
+PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow")
+CALIBRATION_SECONDS = 4
+# 所有并发编码合计的实时倍数：1.0 刚好跟上行车记录仪写入的速度，默认留一半余量
+TARGET_RTF = 1.5
+GRID_CAMERAS = ("front", "back", "left_repeater", "right_repeater")
+
+
+def load_calibration(ffmpeg_bin, path=CALIBRATION_PATH):
+    """The stored calibration for this machine and ffmpeg build, None if there is none."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if data.get("identity") == ffmpeg_identity(ffmpeg_bin) and data.get("choice") else None
+
+
+def calibrated_codec(ffmpeg_bin, path=CALIBRATION_PATH):
+    """'libx264 -preset X -threads N' from the stored calibration, None if uncalibrated."""
+    data = load_calibration(ffmpeg_bin, path)
+    if not data:
+        return None
+    choice = data["choice"]
+    return f"libx264 -preset {choice['preset']} -threads {choice['threads']}"
+
+
+def _synthetic_source(ffmpeg_bin, work_dir, seconds):
+    """A camera-sized clip with motion and sensor-like noise, so decode and x264 costs look like real footage."""
+    path = os.path.join(work_dir, "calibration_source.mp4")
+    cmd = [ffmpeg_bin, "-v", "error", "-y", "-f", "lavfi", "-i", f"testsrc2=s=1280x960:r=36:d={seconds}",
+           "-vf", "noise=alls=12:allf=t", "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "6M", "-g", "36",
+           "-pix_fmt", "yuv420p", path]
+    subprocess.run(cmd, capture_output=True, check=True)
+    return path
+
+
+def _measure(merger, source, preset, threads, concurrency, seconds, work_dir):
+    """Runs `concurrency` grid encodes at once; returns the combined real-time factor and mean output size."""
+    codec = f"libx264 -preset {preset} -threads {threads}"
+    cameras = {camera: source for camera in GRID_CAMERAS}
+    outputs = [os.path.join(work_dir, f"calibration_{preset}_{threads}_{i}.mp4") for i in range(concurrency)]
+    results = [None] * concurrency
+
+    def encode(i):
+        cmd = merger.create_grid_command(cameras, outputs[i], codec=codec)
+        results[i] = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+
+    start = time.monotonic()
+    workers = [threading.Thread(target=encode, args=(i,)) for i in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+    failed = [r for r in results if r.returncode != 0]
+    if failed:
+        raise RuntimeError(f"libx264 {preset} failed: {failed[0].stderr[-200:]}")
+    size = sum(os.path.getsize(p) for p in outputs) / concurrency
+    for p in outputs:
+        os.remove(p)
+    return {"preset": preset, "threads": threads, "rtf": round(concurrency * seconds / elapsed, 2), "bytes": int(size)}
+
+
+def thread_options(concurrency, cpu_count=None):
+    """Thread counts worth trying per encode: an even share of the cores, and twice that (decode stalls leave gaps)."""
+    cpus = cpu_count or os.cpu_count() or 2
+    share = max(1, cpus // concurrency)
+    return sorted({share, min(cpus, share * 2)})
+
+
+def calibrate(merger, concurrency=None, target_rtf=TARGET_RTF, presets=PRESETS, seconds=CALIBRATION_SECONDS,
+              path=CALIBRATION_PATH, log=print):
+    """Measures the presets on this machine, stores and returns the calibration.
+
+    concurrency: how many software encodes run at once (default: the merger's fixed max_workers, else
+    the libx264 slot count).  Presets are tried fastest first; the search stops at the first preset that
+    misses target_rtf, since slower ones would miss it too."""
+    ffmpeg_bin = merger.get_ffmpeg_path("ffmpeg")
+    concurrency = concurrency or merger.max_workers or default_slot_count("libx264")
+    work_dir = tempfile.mkdtemp(prefix="teslacam_calibration_")
+    measurements = []
+    choice = None
+    try:
+        source = _synthetic_source(ffmpeg_bin, work_dir, seconds)
+        for preset in presets:
+            best = None
+            for threads in thread_options(concurrency):
+                result = _measure(merger, source, preset, threads, concurrency, seconds, work_dir)
+                measurements.append(result)
+                log(f"libx264 {preset:<9} threads={threads:<2} x{concurrency}: {result['rtf']:.2f}x real time, "
+                    f"{result['bytes'] / 1024:.0f} KB")
+                if not best or result["rtf"] > best["rtf"]:
+                    best = result
+            if best["rtf"] < target_rtf:
+                break
+            choice = best
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not choice:
+        # 连最快的预设都达不到目标：用最快的，至少不比以前慢
+        choice = max((m for m in measurements if m["preset"] == presets[0]), key=lambda m: m["rtf"])
+        log(f"No preset reaches {target_rtf}x real time at concurrency {concurrency}; using {choice['preset']}.")
+    data = {"identity": ffmpeg_identity(ffmpeg_bin), "checked": time.time(), "concurrency": concurrency,
+            "target_rtf": target_rtf, "seconds": seconds, "measurements": measurements,
+            "choice": {"preset": choice["preset"], "threads": choice["threads"], "rtf": choice["rtf"]}}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+    log(f"Selected libx264 -preset {choice['preset']} -threads {choice['threads']} ({choice['rtf']:.2f}x real time)")
+    return data
+
+
+def main():
+    from merge_tesla_cam import TeslaCamMerger
+
+    parser = argparse.ArgumentParser(description="Pick the libx264 preset and thread count for this machine.")
+    parser.add_argument("--target", type=float, default=TARGET_RTF,
+                        help="combined real-time factor the parallel encodes must reach (default %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=None, help="parallel software encodes (default: CPU based)")
+    parser.add_argument("--seconds", type=int, default=CALIBRATION_SECONDS, help="length of the test clip")
+    parser.add_argument("--presets", default=",".join(PRESETS), help="comma separated, fastest first")
+    args = parser.parse_args()
+
+    merger = TeslaCamMerger(tempfile.gettempdir(), tempfile.gettempdir(), use_fragment_cache=False,
+                            use_source_index=False, use_journal=False)
+    calibrate(merger, concurrency=args.concurrency, target_rtf=args.target, seconds=args.seconds,
+              presets=tuple(p.strip() for p in args.presets.split(",") if p.strip()))
+
+
+if __name__ == "__main__":
+    main()